@@ -1,10 +1,14 @@
 import numpy as np # linear algebra
 import pandas as pd # data processing, CSV file I/O (e.g. pd.read_csv)
 import pickle
+import sys
 from collections import defaultdict
 from itertools import product
 from tqdm import tqdm
 
+sys.path.insert(0, '..')
+from csv_writer import write_csv, write_submission
+
 # Input data files are available in the read-only "../input/" directory
 # For example, running this (by clicking run or pressing Shift+Enter) will list all files under the input directory
 
@@ -112,11 +116,7 @@ def predict(input_data, model, num_tries=5):
             print("iteration: {}, mae: {}".format(i, mae))
     
     print("MAE on test dataset: {}".format(test_mae / n))
-    df_ = df[['id']].copy()
-    predictions = predictions.reshape(n, 625)
-    for i in range(625):
-        df_['start_{}'.format(i)] = predictions[:,i]
-    return df_
+    return df['id'].to_numpy(), predictions.reshape(n, 625)
 
 if __name__ == '__main__':
     N = 200000
@@ -124,18 +124,11 @@ if __name__ == '__main__':
     model_path = '../../data/model.pkl'
     test_data_path = '../../data/test.csv'
     submission_path = '../../data/submissions.csv'
-    with open(new_data_path, 'w') as outfile:
-        # Write column header
-        columns = ['start_{}'.format(i) for i in range(625)] + ['stop_{}'.format(i) for i in range(625)]
-        outfile.write(','.join(columns))
-        outfile.write('\n')
-        for i in range(N):
-            start_board, stop_board = generate()
-            row = ','.join(map(str, start_board.flatten())) + ','
-            row += ','.join(map(str, stop_board.flatten())) + '\n'
-            outfile.write(row)
-    
+    # Write column header
+    columns = ['start_{}'.format(i) for i in range(625)] + ['stop_{}'.format(i) for i in range(625)]
+    write_csv(new_data_path, (generate() for _ in range(N)), header=columns)
+
     model = create_prob_model(new_data_path, model_path)
     #model = pickle.load(open(model_path, 'rb'))
-    predictions = predict(test_data_path, model) 
-    predictions.to_csv(submission_path, index=False)
+    ids, predictions = predict(test_data_path, model)
+    write_submission(submission_path, ids, predictions)
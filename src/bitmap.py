@@ -1,6 +1,11 @@
 import numpy as np
 import itertools
+import functools
+import queue
+import time
+import multiprocessing as mp
 import torch.utils.data
+from numpy.lib.stride_tricks import as_strided
 from simulator import life_step
 
 def generate_all(m, n):
@@ -68,10 +73,364 @@ def generate_inf_cases(train, seed, board_size=25, min_dens=0.01, max_dens=0.99,
                 yield delta, stop
 
 
+class StratifiedCaseGenerator:
+    """
+    Case generator with stratified sampling over (delta, density bucket of the start board after warm-up).
+
+    Plain generate_inf_cases wastes a lot of simulation on boards that die during warm-up (about a quarter of them) and
+    produces the rare strata only occasionally. Here the initial density is drawn from one of init_bins equal-width bins,
+    and the bin is chosen in proportion to how likely it is (according to online acceptance statistics) to produce
+    boards for strata that are behind their target share. After warm-up the density bucket is known, so the delta is
+    picked as the most under-filled stratum of that bucket and the board is evolved only that far (falling back to the
+    longest delta it survived, rather than discarding it).
+
+    Importance weights are p_natural(stratum) / p_emitted(stratum), where p_natural is the estimate of the stratum
+    probability under the original (uniform density, uniform delta) generator and p_emitted the share of the stratum
+    among the emitted cases - so weighted metrics follow generate_inf_cases whatever the realized mix is (strata that
+    no initial density produces often enough just get bigger weights). Strata that were never emitted (e.g. with a
+    zero target) are missing from the weighted mix.
+
+    Unlike generate_inf_cases, the cases are tuples with the weight appended: (delta, start, stop, weight) for train,
+    (delta, one_but_last, stop, weight) with return_one_but_last and (delta, stop, weight) otherwise. That weight comes
+    from the statistics so far; metrics over the whole run should use weights(), which recomputes them for all the
+    emitted cases from the final ones.
+    """
+    def __init__(self, train, seed, target_mix=None, density_edges=(0.0, 0.05, 0.1, 0.15, 0.2, 0.3, 1.0), init_bins=10,
+                 explore=0.1, board_size=25, min_dens=0.01, max_dens=0.99, warm_up=5, min_delta=1, max_delta=5,
+                 return_one_but_last=False):
+        """
+        :param target_mix: array of shape (num deltas, num density buckets) with the desired share of every stratum
+            (normalized internally); uniform over all strata by default
+        :param density_edges: edges of the density buckets of the start board (after warm-up)
+        :param init_bins: number of bins the initial density range is split into
+        :param explore: probability of choosing the initial density bin uniformly at random
+        """
+        self.train = train
+        self.rs = np.random.RandomState(seed)
+        self.density_edges = np.asarray(density_edges, dtype=np.float64)
+        self.init_edges = np.linspace(min_dens, max_dens, init_bins + 1)
+        self.explore = explore
+        self.board_size = board_size
+        self.warm_up = warm_up
+        self.min_delta = min_delta
+        self.max_delta = max_delta
+        self.return_one_but_last = return_one_but_last
+
+        shape = (max_delta - min_delta + 1, len(self.density_edges) - 1)
+        self.target_mix = np.ones(shape) if target_mix is None else np.array(target_mix, dtype=np.float64)
+        assert self.target_mix.shape == shape
+        self.target_mix /= self.target_mix.sum()
+
+        # draws[i] - number of boards simulated from initial bin i,
+        # landed[i, b] - how many of them were in density bucket b after warm-up (boards that died count into bucket 0),
+        # observed[i, d, b] / alive[i, d, b] - how many of those were evolved at least delta d / survived it.
+        self.draws = np.zeros(init_bins)
+        self.landed = np.zeros((init_bins, shape[1]))
+        self.observed = np.zeros((init_bins,) + shape)
+        self.alive = np.zeros((init_bins,) + shape)
+        self.emitted = np.zeros(shape)
+        # Flat stratum index of every emitted case.
+        self.strata = []
+        self.life_steps = 0
+
+    def __iter__(self):
+        return self
+
+    def bucket(self, density):
+        b = np.searchsorted(self.density_edges, density, side='right') - 1
+        return min(max(b, 0), len(self.density_edges) - 2)
+
+    def acceptance(self):
+        """
+        :return: array of shape (init bins, deltas, density buckets) - online estimate of the probability that a board
+            from the initial bin ends up in the stratum (with a weak prior, so unseen strata keep being explored)
+        """
+        p_bucket = (self.landed + 0.1) / (self.draws[:, None] + 0.1 * self.landed.shape[1])
+        p_survive = (self.alive + 0.5) / (self.observed + 1.0)
+        return p_bucket[:, None, :] * p_survive
+
+    def natural_mix(self):
+        """
+        :return: estimated stratum probabilities under uniform initial density and uniform delta, after rejection
+        """
+        p = self.acceptance().mean(axis=0)
+        return p / p.sum()
+
+    def weights(self, deltas=None, buckets=None):
+        """
+        :param deltas: deltas of the cases to weight (all the emitted cases by default)
+        :param buckets: density buckets of their start boards after warm-up (see bucket)
+        :return: importance weights of the cases from the current statistics - natural share of their stratum over its
+            share of the emitted cases (0 for strata never emitted)
+        """
+        if deltas is None:
+            d, b = np.unravel_index(np.array(self.strata, dtype=np.int64), self.emitted.shape)
+        else:
+            d, b = np.asarray(deltas) - self.min_delta, np.asarray(buckets)
+        emitted = self.emitted[d, b]
+        return np.where(emitted > 0, self.natural_mix()[d, b] * self.emitted.sum() / np.maximum(emitted, 1), 0.0)
+
+    def stats(self):
+        total = max(self.emitted.sum(), 1)
+        return {
+            'emitted': int(self.emitted.sum()),
+            'life_steps_per_case': self.life_steps / total,
+            'acceptance': self.acceptance(),
+            'emitted_mix': self.emitted / total,
+        }
+
+    def _choose_init_bin(self, deficit):
+        if self.rs.uniform() < self.explore:
+            return self.rs.randint(len(self.draws))
+        score = (self.acceptance() * np.maximum(deficit, 0)[None]).sum(axis=(1, 2))
+        if score.sum() <= 0:
+            return self.rs.randint(len(self.draws))
+        return self.rs.choice(len(self.draws), p=score / score.sum())
+
+    def __next__(self):
+        m = self.board_size
+        while True:
+            deficit = self.target_mix * (self.emitted.sum() + 1) - self.emitted
+
+            i = self._choose_init_bin(deficit)
+            density = self.rs.uniform(self.init_edges[i], self.init_edges[i + 1])
+            start = self.rs.choice([1, 0], size=(m, m), p=[density, 1.0 - density])
+            for _ in range(self.warm_up):
+                start = life_step(start)
+            self.life_steps += self.warm_up
+            self.draws[i] += 1
+
+            b = self.bucket(np.mean(start))
+            self.landed[i, b] += 1
+            # Evolve only up to the delta whose stratum is the most behind; boards[k] is the board after k steps.
+            wanted = self.min_delta + int(np.argmax(deficit[:, b]))
+            # Survival is counted up to the wanted delta only, even for boards known to be dead beyond it - the boards
+            # still alive there aren't followed any further, so counting the dead ones would bias it downwards.
+            self.observed[i, :wanted - self.min_delta + 1, b] += 1
+            if not start.any():
+                continue
+
+            boards = [start]
+            while len(boards) <= wanted and boards[-1].any():
+                boards.append(life_step(boards[-1]))
+                self.life_steps += 1
+            survived = [delta for delta in range(self.min_delta, len(boards)) if boards[delta].any()]
+            for delta in survived:
+                self.alive[i, delta - self.min_delta, b] += 1
+            if not survived:
+                continue
+
+            delta = survived[-1]
+            d = delta - self.min_delta
+            self.emitted[d, b] += 1
+            self.strata.append(d * self.emitted.shape[1] + b)
+            weight = float(self.weights(delta, b))
+            if self.return_one_but_last:
+                return delta, boards[delta - 1], boards[delta], weight
+            elif self.train:
+                return delta, start, boards[delta], weight
+            else:
+                return delta, boards[delta], weight
+
+
+# Torus symmetries.
+#
+# Boards live on a torus, so the rules of the game commute with all 8 dihedral transforms of the square board
+# (rotations by k*90 degrees, optionally preceded by a transposition) and with all m*m cyclic translations.
+# Applying the same symmetry to both boards of a (prev, stop) pair gives another valid pair, so a single simulated
+# trajectory can produce up to 8*m*m training examples.
+NUM_DIHEDRAL = 8
+
+
+def dihedral_view(X, sym):
+    """
+    Zero-copy view of the board(s) X transformed by one of the 8 dihedral symmetries (acts on the last two axes).
+    :param sym: symmetry id in [0, 8) - rotation by (sym % 4) * 90 degrees, preceded by a transposition if sym >= 4
+    """
+    if sym >= 4:
+        X = np.swapaxes(X, -1, -2)
+    return np.rot90(X, sym % 4, axes=(-2, -1))
+
+
+def translation_view(X):
+    """
+    All cyclic translations of a board as a single read-only view.
+    Only a 2x2 tiling of the board is materialized, not the m*n translated copies.
+    :param X: board of shape (m, n)
+    :return: view V of shape (m, n, m, n) where V[dy, dx] == np.roll(X, (-dy, -dx), axis=(0, 1))
+    """
+    m, n = X.shape
+    D = np.tile(X, (2, 2))
+    s0, s1 = D.strides
+    return as_strided(D, shape=(m, n, m, n), strides=(s0, s1, s0, s1), writeable=False)
+
+
+@functools.lru_cache(maxsize=None)
+def symmetry_index_table(board_size):
+    """
+    Index table of all torus symmetries of a square board.
+    :return: array T of shape (8, m, m, m*m) such that X.reshape(-1)[T[sym, dy, dx]] is the board X transformed by
+        dihedral_view(X, sym) and then translated by (dy, dx) - flattened
+    """
+    m = board_size
+    dtype = np.int16 if m * m < 2 ** 15 else np.int32
+    idx = np.arange(m * m, dtype=dtype).reshape(m, m)
+    T = np.stack([translation_view(np.ascontiguousarray(dihedral_view(idx, sym))).reshape(m, m, m * m)
+                  for sym in range(NUM_DIHEDRAL)])
+    T.flags.writeable = False
+    return T
+
+
+def augment_batch(boards, k, rs):
+    """
+    Applies random torus symmetries to a batch of examples. Every array in boards gets the same transform for a given
+    example, so (prev, stop) pairs stay consistent.
+    :param boards: tuple of arrays of shape (N, m, m)
+    :param k: number of random symmetries sampled per example
+    :param rs: np.random.RandomState used for sampling
+    :return: tuple of arrays of shape (k, N, m, m) - copy j of example i is at [j, i]
+    """
+    N, m, _ = boards[0].shape
+    T = symmetry_index_table(m).reshape(-1, m * m)
+    # Sampled transforms are index rows, so the whole batch is transformed with a single gather per array.
+    idx = T[rs.randint(len(T), size=(k, N))]
+    rows = np.arange(N)[None, :, None]
+    return tuple(np.reshape(B, (N, m * m))[rows, idx].reshape(k, N, m, m) for B in boards)
+
+
+def augment_cases(cases, k, seed=None, batch_size=64):
+    """
+    Augmentation stage for case generators (e.g. generate_inf_cases). Turns every case (delta, board, board, ...) into
+    many cases using torus symmetries.
+    :param cases: iterable of tuples (delta, board, ...)
+    :param k: number of random symmetries per case, or 'all' to yield every one of the 8*m*m symmetric copies
+        (as zero-copy views, so copy them if they need to outlive the next iteration)
+    :param seed: random seed used for sampling symmetries
+    :param batch_size: number of cases transformed together in the random mode; copies are interleaved across the
+        batch, so consecutive outputs come from different trajectories
+    """
+    if k == 'all':
+        for delta, *boards in cases:
+            views = [[translation_view(np.asarray(dihedral_view(B, sym))) for B in boards]
+                     for sym in range(NUM_DIHEDRAL)]
+            m, n = boards[0].shape
+            for sym_views in views:
+                for dy in range(m):
+                    for dx in range(n):
+                        yield (delta,) + tuple(V[dy, dx] for V in sym_views)
+        return
+
+    rs = np.random.RandomState(seed)
+    it = iter(cases)
+    while True:
+        batch = list(itertools.islice(it, batch_size))
+        if not batch:
+            return
+        deltas, *boards = zip(*batch)
+        augmented = augment_batch(tuple(np.stack(B) for B in boards), k, rs)
+        for j in range(k):
+            for i, delta in enumerate(deltas):
+                yield (delta,) + tuple(A[j, i] for A in augmented)
+
+
+def num_symmetries(board_size):
+    return NUM_DIHEDRAL * board_size * board_size
+
+
+def apply_symmetry(boards, transforms):
+    """
+    :param boards: array of shape (N, m, m)
+    :param transforms: N symmetry ids in [0, 8*m*m), i.e. flat indices into symmetry_index_table(m)
+    :return: array of shape (N, m, m) with every board transformed by its symmetry
+    """
+    boards = np.asarray(boards)
+    N, m, _ = boards.shape
+    idx = symmetry_index_table(m).reshape(-1, m * m)[np.asarray(transforms)]
+    return np.reshape(boards, (N, m * m))[np.arange(N)[:, None], idx].reshape(N, m, m)
+
+
+@functools.lru_cache(maxsize=None)
+def _symmetry_inverse_table(board_size):
+    T = symmetry_index_table(board_size).reshape(-1, board_size * board_size)
+    row_to_id = {row.tobytes(): t for t, row in enumerate(T)}
+    inv = np.array([row_to_id[row.tobytes()] for row in np.argsort(T, axis=1).astype(T.dtype)])
+    inv.flags.writeable = False
+    return inv
+
+
+def inverse_symmetry(transforms, board_size):
+    """
+    :return: symmetry ids undoing the given ones: apply_symmetry(apply_symmetry(X, t), inverse_symmetry(t, m)) == X
+    """
+    return _symmetry_inverse_table(board_size)[np.asarray(transforms)]
+
+
+@functools.lru_cache(maxsize=None)
+def _orbit_hash_weights(board_size):
+    # Two independent random hashes of a board: hash(X) = sum of weights of its live cells.
+    # Weights are below 2**43, so sums over a whole 25x25 board stay below 2**53 and BLAS float64 products are exact.
+    # Column t of the result holds the weights permuted by symmetry t, so (X @ W)[t] == hash(apply_symmetry(X, t)),
+    # i.e. a single matrix product hashes every symmetric copy of every board in a batch.
+    mm = board_size * board_size
+    assert mm * 2 ** 43 < 2 ** 53
+    T = symmetry_index_table(board_size).reshape(-1, mm)
+    rs = np.random.RandomState(229)
+    W = np.empty((2, len(T), mm))
+    for h in range(2):
+        W[h][np.arange(len(T))[:, None], T] = rs.randint(0, 2 ** 43, size=mm).astype(np.float64)[None, :]
+    W = np.ascontiguousarray(np.concatenate(W, axis=0).T)
+    W.flags.writeable = False
+    return W
+
+
+def canonicalize(boards, bits=64):
+    """
+    Canonical form of boards under torus symmetries (8 dihedral transforms times all translations).
+    Boards that differ only by a symmetry get the same key and the same canonical representative, which is the symmetric
+    copy with the smallest (hash1, hash2). Keys are stable across processes, so they can be used in on-disk caches.
+    :param boards: array of shape (N, m, m)
+    :param bits: 64 for uint64 keys of shape (N,), 128 for uint64 keys of shape (N, 2)
+    :return: (keys, transforms) - apply_symmetry(boards, transforms) gives the canonical representatives and
+        inverse_symmetry(transforms, m) maps them (or results computed for them) back
+    """
+    boards = np.asarray(boards)
+    N, m, _ = boards.shape
+    T = num_symmetries(m)
+    H = np.reshape(boards, (N, m * m)).astype(np.float64) @ _orbit_hash_weights(m)
+    h1, h2 = H[:, :T], H[:, T:]
+
+    # Lexicographic argmin over (h1, h2).
+    min1 = h1.min(axis=1)
+    transforms = np.where(h1 == min1[:, None], h2, np.inf).argmin(axis=1)
+    min2 = h2[np.arange(N), transforms]
+
+    keys = np.stack([min1, min2], axis=1).astype(np.uint64)
+    if bits == 128:
+        return keys, transforms
+    elif bits == 64:
+        return keys[:, 0] * np.uint64(0x9E3779B97F4A7C15) + keys[:, 1], transforms
+    else:
+        raise Exception(f'Unsupported key size {bits}')
+
+
+def unique_boards(boards):
+    """
+    Deduplicates boards up to torus symmetries.
+    :return: indices of the first board from every symmetry class, in the original order
+    """
+    keys, _ = canonicalize(boards, bits=128)
+    _, first = np.unique(keys, axis=0, return_index=True)
+    return np.sort(first)
+
+
 class ConwayIterableDataset(torch.utils.data.IterableDataset):
-    def __init__(self, base_seed):
+    def __init__(self, base_seed, augment=None):
+        """
+        :param augment: None to use every simulated case once, otherwise the 'k' argument of augment_cases
+        """
         super(ConwayIterableDataset).__init__()
         self.base_seed = base_seed
+        self.augment = augment
 
     def __iter__(self):
         worker_info = torch.utils.data.get_worker_info()
@@ -81,5 +440,201 @@ class ConwayIterableDataset(torch.utils.data.IterableDataset):
             # split workload
             worker_id = worker_info.id
             seed = self.base_seed + worker_id
-        for delta, prev, stop in generate_inf_cases(True, seed, return_one_but_last=True):
+        cases = generate_inf_cases(True, seed, return_one_but_last=True)
+        if self.augment is not None:
+            cases = augment_cases(cases, self.augment, seed)
+        for delta, prev, stop in cases:
             yield np.array(np.reshape(stop, (1,25,25)), dtype=np.float32), delta
+
+
+
+def case_batch_specs(batch_size, board_size=25):
+    """
+    Layout of the batches produced by case_batches: (prev, stop, deltas).
+    """
+    return [
+        ((batch_size, 1, board_size, board_size), np.float32),
+        ((batch_size, 1, board_size, board_size), np.float32),
+        ((batch_size,), np.int64),
+    ]
+
+
+def case_batches(worker_id, base_seed, batch_size, augment=None, board_size=25):
+    """
+    Infinite generator of complete training batches (prev, stop, deltas) for SharedBatchRing producers.
+    Boards are float32 arrays of shape (batch_size, 1, board_size, board_size), like ConwayIterableDataset samples.
+    """
+    seed = base_seed + worker_id
+    cases = generate_inf_cases(True, seed, board_size=board_size, return_one_but_last=True)
+    if augment is not None:
+        cases = augment_cases(cases, augment, seed)
+    while True:
+        deltas, prevs, stops = zip(*itertools.islice(cases, batch_size))
+        yield (
+            np.expand_dims(np.array(prevs, dtype=np.float32), 1),
+            np.expand_dims(np.array(stops, dtype=np.float32), 1),
+            np.array(deltas, dtype=np.int64),
+        )
+
+
+class _SharedArray:
+    """
+    Array interface over a part of a shared memory block that keeps the block mapped. Arrays built on shm.buf only keep
+    the raw buffer, which SharedMemory.close() (called by its finalizer too) unmaps regardless - arrays built on this
+    object have it as their base, so the block stays mapped until the last of them is gone.
+    """
+    def __init__(self, shm, shape, dtype, offset):
+        self.shm = shm
+        address = np.frombuffer(shm.buf, dtype=np.uint8).__array_interface__['data'][0]
+        self.__array_interface__ = {
+            'shape': shape, 'typestr': dtype.str, 'data': (address + offset, False), 'version': 3,
+        }
+
+
+def _ring_producer(worker_id, shm_name, specs, num_slots, batches_fn, free_q, ready_q, stop, stall, produced):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    views = SharedBatchRing._views(shm, specs, num_slots)
+    # Never block process exit on slot ids the trainer won't read anymore.
+    ready_q.cancel_join_thread()
+    try:
+        for batch in batches_fn(worker_id):
+            tic = time.perf_counter()
+            slot = None
+            while slot is None and not stop.is_set():
+                try:
+                    slot = free_q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            stall[worker_id] += time.perf_counter() - tic
+            if slot is None:
+                break
+
+            for view, arr in zip(views, batch):
+                view[slot] = arr
+            produced[worker_id] += 1
+            ready_q.put(slot)
+    finally:
+        del views
+        shm.close()
+        ready_q.put(-1)
+
+
+class SharedBatchRing:
+    """
+    Ring buffer of complete batches in shared memory, filled by generator processes and read by the trainer.
+
+    Only slot ids go through the queues - producers write whole batches straight into shared memory and the trainer gets
+    them as zero-copy numpy views, so there's no per-sample pickling or collating. Backpressure comes from the fixed
+    number of slots: producers wait for a free slot once the trainer falls behind.
+
+    Usage:
+        with SharedBatchRing(case_batch_specs(64)) as ring:
+            ring.start(functools.partial(case_batches, base_seed=823131, batch_size=64), num_producers=4)
+            for prev, stop, deltas in ring:
+                ...
+
+    A batch is a view of its slot, which goes back to the producers once the next batch is fetched - anything kept
+    longer (including torch.from_numpy tensors sharing the memory) has to be copied, or it's silently overwritten.
+    Closing the ring stops the producers and unlinks the shared memory, but views still alive keep it mapped (with
+    the content frozen) until they're gone.
+    """
+    def __init__(self, specs, num_slots=8):
+        """
+        :param specs: list of (shape, dtype) of the arrays making up one batch
+        :param num_slots: number of batches held in the buffer
+        """
+        from multiprocessing import shared_memory
+
+        self.specs = [(tuple(shape), np.dtype(dtype)) for shape, dtype in specs]
+        self.num_slots = num_slots
+        size = sum(num_slots * int(np.prod(shape)) * dtype.itemsize for shape, dtype in self.specs)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.views = self._views(self.shm, self.specs, num_slots)
+
+        self.free_q = mp.Queue()
+        self.ready_q = mp.Queue()
+        for slot in range(num_slots):
+            self.free_q.put(slot)
+        self.stop = mp.Event()
+
+        self.producers = []
+        self.running = 0
+        self.held = None
+        self.consumer_stall = 0.0
+        self.consumed = 0
+
+    @staticmethod
+    def _views(shm, specs, num_slots):
+        views = []
+        offset = 0
+        for shape, dtype in specs:
+            views.append(np.asarray(_SharedArray(shm, (num_slots,) + shape, dtype, offset)))
+            offset += num_slots * int(np.prod(shape)) * dtype.itemsize
+        return views
+
+    def start(self, batches_fn, num_producers=1):
+        """
+        :param batches_fn: picklable function batches_fn(worker_id) returning an iterator of batches (tuples of arrays
+            matching specs) - e.g. functools.partial(case_batches, ...)
+        """
+        self.producer_stall = mp.Array('d', num_producers, lock=False)
+        self.produced = mp.Array('q', num_producers, lock=False)
+        for worker_id in range(num_producers):
+            p = mp.Process(
+                target=_ring_producer,
+                args=(worker_id, self.shm.name, self.specs, self.num_slots, batches_fn,
+                      self.free_q, self.ready_q, self.stop, self.producer_stall, self.produced),
+                daemon=True)
+            p.start()
+            self.producers.append(p)
+        self.running = num_producers
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # The previously returned batch isn't used anymore - give its slot back to the producers.
+        if self.held is not None:
+            self.free_q.put(self.held)
+            self.held = None
+
+        tic = time.perf_counter()
+        while self.running > 0:
+            slot = self.ready_q.get()
+            if slot >= 0:
+                self.consumer_stall += time.perf_counter() - tic
+                self.held = slot
+                self.consumed += 1
+                return tuple(view[slot] for view in self.views)
+            self.running -= 1
+        self.consumer_stall += time.perf_counter() - tic
+        raise StopIteration
+
+    def stats(self):
+        return {
+            'batches_produced': sum(self.produced) if self.producers else 0,
+            'batches_consumed': self.consumed,
+            'producer_stall_s': sum(self.producer_stall) if self.producers else 0.0,
+            'consumer_stall_s': self.consumer_stall,
+        }
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.stop.set()
+        for p in self.producers:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        # No close() - the block is unmapped once the views handed out (which keep it alive) are gone too.
+        self.views = None
+        self.shm.unlink()
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
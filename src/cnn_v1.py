@@ -68,7 +68,12 @@ best_multi_step_idx = -1
 best_one_step_error = 1.0
 best_one_step_idx = -1
 
-for i, batch in enumerate(grouper(bitmap.generate_inf_cases(True, 432341, return_one_but_last=True), 2048)):
+# Number of random torus symmetries per simulated board (see bitmap.augment_cases), None to use every case once.
+AUGMENT = None
+cases = bitmap.generate_inf_cases(True, 432341, return_one_but_last=True)
+if AUGMENT is not None:
+    cases = bitmap.augment_cases(cases, AUGMENT, 432341)
+for i, batch in enumerate(grouper(cases, 2048)):
     deltas, one_but_lasts, stops = zip(*batch)
 
     deltas_batch = np.expand_dims(deltas, -1)
@@ -0,0 +1,90 @@
+import numpy as np
+import itertools
+
+# Precomputed bytes for every cell value: _CELL_BYTES[v] == b'v,'
+_CELL_BYTES = np.frombuffer(b'0,1,', dtype=np.uint8).reshape(2, 2)
+_NEWLINE = ord('\n')
+
+
+def submission_header(board_size=25):
+    return ['id'] + [f'start_{i}' for i in range(board_size * board_size)]
+
+
+def format_rows(boards, ids=None):
+    """
+    Formats a chunk of boards as CSV rows without building any per-cell Python strings.
+    :param boards: array of shape (N, ...) with 0/1 (or boolean) cells - every board is flattened into one row
+    :param ids: optional sequence of N row ids, written as the first column
+    :return: bytes with N newline-terminated rows
+    """
+    boards = np.asarray(boards)
+    n = boards.shape[0]
+    if n == 0:
+        return b''
+
+    # Table lookup turns every cell into its two bytes "0," / "1,", then the last comma of each row becomes "\n".
+    out = _CELL_BYTES[boards.reshape(n, -1).astype(np.uint8)].reshape(n, -1)
+    out[:, -1] = _NEWLINE
+    if ids is None:
+        return out.tobytes()
+
+    # Ids have variable width, so they're the only part that's formatted per row.
+    body = out.tobytes()
+    width = out.shape[1]
+    return b''.join(itertools.chain.from_iterable(
+        (b'%d,' % row_id, body[k * width:(k + 1) * width]) for k, row_id in enumerate(ids)))
+
+
+def _stack_chunk(chunk):
+    # Every item is either a single board or a tuple of boards that go one after another into the same row.
+    if isinstance(chunk[0], tuple):
+        return np.concatenate([np.reshape(part, (len(chunk), -1)) for part in map(np.stack, zip(*chunk))], axis=1)
+    return np.reshape(np.stack(chunk), (len(chunk), -1))
+
+
+def _iter_chunks(rows, chunk_size):
+    if isinstance(rows, np.ndarray):
+        for k in range(0, rows.shape[0], chunk_size):
+            yield rows[k:k + chunk_size]
+        return
+
+    it = iter(rows)
+    while True:
+        chunk = list(itertools.islice(it, chunk_size))
+        if not chunk:
+            return
+        yield _stack_chunk(chunk)
+
+
+def write_csv(f, rows, header=None, ids=None, chunk_size=4096):
+    """
+    Streams boards to a CSV file, formatting chunk_size rows at a time.
+    :param f: path or binary file object
+    :param rows: array of shape (N, ...) or any iterable of boards (or tuples of boards), e.g. a generator
+    :param header: optional list of column names
+    :param ids: optional iterable of row ids, written as the first column
+    :param chunk_size: number of rows formatted and written at once
+    """
+    if isinstance(f, str):
+        with open(f, 'wb') as outfile:
+            return write_csv(outfile, rows, header=header, ids=ids, chunk_size=chunk_size)
+
+    if header is not None:
+        f.write((','.join(header) + '\n').encode())
+
+    id_iter = iter(ids) if ids is not None else None
+    for chunk in _iter_chunks(rows, chunk_size):
+        chunk_ids = list(itertools.islice(id_iter, len(chunk))) if id_iter is not None else None
+        f.write(format_rows(chunk, chunk_ids))
+
+
+def write_submission(f, ids, predictions, chunk_size=4096):
+    """
+    Writes predictions in the Kaggle submission format (id,start_0,...,start_624).
+    :param f: path or binary file object
+    :param ids: sequence of N board ids
+    :param predictions: array of shape (N, 625) or (N, 25, 25)
+    """
+    predictions = np.asarray(predictions)
+    board_size = int(round(np.sqrt(np.prod(predictions.shape[1:]))))
+    write_csv(f, predictions, header=submission_header(board_size), ids=ids, chunk_size=chunk_size)
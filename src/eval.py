@@ -2,6 +2,7 @@ import numpy as np
 import argparse
 import bitmap
 import baselines
+import orphans
 import tile_graph
 from scoring import score
 from tabulate import tabulate
@@ -15,6 +16,9 @@ if __name__ == '__main__':
 
     parser.add_argument('--baselines', action='store_true', help='Run baseline evaluations.')
     parser.add_argument('--proba_heur2_path', action='append', help='Run the ProbaHeur2 model from the provided paths.')
+    parser.add_argument('--dfs', action='store_true',
+                        help='Run DFS (anytime, boards containing an orphan pattern go to BeliefProp instead).')
+    parser.add_argument('--dfs_time_budget', type=float, default=10, help='Time budget of DFS per step back in seconds.')
 
     parser.add_argument('--test_seed', type=int, default=9568382, help='Random seed for test set generation.')
     parser.add_argument('--test_size', type=int, default=10000, help='Test set size.')
@@ -47,9 +51,17 @@ if __name__ == '__main__':
             m.load_model(path)
             models.append(m.predict)
 
+    router = None
+    if args.dfs:
+        model_names.append('dfs')
+        router = orphans.OrphanRouter(tile_graph.DFS(time_budget=args.dfs_time_budget))
+        models.append(router.predict)
+
     data = []
     for model_name, model in zip(model_names, models):
         multi_step_mean, multi_step_var, one_step_mean, one_step_var = eval(model)
         data.append((model_name, multi_step_mean, multi_step_var, one_step_mean, one_step_var))
 
     print(tabulate(data, headers=['model', 'multi-step mean', 'multi-step var', 'one step mean', 'one step var'], tablefmt='orgtbl'))
+    if router is not None:
+        print(f'Orphan index fired on {router.router_stats["routed"]} of {router.router_stats["boards"]} DFS boards.')
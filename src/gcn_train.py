@@ -15,6 +15,7 @@ Mean error: one step 0.07687658071517944
 
 from __future__ import print_function
 import argparse
+import functools
 import os
 import random
 import torch
@@ -45,10 +46,11 @@ def process_board(board, sigmoid):
 
 
 class DataGenerator(torch.utils.data.IterableDataset):
-    def __init__(self, base_seed, sigmoid):
+    def __init__(self, base_seed, sigmoid, augment=None):
         super(DataGenerator).__init__()
         self.base_seed = base_seed
         self.sigmoid = sigmoid
+        self.augment = augment
 
     def __iter__(self):
         worker_info = torch.utils.data.get_worker_info()
@@ -58,7 +60,10 @@ class DataGenerator(torch.utils.data.IterableDataset):
             # split workload
             worker_id = worker_info.id
             seed = self.base_seed + worker_id
-        for delta, prev, stop in generate_inf_cases(True, seed, return_one_but_last=True):
+        cases = generate_inf_cases(True, seed, return_one_but_last=True)
+        if self.augment is not None:
+            cases = bitmap.augment_cases(cases, self.augment, seed)
+        for delta, prev, stop in cases:
             yield (
                 process_board(prev, self.sigmoid),
                 process_board(stop, self.sigmoid)
@@ -347,7 +352,9 @@ def train(
         nz=8,
         epoch_samples=64*100,
         learn_forward=True,
-        sigmoid=True):
+        sigmoid=True,
+        augment=None,
+        shm_producers=0):
 
     os.makedirs(outf, exist_ok=True)
 
@@ -357,158 +364,177 @@ def train(
     # Prediction threshold
     pred_th = 0.5 if sigmoid else 0.0
 
-    dataset = DataGenerator(823131 + start_iter, sigmoid)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batchSize,
-                                             shuffle=False, num_workers=int(workers))
-
-    # uniform
-    rand_f = torch.rand
-
-    val_size = 1024
-    val_set = bitmap.generate_test_set(set_size=val_size, seed=9568382)
-    deltas_val, stops_val = cnnify_batch(zip(*val_set))
-    ones_val = np.ones_like(deltas_val)
-    noise_val = rand_f(val_size, nz, 1, 1, device=device)
-
-    netG = get_generator_net(gen_arch).to(device)
-    init_model(netG, gen_path)
-
-    netF = get_forward_net(fwd_arch).to(device)
-    init_model(netF, fwd_path)
-
-    criterion = nn.BCELoss()
-
-    fixed_noise = rand_f(batchSize, nz, 1, 1, device=device)
-    fixed_ones = np.ones((batchSize,), dtype=np.int)
-
-    # setup optimizer
-    if learn_forward:
-        optimizerD = optim.Adam(netF.parameters(), lr=lr, betas=(beta1, 0.999))
-    optimizerG = optim.Adam(netG.parameters(), lr=lr, betas=(beta1, 0.999))
-
-    scores = []
-    for i in range(5):
-        noise = rand_f(val_size, nz, 1, 1, device=device)
-        one_step_pred_batch = (netG(torch.Tensor(stops_val).to(device), noise) > pred_th).cpu()
-        model_scores = scoring.score_batch(ones_val, np.array(one_step_pred_batch, dtype=np.bool), stops_val)
-        scores.append(model_scores)
-
-    zeros = np.zeros_like(one_step_pred_batch, dtype=np.bool)
-    zeros_scores = scoring.score_batch(ones_val, zeros, stops_val)
-    scores.append(zeros_scores)
-
-    best_scores = np.max(scores, axis=0)
-
-    print(
-        f'Mean error one step: model {1 - np.mean(model_scores)}, zeros {1 - np.mean(zeros_scores)}, ensemble {1 - np.mean(best_scores)}')
-
-    #for epoch in range(opt.niter):
-    epoch = start_iter
-    samples_in_epoch = 0
-    samples_before = start_iter * epoch_samples
-    for j, data in enumerate(dataloader, 0):
-        i = start_iter * epoch_samples // batchSize + j
-        # train with real starting board -- data set provides ground truth
-        start_real_cpu = data[0].to(device)
-        stop_real_cpu = data[1].to(device)
-        batch_size = start_real_cpu.size(0)
-
-        ############################
-        # (2) Update G network: maximize log(D(G(z)))
-        ###########################
-        netG.zero_grad()
-        netF.zero_grad()
-        # train with fake -- use simulator (life_step) to generate ground truth
-        # TODO: replace with fixed forward model (should be faster, in batches and on GPU)
-        noise = rand_f(batch_size, nz, 1, 1, device=device)
-        fake = netG(stop_real_cpu, noise)
-        fake_np = (fake > pred_th).detach().cpu().numpy()
-        fake_next_np = life_step(fake_np)
-        fake_next = torch.tensor(fake_next_np, dtype=torch.float32).to(device)
-
-        output = netF(fake)
-        errG = criterion(output, stop_real_cpu)
-        errG.backward()
-        D_G_z2 = (output.round().eq(fake_next)).sum().item() / output.numel()
-        optimizerG.step()
-        ############################
-        # (1) Update F (forward) network -- in the original GAN, it's a "D" network (discriminator)
-        # Original comment: Update D network: maximize log(D(x)) + log(1 - D(G(z)))
-        ###########################
-
-        netG.zero_grad()
-        netF.zero_grad()
-        output = netF(start_real_cpu)
-        errD_real = criterion(output, stop_real_cpu)
-        if learn_forward:
-            errD_real.backward()
-        D_x = (output.round().eq(stop_real_cpu)).sum().item() / output.numel()
+    ring = dataloader = None
+    try:
+        if shm_producers > 0:
+            # Producers write whole batches into shared memory - no per-sample pickling through DataLoader workers.
+            ring = bitmap.SharedBatchRing(bitmap.case_batch_specs(batchSize))
+            ring.start(functools.partial(bitmap.case_batches, base_seed=823131 + start_iter, batch_size=batchSize,
+                                         augment=augment), num_producers=shm_producers)
+            # With sigmoid the tensors share memory with the ring slot, which is refilled once the next batch is fetched
+            # - they're only used within one iteration (anything kept longer has to be cloned).
+            to_tensor = torch.from_numpy if sigmoid else (lambda b: torch.from_numpy(b) * 2 - 1)
+            dataloader = ((to_tensor(prev), to_tensor(stop)) for prev, stop, _ in ring)
+        else:
+            dataset = DataGenerator(823131 + start_iter, sigmoid, augment)
+            dataloader = torch.utils.data.DataLoader(dataset, batch_size=batchSize,
+                                                     shuffle=False, num_workers=int(workers))
 
-        output = netF(fake.detach())
-        errD_fake = criterion(output, fake_next)
-        if learn_forward:
-            errD_fake.backward()
-        D_G_z1 = (output.round().eq(fake_next)).sum().item() / output.numel()
-        errD = errD_real + errD_fake
+        # uniform
+        rand_f = torch.rand
+
+        val_size = 1024
+        val_set = bitmap.generate_test_set(set_size=val_size, seed=9568382)
+        deltas_val, stops_val = cnnify_batch(zip(*val_set))
+        ones_val = np.ones_like(deltas_val)
+        noise_val = rand_f(val_size, nz, 1, 1, device=device)
+
+        netG = get_generator_net(gen_arch).to(device)
+        init_model(netG, gen_path)
+
+        netF = get_forward_net(fwd_arch).to(device)
+        init_model(netF, fwd_path)
+
+        criterion = nn.BCELoss()
+
+        fixed_noise = rand_f(batchSize, nz, 1, 1, device=device)
+        fixed_ones = np.ones((batchSize,), dtype=np.int)
+
+        # setup optimizer
         if learn_forward:
-            optimizerD.step()
-
-        # just for reporting...
-        true_stop_np = (stop_real_cpu > pred_th).detach().cpu().numpy()
-        fake_scores = scoring.score_batch(fixed_ones, fake_np, true_stop_np, show_progress=False)
-        fake_mae = 1 - fake_scores.mean()
-        fake_density = fake_np.mean()
-        real_density = start_real_cpu.detach().cpu().mean()
-
-        samples_in_epoch += batch_size
-        s = samples_before + samples_in_epoch
-        writer.add_scalar('Loss/forward', errD.item(), i)
-        writer.add_scalar('Loss/gen', errG.item(), i)
-        writer.add_scalar('MAE/train', fake_mae.item(), i)
-        writer.add_scalar('Fwd accuracy/real', D_x, i)
-        writer.add_scalar('Fwd accuracy/fake_unseen', D_G_z1, i)
-        writer.add_scalar('Fwd accuracy/fake_seen', D_G_z2, i)
-        writer.add_scalar('Density/real_start', real_density, i)
-        writer.add_scalar('Density/fake_start', fake_density, i)
-        print('[%d/%d][%d] Loss_F: %.4f Loss_G: %.4f fwd acc(real): %.2f fwd acc(fake): %.2f / %.2f, fake dens: %.2f, MAE: %.4f'
-              % (epoch, start_iter+niter, i,
-                 errD.item(), errG.item(), D_x, D_G_z1, D_G_z2, fake_density, fake_mae))
-        if samples_in_epoch >= epoch_samples:
-            """
-            multi_step_pred_batch = predict(netG, deltas_val, stops_val, fixed_noise)
-            multi_step_mean_err = 1 - np.mean(scoring.score_batch(deltas_val, np.array(multi_step_pred_batch, dtype=np.bool), stops_val))
-            """
-
-            one_step_pred_batch = (netG(torch.Tensor(stops_val).to(device), noise_val) > pred_th).detach().cpu().numpy()
-            one_step_mean_err = 1 - np.mean(scoring.score_batch(ones_val, np.array(one_step_pred_batch, dtype=np.bool), stops_val))
-            print(f'Mean error: one step {one_step_mean_err}')
-            writer.add_scalar('MAE/val', one_step_mean_err, epoch)
-
-            vutils.save_image(start_real_cpu,
-                    '%s/real_samples.png' % outf,
-                    normalize=True)
-            fake = netG(stop_real_cpu, fixed_noise).detach()
-            vutils.save_image(fake,
-                    '%s/fake_samples_epoch_%03d.png' % (outf, epoch),
-                    normalize=True)
-
-            grid = vutils.make_grid(start_real_cpu)
-            writer.add_image('real', grid, epoch)
-            grid = vutils.make_grid(fake)
-            writer.add_image('fake', grid, epoch)
-
-            # do checkpointing
-            torch.save(netG.state_dict(), '%s/netG_epoch_%d.pth' % (outf, epoch))
-            torch.save(netF.state_dict(), '%s/netF_epoch_%d.pth' % (outf, epoch))
-            epoch += 1
-            samples_in_epoch = 0
-
-        if epoch - start_iter >= niter:
-            break
-        if dry_run:
-            break
-
-    return one_step_mean_err
+            optimizerD = optim.Adam(netF.parameters(), lr=lr, betas=(beta1, 0.999))
+        optimizerG = optim.Adam(netG.parameters(), lr=lr, betas=(beta1, 0.999))
+
+        scores = []
+        for i in range(5):
+            noise = rand_f(val_size, nz, 1, 1, device=device)
+            one_step_pred_batch = (netG(torch.Tensor(stops_val).to(device), noise) > pred_th).cpu()
+            model_scores = scoring.score_batch(ones_val, np.array(one_step_pred_batch, dtype=np.bool), stops_val)
+            scores.append(model_scores)
+
+        zeros = np.zeros_like(one_step_pred_batch, dtype=np.bool)
+        zeros_scores = scoring.score_batch(ones_val, zeros, stops_val)
+        scores.append(zeros_scores)
+
+        best_scores = np.max(scores, axis=0)
+
+        print(
+            f'Mean error one step: model {1 - np.mean(model_scores)}, zeros {1 - np.mean(zeros_scores)}, ensemble {1 - np.mean(best_scores)}')
+
+        #for epoch in range(opt.niter):
+        epoch = start_iter
+        samples_in_epoch = 0
+        samples_before = start_iter * epoch_samples
+        for j, data in enumerate(dataloader, 0):
+            i = start_iter * epoch_samples // batchSize + j
+            # train with real starting board -- data set provides ground truth
+            start_real_cpu = data[0].to(device)
+            stop_real_cpu = data[1].to(device)
+            batch_size = start_real_cpu.size(0)
+
+            ############################
+            # (2) Update G network: maximize log(D(G(z)))
+            ###########################
+            netG.zero_grad()
+            netF.zero_grad()
+            # train with fake -- use simulator (life_step) to generate ground truth
+            # TODO: replace with fixed forward model (should be faster, in batches and on GPU)
+            noise = rand_f(batch_size, nz, 1, 1, device=device)
+            fake = netG(stop_real_cpu, noise)
+            fake_np = (fake > pred_th).detach().cpu().numpy()
+            fake_next_np = life_step(fake_np)
+            fake_next = torch.tensor(fake_next_np, dtype=torch.float32).to(device)
+
+            output = netF(fake)
+            errG = criterion(output, stop_real_cpu)
+            errG.backward()
+            D_G_z2 = (output.round().eq(fake_next)).sum().item() / output.numel()
+            optimizerG.step()
+            ############################
+            # (1) Update F (forward) network -- in the original GAN, it's a "D" network (discriminator)
+            # Original comment: Update D network: maximize log(D(x)) + log(1 - D(G(z)))
+            ###########################
+
+            netG.zero_grad()
+            netF.zero_grad()
+            output = netF(start_real_cpu)
+            errD_real = criterion(output, stop_real_cpu)
+            if learn_forward:
+                errD_real.backward()
+            D_x = (output.round().eq(stop_real_cpu)).sum().item() / output.numel()
+
+            output = netF(fake.detach())
+            errD_fake = criterion(output, fake_next)
+            if learn_forward:
+                errD_fake.backward()
+            D_G_z1 = (output.round().eq(fake_next)).sum().item() / output.numel()
+            errD = errD_real + errD_fake
+            if learn_forward:
+                optimizerD.step()
+
+            # just for reporting...
+            true_stop_np = (stop_real_cpu > pred_th).detach().cpu().numpy()
+            fake_scores = scoring.score_batch(fixed_ones, fake_np, true_stop_np, show_progress=False)
+            fake_mae = 1 - fake_scores.mean()
+            fake_density = fake_np.mean()
+            real_density = start_real_cpu.detach().cpu().mean()
+
+            samples_in_epoch += batch_size
+            s = samples_before + samples_in_epoch
+            writer.add_scalar('Loss/forward', errD.item(), i)
+            writer.add_scalar('Loss/gen', errG.item(), i)
+            writer.add_scalar('MAE/train', fake_mae.item(), i)
+            writer.add_scalar('Fwd accuracy/real', D_x, i)
+            writer.add_scalar('Fwd accuracy/fake_unseen', D_G_z1, i)
+            writer.add_scalar('Fwd accuracy/fake_seen', D_G_z2, i)
+            writer.add_scalar('Density/real_start', real_density, i)
+            writer.add_scalar('Density/fake_start', fake_density, i)
+            print('[%d/%d][%d] Loss_F: %.4f Loss_G: %.4f fwd acc(real): %.2f fwd acc(fake): %.2f / %.2f, fake dens: %.2f, MAE: %.4f'
+                  % (epoch, start_iter+niter, i,
+                     errD.item(), errG.item(), D_x, D_G_z1, D_G_z2, fake_density, fake_mae))
+            if samples_in_epoch >= epoch_samples:
+                """
+                multi_step_pred_batch = predict(netG, deltas_val, stops_val, fixed_noise)
+                multi_step_mean_err = 1 - np.mean(scoring.score_batch(deltas_val, np.array(multi_step_pred_batch, dtype=np.bool), stops_val))
+                """
+
+                one_step_pred_batch = (netG(torch.Tensor(stops_val).to(device), noise_val) > pred_th).detach().cpu().numpy()
+                one_step_mean_err = 1 - np.mean(scoring.score_batch(ones_val, np.array(one_step_pred_batch, dtype=np.bool), stops_val))
+                print(f'Mean error: one step {one_step_mean_err}')
+                writer.add_scalar('MAE/val', one_step_mean_err, epoch)
+
+                vutils.save_image(start_real_cpu,
+                        '%s/real_samples.png' % outf,
+                        normalize=True)
+                fake = netG(stop_real_cpu, fixed_noise).detach()
+                vutils.save_image(fake,
+                        '%s/fake_samples_epoch_%03d.png' % (outf, epoch),
+                        normalize=True)
+
+                grid = vutils.make_grid(start_real_cpu)
+                writer.add_image('real', grid, epoch)
+                grid = vutils.make_grid(fake)
+                writer.add_image('fake', grid, epoch)
+
+                # do checkpointing
+                torch.save(netG.state_dict(), '%s/netG_epoch_%d.pth' % (outf, epoch))
+                torch.save(netF.state_dict(), '%s/netF_epoch_%d.pth' % (outf, epoch))
+                epoch += 1
+                samples_in_epoch = 0
+
+            if epoch - start_iter >= niter:
+                break
+            if dry_run:
+                break
+
+        return one_step_mean_err
+    finally:
+        if ring is not None:
+            # Nothing should touch the shared batches past this point - stop the generator still holding them.
+            if dataloader is not None:
+                dataloader.close()
+            print(f'Data ring: {ring.stats()}')
+            ring.close()
 
 
 if __name__ == "__main__":
@@ -535,6 +561,8 @@ if __name__ == "__main__":
     parser.add_argument('--manualSeed', type=int, help='manual seed')
 
     parser.add_argument('--improve_fwd', action='store_true')
+    parser.add_argument('--shm_producers', type=int, default=0, help='number of data generator processes writing batches to shared memory (instead of DataLoader workers)')
+    parser.add_argument('--augment', type=int, default=None, help='number of random torus symmetries per simulated board')
 
     opt = parser.parse_args()
     print(opt)
@@ -571,4 +599,6 @@ if __name__ == "__main__":
         beta1=opt.beta1,
         dry_run=opt.dry_run,
         device=device,
-        learn_forward=opt.improve_fwd)
\ No newline at end of file
+        learn_forward=opt.improve_fwd,
+        augment=opt.augment,
+        shm_producers=opt.shm_producers)
\ No newline at end of file
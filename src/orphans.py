@@ -0,0 +1,364 @@
+import collections
+import os
+import numpy as np
+
+from tile_graph import DFS, BeliefProp, Propagator, SearchState, get_tile_graph, tile_codes
+
+# Verified orphan patterns shipped with the repo (see build_orphans), the index of get_orphan_index.
+DEFAULT_ORPHANS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'best', 'orphans.npz')
+
+
+def window_has_predecessor(W, care=None, tile_graph=None, max_nodes=100000):
+    """
+    Exact check of a pattern in the infinite plane: is there any previous patch evolving into the cells of W, whatever
+    the cells around it are? The window is put on a torus with a free ring of pixels around it (every tile allowed),
+    which is big enough for any previous patch of the window, and the torus is searched with DFS.
+    :param W: final window (boolean matrix)
+    :param care: optional boolean matrix of the cells of W that are part of the pattern - the others are free too
+    :param max_nodes: node limit of the DFS, TimeoutError is raised once it's reached
+    :return: True if W has a predecessor, False if it's an orphan pattern
+    """
+    G = tile_graph if tile_graph is not None else get_tile_graph()
+    W = np.asarray(W, dtype=np.bool_)
+    care = np.ones(W.shape, dtype=np.bool_) if care is None else np.asarray(care, dtype=np.bool_)
+    h, w = W.shape
+
+    F = np.zeros((h + 2, w + 2), dtype=np.bool_)
+    F[1:-1, 1:-1] = W
+    D = np.full(F.shape + (8,), ~np.uint64(0))
+    D[1:-1, 1:-1][care] = G.prev_masks[W[care].astype(np.int64)]
+    P = Propagator(G, D)
+    P.push_all()
+    if not P.propagate():
+        return False
+    return bool(DFS(G, max_nodes=max_nodes).dfs(F, SearchState(G, D)))
+
+
+# _TILE_NEXT[code] - next state of the center of a 3x3 tile (bit 3r + c is the cell in row r, column c).
+_tile_cells = (np.arange(512)[:, None] >> np.arange(9)) & 1
+_tile_nbrs = _tile_cells.sum(axis=1) - _tile_cells[:, 4]
+_TILE_NEXT = ((_tile_nbrs == 3) | ((_tile_cells[:, 4] == 1) & (_tile_nbrs == 2))).astype(np.int64)
+
+
+def _strip_step(S, w, chunk=2048):
+    """
+    :param S: sorted pairs (a << w + 2 | b) of consecutive previous rows of a strip of width w (with a free column on
+        both sides)
+    :return: dict: final row r -> sorted pairs (b, c) such that (a, b) is in S and (a, b, c) evolves into r
+    """
+    if len(S) > chunk:
+        parts = [_strip_step(S[k:k + chunk], w, chunk) for k in range(0, len(S), chunk)]
+        return {r: np.unique(np.concatenate([part[r] for part in parts])) for r in range(1 << w)}
+
+    W = w + 2
+    a, b = S[:, None] >> W, S[:, None] & ((1 << W) - 1)
+    c = np.arange(1 << W)[None]
+    f = np.zeros((len(S), 1 << W), dtype=np.int64)
+    for j in range(w):
+        f |= _TILE_NEXT[(a >> j) & 7 | ((b >> j) & 7) << 3 | ((c >> j) & 7) << 6] << j
+    keys = np.unique((f << (2 * W) | b << W | c).ravel())
+    bounds = np.searchsorted(keys >> (2 * W), np.arange((1 << w) + 1))
+    return {r: keys[bounds[r]:bounds[r + 1]] & ((1 << (2 * W)) - 1) for r in range(1 << w)}
+
+
+def strip_orphan(w, beam=64, max_rows=40, rseed=0):
+    """
+    Looks for an orphan pattern w cells wide row by row (as the first Gardens of Eden were found): the previous cells
+    of a strip are tracked as the set of pairs of consecutive previous rows (2 cells wider than the strip) that some
+    previous patch can end with, and every final row added keeps only the pairs that continue into it. The pattern is
+    an orphan once the set is empty. Beam search over the final rows, the ones leaving the fewest pairs first.
+    :param beam: number of partial patterns kept after every row
+    :param max_rows: max height of the pattern
+    :return: the orphan pattern (boolean matrix max_rows x w at most), None if it wasn't found
+    """
+    rs = np.random.RandomState(rseed)
+    states = [(np.arange(1 << (2 * (w + 2)), dtype=np.int64), [])]
+    for _ in range(max_rows):
+        candidates = []
+        for S, rows in states:
+            for r, T in _strip_step(S, w).items():
+                # Random tie breaks, so that the beam isn't filled with equivalent rows.
+                candidates.append((len(T) + rs.rand(), T, rows + [r]))
+        candidates.sort(key=lambda candidate: candidate[0])
+        if len(candidates[0][1]) == 0:
+            return ((np.array(candidates[0][2])[:, None] >> np.arange(w)) & 1).astype(np.bool_)
+
+        seen = set()
+        states = []
+        for _, T, rows in candidates:
+            if T.tobytes() not in seen:
+                seen.add(T.tobytes())
+                states.append((T, rows))
+                if len(states) == beam:
+                    break
+    return None
+
+
+def _symmetric_copies(W, care):
+    """
+    :return: list of (W, care) under the 8 symmetries of the plane, without duplicates
+    """
+    copies = {}
+    for k in range(4):
+        for flip in (False, True):
+            V, C = np.rot90(W, k), np.rot90(care, k)
+            if flip:
+                V, C = V.T, C.T
+            V = np.where(C, V, False)
+            copies.setdefault((V.shape, V.tobytes(), C.tobytes()), (V, C))
+    return list(copies.values())
+
+
+class OrphanIndex:
+    """
+    Index of orphan patterns (cells with no predecessor at all, whatever is around them) with a vectorized scan - a
+    board containing one of them anywhere (torus wrap included, in any orientation) has no predecessor either, so it
+    can go straight to approximate methods instead of an exact search that would have to exhaust the whole space.
+
+    Every pattern is stored in all its orientations and compiled to 3x3 blocks: the scan looks the tile codes of the
+    boards up in a 512-entry table per block, so a batch of boards costs a few table lookups per block of every
+    pattern.
+
+    Patterns are mined from boards known to have no predecessor (see mine) and verified with window_has_predecessor,
+    so the index is sound - it only ever flags orphans.
+    """
+    def __init__(self, tile_graph=None):
+        self.G = tile_graph if tile_graph is not None else get_tile_graph()
+        self.patterns = []
+        # Compiled patterns: list of (pattern number, shape, [(row offset, column offset, 512 boolean table)]).
+        self.blocks = []
+        self.keys = set()
+        self.index_stats = {'boards': 0, 'flagged': 0, 'hits': collections.Counter()}
+
+    def add(self, W, care=None):
+        """
+        Adds a pattern (in all its orientations) without verifying it.
+        :param W: pattern cells (boolean matrix)
+        :param care: optional boolean matrix of the cells of W that are part of the pattern
+        :return: False if the pattern was in the index already
+        """
+        W = np.asarray(W, dtype=np.bool_)
+        care = np.ones(W.shape, dtype=np.bool_) if care is None else np.asarray(care, dtype=np.bool_)
+        copies = _symmetric_copies(W, care)
+        if any((V.shape, V.tobytes(), C.tobytes()) in self.keys for V, C in copies):
+            return False
+
+        number = len(self.patterns)
+        self.patterns.append((W, care))
+        codes = np.arange(512)
+        for V, C in copies:
+            self.keys.add((V.shape, V.tobytes(), C.tobytes()))
+            # A tile code covers the 3x3 cells around its pixel - blocks are centered at every third row and column.
+            h, w = V.shape
+            Vp = np.pad(V, ((1, 2), (1, 2)))
+            Cp = np.pad(C, ((1, 2), (1, 2)))
+            blocks = []
+            for i in range(2, h + 2, 3):
+                for j in range(2, w + 2, 3):
+                    bits = 1 << np.arange(9).reshape(3, 3)
+                    care_bits = int((bits * Cp[i - 1:i + 2, j - 1:j + 2]).sum())
+                    value_bits = int((bits * Vp[i - 1:i + 2, j - 1:j + 2]).sum())
+                    if care_bits:
+                        blocks.append((i - 1, j - 1, (codes & care_bits) == value_bits))
+            self.blocks.append((number, V.shape, blocks))
+        return True
+
+    def scan(self, Fs):
+        """
+        Patterns are only looked for on boards at least 2 cells longer in both directions - the previous cells around a
+        pattern on a smaller torus would wrap around onto each other.
+        :param Fs: final bitmaps - array of shape (boards, m, n)
+        :return: boolean array (boards,) - True for the boards containing some pattern of the index
+        """
+        Fs = np.asarray(Fs, dtype=np.bool_)
+        codes = tile_codes(Fs)
+        rolled = {}
+        flagged = np.zeros(len(Fs), dtype=np.bool_)
+        for number, (h, w), blocks in self.blocks:
+            if h + 2 > Fs.shape[-2] or w + 2 > Fs.shape[-1]:
+                continue
+            match = np.ones(Fs.shape, dtype=np.bool_)
+            for di, dj, table in blocks:
+                if (di, dj) not in rolled:
+                    rolled[di, dj] = np.roll(codes, (-di, -dj), axis=(-2, -1))
+                match &= table[rolled[di, dj]]
+                if not match.any():
+                    break
+            hits = match.any(axis=(-2, -1))
+            self.index_stats['hits'][number] += int(hits.sum())
+            flagged |= hits
+
+        self.index_stats['boards'] += len(Fs)
+        self.index_stats['flagged'] += int(flagged.sum())
+        return flagged
+
+    def contains(self, F):
+        """
+        :return: True if the final bitmap F contains some pattern of the index
+        """
+        return bool(self.scan(np.asarray(F)[None])[0])
+
+    def mine(self, F, sizes=(6, 8, 10), stride=3, max_nodes=20000):
+        """
+        Looks for orphan windows of a board known to have no predecessor, shrinks each one to a minimal set of cells
+        that is still an orphan and adds it to the index. Windows the DFS can't decide within max_nodes are skipped.
+        :param sizes: sizes of the square windows tried, the smallest first
+        :param stride: distance of the corners of the tried windows
+        :return: number of patterns added
+        """
+        F = np.asarray(F, dtype=np.bool_)
+        m, n = F.shape
+        added = 0
+        for size in sizes:
+            if size > min(m, n):
+                break
+            for i in range(0, m, stride):
+                for j in range(0, n, stride):
+                    W = np.roll(F, (-i, -j), axis=(0, 1))[:size, :size]
+                    try:
+                        if window_has_predecessor(W, tile_graph=self.G, max_nodes=max_nodes):
+                            continue
+                    except TimeoutError:
+                        continue
+                    added += self.add(*self._shrink(W, max_nodes))
+            if added:
+                break
+        return added
+
+    def _shrink(self, W, max_nodes):
+        # Greedily drops the cells the pattern stays an orphan without, then crops it to the cells left.
+        care = np.ones(W.shape, dtype=np.bool_)
+        for i, j in zip(*np.nonzero(care)):
+            care[i, j] = False
+            try:
+                if window_has_predecessor(W, care, self.G, max_nodes):
+                    care[i, j] = True
+            except TimeoutError:
+                care[i, j] = True
+        rows = np.flatnonzero(care.any(axis=1))
+        cols = np.flatnonzero(care.any(axis=0))
+        crop = np.ix_(np.arange(rows[0], rows[-1] + 1), np.arange(cols[0], cols[-1] + 1))
+        return W[crop], care[crop]
+
+    def save(self, path):
+        arrays = {}
+        for k, (W, care) in enumerate(self.patterns):
+            arrays[f'pattern_{k}'] = W
+            arrays[f'care_{k}'] = care
+        np.savez(path, **arrays)
+
+    def load(self, path):
+        with np.load(path) as data:
+            for k in range(sum(name.startswith('pattern_') for name in data.files)):
+                self.add(data[f'pattern_{k}'], data[f'care_{k}'])
+
+
+_orphan_index = None
+
+
+def get_orphan_index():
+    """
+    Lazily created process-wide OrphanIndex with the patterns of DEFAULT_ORPHANS (empty if the file is missing).
+    """
+    global _orphan_index
+    if _orphan_index is None:
+        _orphan_index = OrphanIndex()
+        if os.path.exists(DEFAULT_ORPHANS):
+            _orphan_index.load(DEFAULT_ORPHANS)
+    return _orphan_index
+
+
+class OrphanRouter:
+    """
+    Dispatch layer of the batch jobs: a batch of boards is scanned at once and the boards containing an orphan pattern
+    go straight to an approximate method, the rest to the exact solver - which would otherwise spend its whole budget
+    on proving there's no predecessor. The solvers themselves don't look for orphans unless they're given an index.
+    """
+    def __init__(self, solver, fallback=None, index=None):
+        """
+        :param solver: method for the boards without any pattern, with step_back(F) (e.g. DFS with a time_budget)
+        :param fallback: approximate method for the flagged boards, with step_back_batch(Fs) (BeliefProp by default)
+            or just step_back(F) (e.g. LocalSearch)
+        :param index: OrphanIndex (get_orphan_index() by default)
+        """
+        self.solver = solver
+        self.fallback = fallback if fallback is not None else BeliefProp()
+        self.index = index if index is not None else get_orphan_index()
+        self.router_stats = {'boards': 0, 'routed': 0}
+
+    def step_back_batch(self, Fs):
+        """
+        :param Fs: final bitmaps - array of shape (boards, m, n)
+        :return: previous bitmaps (boolean array of the same shape as Fs)
+        """
+        Fs = np.asarray(Fs, dtype=np.bool_)
+        flagged = self.index.scan(Fs)
+        self.router_stats['boards'] += len(Fs)
+        self.router_stats['routed'] += int(flagged.sum())
+
+        A = np.zeros(Fs.shape, dtype=np.bool_)
+        if flagged.any():
+            if hasattr(self.fallback, 'step_back_batch'):
+                A[flagged] = self.fallback.step_back_batch(Fs[flagged])
+            else:
+                A[flagged] = [self.fallback.step_back(F) for F in Fs[flagged]]
+        for k in np.flatnonzero(~flagged):
+            A[k] = self.solver.step_back(Fs[k])
+        return A
+
+    def step_back(self, F):
+        return self.step_back_batch(np.asarray(F)[None])[0]
+
+    def predict(self, delta, stop):
+        """
+        :return: start bitmap, stepping back one generation at a time - the boards in between are routed too
+        """
+        X = np.asarray(stop, dtype=np.bool_)
+        for _ in range(delta):
+            X = self.step_back(X)
+        return X
+
+
+def build_orphans(path=DEFAULT_ORPHANS, widths=(7, 6), max_nodes=10 ** 7):
+    """
+    Builds the shipped index: an orphan strip of every width (see strip_orphan), each verified with
+    window_has_predecessor before it's added. Takes a few minutes.
+    :return: the index
+    """
+    index = OrphanIndex()
+    for w in widths:
+        W = strip_orphan(w)
+        if W is not None and not window_has_predecessor(W, tile_graph=index.G, max_nodes=max_nodes):
+            index.add(W)
+    index.save(path)
+    return index
+
+
+if __name__ == '__main__':
+    from bitmap import generate_inf_cases
+
+    # How often the index fires on the test distribution: stop boards always have a predecessor, the boards that
+    # don't show up one step further back - predecessors found by DFS, as in multi-step search.
+    index = OrphanIndex()
+    index.load(DEFAULT_ORPHANS)
+    counts = collections.Counter()
+    gen = generate_inf_cases(False, 7, board_size=12, dtype=np.int64)
+    for _ in range(30):
+        delta, stop = next(gen)
+        counts['stop_flagged'] += index.contains(stop)
+        try:
+            A = DFS(max_nodes=20000).step_back(stop)
+        except Exception:
+            continue
+        counts['predecessors'] += 1
+        try:
+            DFS(max_nodes=20000).step_back(A)
+            continue
+        except TimeoutError:
+            continue
+        except Exception:
+            counts['orphan_predecessors'] += 1
+        counts['mined'] += index.mine(A)
+        counts['orphans_flagged'] += index.contains(A)
+        print(dict(counts), flush=True)
+    print(f'Index: {len(index.patterns)} patterns, {index.index_stats}')
@@ -0,0 +1,174 @@
+import collections
+import functools
+import multiprocessing as mp
+import queue
+import time
+import numpy as np
+
+from simulator import life_step
+from scoring import score
+from tile_graph import DFS, BlockGraph, DynamicProg, anytime_stats, get_tile_graph, majority_board
+from sat import SatSolver
+
+
+class RandomValueOrder:
+    """
+    Picklable DFS value order trying the candidate tiles of every pixel in a random order.
+    """
+    def __init__(self, rseed):
+        self.rs = np.random.RandomState(rseed)
+
+    def __call__(self, F, i, j, tiles):
+        return self.rs.permutation(tiles)
+
+
+def block_dfs(**kwargs):
+    # The block tables are loaded in the worker process instead of being sent to it.
+    return DFS(BlockGraph(), **kwargs)
+
+
+def default_configs(size=8):
+    """
+    :return: list of (name, factory) - factory() creates a solver with step_back(F); the first configurations are the
+        plain solvers, the rest are DFS with random value orders
+    """
+    configs = [
+        ('dfs', DFS),
+        ('dfs-blocks', block_dfs),
+        ('sat', functools.partial(SatSolver, seed=0)),
+        ('dynamic-prog', DynamicProg),
+    ]
+    for k in range(len(configs), size):
+        configs.append((f'dfs-random-{k}', functools.partial(DFS, value_order=RandomValueOrder(k))))
+    return configs[:size]
+
+
+def _portfolio_worker(k, factory, F, results):
+    try:
+        A = factory().step_back(F)
+        results.put((k, np.asarray(A), None))
+    except Exception as e:
+        results.put((k, None, repr(e)))
+
+
+class Portfolio:
+    """
+    Runs several solver configurations on the same board in parallel processes - the first one returning a valid
+    predecessor wins and the others are terminated. The running time of a single configuration varies by orders of
+    magnitude from board to board, so the portfolio is about as fast as the luckiest configuration on every board.
+    """
+    def __init__(self, configs=None, num_workers=None, time_budget=None):
+        """
+        :param configs: list of (name, factory) with picklable factories, see default_configs
+        :param num_workers: max number of configurations running at once (by default the number of CPUs), the
+            remaining ones are started as the running ones fail
+        :param time_budget: optional limit in seconds per step back
+        """
+        self.configs = configs if configs is not None else default_configs()
+        self.num_workers = num_workers or mp.cpu_count()
+        self.time_budget = time_budget
+        self.wins = collections.Counter()
+        self.search_stats = {}
+
+    def step_back(self, F, verbose=False, deadline=None, callback=None):
+        """
+        :param F: final bitmap (boolean matrix)
+        :param deadline: optional time.perf_counter() value - with a deadline (or time_budget) running out of time or
+            having all the configurations fail doesn't raise, the most accurate board returned by any of them (or the
+            majority center bit of the arc consistent tiles if that's better) is returned instead
+        :param callback: optional function called with search_stats at the end
+        :return: previous bitmap (int matrix of the same shape as F)
+        """
+        F = np.asarray(F, dtype=np.bool_)
+        tic = time.perf_counter()
+        if self.time_budget is not None:
+            deadline = min(deadline, tic + self.time_budget) if deadline is not None else tic + self.time_budget
+        results = mp.Queue()
+        pending = collections.deque(range(len(self.configs)))
+        running = {}
+        failed = []
+        winner = None
+        # (accuracy, board) of the best inexact board returned by a heuristic configuration.
+        best = None
+
+        try:
+            while winner is None and (pending or running):
+                while pending and len(running) < self.num_workers:
+                    k = pending.popleft()
+                    p = mp.Process(target=_portfolio_worker, args=(k, self.configs[k][1], F, results), daemon=True)
+                    p.start()
+                    running[k] = p
+
+                if deadline is not None and time.perf_counter() > deadline:
+                    break
+                try:
+                    k, A, error = results.get(timeout=0.1)
+                except queue.Empty:
+                    # A worker that died without reporting (e.g. killed for running out of memory) just failed.
+                    for k, p in list(running.items()):
+                        if p.exitcode not in (None, 0):
+                            failed.append(self.configs[k][0])
+                            del running[k]
+                    continue
+
+                running.pop(k).join()
+                # Heuristic solvers may return a board that doesn't evolve into F - that's no solution either.
+                if A is not None and (life_step(A) == F).all():
+                    winner = k
+                else:
+                    if A is not None and (best is None or score(1, A, F) > best[0]):
+                        best = (score(1, A, F), A)
+                    failed.append(self.configs[k][0])
+                    if verbose:
+                        print(f'{self.configs[k][0]} failed: {error}')
+        finally:
+            for p in running.values():
+                p.terminate()
+            for p in running.values():
+                p.join()
+            results.close()
+
+        self.search_stats = {
+            'winner': self.configs[winner][0] if winner is not None else None,
+            'seconds': time.perf_counter() - tic,
+            'failed': failed,
+            'cancelled': len(running) if winner is not None or deadline is not None else 0,
+        }
+        if winner is None:
+            if deadline is None:
+                if verbose:
+                    print(f'Portfolio: {self.search_stats}')
+                raise Exception('No previous state found.')
+            A = majority_board(get_tile_graph(), F)
+            if best is not None and best[0] > score(1, A, F):
+                A = best[1]
+        else:
+            self.wins[self.configs[winner][0]] += 1
+        A = A.astype(int)
+        anytime_stats(self.search_stats, A, F, winner is not None, tic, callback)
+        if verbose:
+            print(f'Portfolio: {self.search_stats}')
+        return A
+
+    def predict(self, delta, stop, verbose=False):
+        """
+        :return: start bitmap that evolves into stop in delta steps (stepping back one generation at a time)
+        """
+        A = np.asarray(stop)
+        for _ in range(delta):
+            A = self.step_back(A, verbose=verbose)
+        return A
+
+
+if __name__ == '__main__':
+    from sat import benchmark_boards
+
+    portfolio = Portfolio(time_budget=300)
+    for F in benchmark_boards():
+        try:
+            portfolio.step_back(F)
+        except Exception as e:
+            print(f'{F.shape[0]}x{F.shape[1]}: {e}')
+            continue
+        print(f'{F.shape[0]}x{F.shape[1]}: {portfolio.search_stats["winner"]} {portfolio.search_stats["seconds"]:0.2f}s')
+    print(f'Wins: {dict(portfolio.wins)}')
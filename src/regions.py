@@ -0,0 +1,222 @@
+import collections
+import multiprocessing as mp
+import numpy as np
+
+from simulator import life_step
+from tile_graph import DFS
+
+
+def _empty_runs(empty):
+    """
+    :param empty: boolean vector of empty lines of a torus
+    :return: list of (start, length) of the maximal runs of empty lines, a run may wrap around the end
+    """
+    h = len(empty)
+    if empty.all() or not empty.any():
+        return []
+    # Start from a non-empty line, so no run is cut in two by the wrap.
+    offset = int(np.argmin(empty))
+    runs = []
+    k = 0
+    while k < h:
+        if empty[(offset + k) % h]:
+            start = k
+            while k < h and empty[(offset + k) % h]:
+                k += 1
+            runs.append(((offset + start) % h, k - start))
+        else:
+            k += 1
+    return runs
+
+
+def _split(F, dead, rows, cols, axis):
+    """
+    Splits a piece along the bands of at least 2 empty lines of the given axis.
+    :return: list of pieces, or None if there's no such band making the piece smaller
+    """
+    if axis == 1:
+        pieces = _split(F.T, dead.T, cols, rows, 0)
+        return [(G.T, d.T, c, r) for G, d, r, c in pieces] if pieces is not None else None
+
+    h = F.shape[0]
+    runs = [(start, length) for start, length in _empty_runs(~F.any(axis=1)) if length >= 2]
+    # Two lines of every band are the margins of the pieces next to it, the previous cells there are forced dead. The
+    # previous cells of a cluster often stick out by a line, so on wider bands the margins leave one empty line free.
+    cuts = []
+    for start, length in runs:
+        free = 1 if length >= 4 else 0
+        cuts.append(((start + free) % h, (start + length - 1 - free) % h))
+    if not cuts or len(cuts) == 1 and (cuts[0][0] - cuts[0][1]) % h + 1 >= h:
+        # A single band only makes the piece smaller by removing the lines between its margins.
+        return None
+
+    pieces = []
+    for (_, first), (last, _) in zip(cuts, cuts[1:] + cuts[:1]):
+        lines = (first + np.arange((last - first) % h + 1)) % h
+        sub_dead = dead[lines].copy()
+        sub_dead[[0, -1]] = True
+        pieces.append((F[lines], sub_dead, rows[lines], cols))
+    return pieces
+
+
+def decompose(F):
+    """
+    Splits a final bitmap into independent pieces, recursively along bands of at least 2 empty rows or columns (wrap
+    included). A piece is the part between two bands plus a margin line in each band. With the previous cells on two
+    neighbouring margins dead, the final cells there only depend on the piece next to them, so the pieces are tori of
+    their own and predecessors of the pieces put together give a predecessor of the whole board.
+    :return: list of (F_piece, dead, rows, cols) - final bitmap of the piece, previous cells forced dead, and indices of
+        its rows and columns on the board
+    """
+    F = np.asarray(F, dtype=np.bool_)
+    todo = [(F, np.zeros(F.shape, dtype=np.bool_), np.arange(F.shape[0]), np.arange(F.shape[1]))]
+    pieces = []
+    while todo:
+        piece = todo.pop()
+        for axis in (0, 1):
+            split = _split(*piece, axis)
+            if split is not None:
+                todo.extend(split)
+                break
+        else:
+            pieces.append(piece)
+    return pieces
+
+
+# Symmetries of a torus piece as pairs (transform, inverse) of the last two axes - the first 4 keep its shape, the others
+# swap the axes.
+_SYMMETRIES = [
+    (lambda X: X, lambda X: X),
+    (lambda X: X[..., ::-1, :], lambda X: X[..., ::-1, :]),
+    (lambda X: X[..., :, ::-1], lambda X: X[..., :, ::-1]),
+    (lambda X: X[..., ::-1, ::-1], lambda X: X[..., ::-1, ::-1]),
+
+    (lambda X: np.swapaxes(X, -1, -2), lambda X: np.swapaxes(X, -1, -2)),
+    (lambda X: np.swapaxes(X, -1, -2)[..., ::-1, ::-1], lambda X: np.swapaxes(X[..., ::-1, ::-1], -1, -2)),
+    (lambda X: np.rot90(X, 1, axes=(-2, -1)), lambda X: np.rot90(X, -1, axes=(-2, -1))),
+    (lambda X: np.rot90(X, -1, axes=(-2, -1)), lambda X: np.rot90(X, 1, axes=(-2, -1))),
+]
+
+
+def _symmetries(shape):
+    """
+    :return: symmetries taking a piece of the given shape to the pieces of shape (min(shape), max(shape))
+    """
+    h, w = shape
+    return _SYMMETRIES if h == w else _SYMMETRIES[:4] if h < w else _SYMMETRIES[4:]
+
+
+def region_key(F, dead):
+    """
+    Canonical form of a piece under the symmetries of its torus (translations, flips and rotations - a piece and its
+    transpose have the same canonical form): the smallest byte string over all of them.
+    :return: (key, symmetry, shift) - the piece is transformed to the canonical one by symmetry and then rolled by shift
+    """
+    X = np.stack([F, dead]).astype(np.uint8)
+    h, w = min(F.shape), max(F.shape)
+    best = None
+    for k, (transform, _) in enumerate(_symmetries(F.shape)):
+        V = transform(X)
+        for di in range(h):
+            R = np.roll(V, di, axis=1)
+            for dj in range(w):
+                key = np.roll(R, dj, axis=2).tobytes()
+                if best is None or key < best[0]:
+                    best = (key, k, (di, dj))
+    key, k, shift = best
+    return ((h, w), key), k, shift
+
+
+def _solve_piece(factory, F, dead):
+    try:
+        return factory().step_back(F, dead=dead).astype(np.bool_)
+    except Exception:
+        return None
+
+
+class RegionSolver:
+    """
+    Steps back boards made of isolated clusters piece by piece (see decompose) - the cost of the exact search is then
+    exponential in the size of the largest piece instead of the whole board. Pieces are solved in parallel and their
+    predecessors are cached by the canonical form of the piece, so clusters that keep coming back (blinkers, blocks,
+    gliders in any position and orientation) are solved once.
+
+    If a piece has no predecessor with the dead margins, the whole board is solved the usual way instead.
+    """
+    def __init__(self, factory=DFS, num_workers=1, cache_size=10000):
+        """
+        :param factory: picklable function creating the solver of the pieces - its step_back has to take the dead
+            argument of DFS.step_back
+        :param num_workers: number of processes solving the pieces (1 - solved in this process)
+        :param cache_size: max number of cached pieces (least recently used ones are dropped)
+        """
+        self.factory = factory
+        self.num_workers = num_workers
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.region_stats = {'boards': 0, 'pieces': 0, 'cache_hits': 0, 'fallbacks': 0}
+
+    def _cached(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.region_stats['cache_hits'] += 1
+            return True
+        return False
+
+    def _store(self, key, value):
+        self.cache[key] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def step_back(self, F, verbose=False):
+        """
+        :param F: final bitmap (boolean matrix)
+        :return: previous bitmap (int matrix of the same shape as F)
+        """
+        F = np.asarray(F, dtype=np.bool_)
+        self.region_stats['boards'] += 1
+        pieces = decompose(F)
+        self.region_stats['pieces'] += len(pieces)
+
+        # Canonical pieces not in the cache yet, each solved once even if it's on the board several times.
+        keys = [region_key(G, dead) for G, dead, _, _ in pieces]
+        todo = {}
+        for (G, dead, _, _), (key, k, shift) in zip(pieces, keys):
+            if key in todo:
+                self.region_stats['cache_hits'] += 1
+            elif not self._cached(key):
+                todo[key] = tuple(np.roll(_symmetries(G.shape)[k][0](X), shift, axis=(0, 1)) for X in (G, dead))
+
+        args = [(self.factory,) + piece for piece in todo.values()]
+        if self.num_workers > 1 and len(args) > 1:
+            with mp.Pool(min(self.num_workers, len(args))) as pool:
+                solved = pool.starmap(_solve_piece, args)
+        else:
+            solved = [_solve_piece(*a) for a in args]
+        for key, A in zip(todo, solved):
+            self._store(key, A)
+
+        A = np.zeros(F.shape, dtype=np.bool_)
+        for (G, dead, rows, cols), (key, k, shift) in zip(pieces, keys):
+            P = self.cache.get(key)
+            if P is None:
+                break
+            P = _symmetries(G.shape)[k][1](np.roll(P, (-shift[0], -shift[1]), axis=(0, 1)))
+            # Margins are dead, so only the inner cells go on the board - margins of the neighbouring pieces overlap.
+            A[np.ix_(rows, cols)] |= P
+        else:
+            if (life_step(A) == F).all():
+                if verbose:
+                    print(f'Regions: {self.region_stats}')
+                return A.astype(int)
+
+        self.region_stats['fallbacks'] += 1
+        if verbose:
+            print(f'Regions: {self.region_stats} - solving the whole board')
+        return self.factory().step_back(F)
+
+    def predict(self, delta, stop):
+        A = np.asarray(stop)
+        for _ in range(delta):
+            A = self.step_back(A)
+        return A
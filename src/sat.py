@@ -0,0 +1,541 @@
+import heapq
+import time
+import numpy as np
+from simulator import life_step
+from tile_graph import anytime_stats, get_tile_graph, majority_board
+
+
+class CNF:
+    """
+    CNF formula under construction. Literals are DIMACS style: variable v (counted from 1) is v, its negation -v.
+    Clauses may also contain the constants True / False, which are simplified away when the clause is added.
+    """
+    def __init__(self, num_vars=0):
+        self.num_vars = num_vars
+        self.clauses = []
+
+    def new_var(self):
+        self.num_vars += 1
+        return self.num_vars
+
+    def add(self, clause):
+        if any(lit is True for lit in clause):
+            return
+        self.clauses.append([lit for lit in clause if lit is not False])
+
+
+def _neg(lit):
+    return (not lit) if isinstance(lit, bool) else -lit
+
+
+def _add_counter(cnf, inputs, bound):
+    """
+    Sequential counter with both directions encoded: counts[k - 1] is true iff at least k of the inputs are true,
+    for k = 1..bound.
+    """
+    # prefix[k] - at least k of the inputs seen so far (prefix[0] is always true).
+    prefix = [True] + [False] * bound
+    for x in inputs:
+        current = [True]
+        for k in range(1, bound + 1):
+            if prefix[k] is True or (prefix[k - 1] is False):
+                current.append(prefix[k])
+                continue
+            s = cnf.new_var()
+            # s <-> prefix[k] | (prefix[k - 1] & x)
+            cnf.add([_neg(prefix[k]), s])
+            cnf.add([_neg(prefix[k - 1]), -x, s])
+            cnf.add([-s, prefix[k], prefix[k - 1]])
+            cnf.add([-s, prefix[k], x])
+            current.append(s)
+        prefix = current
+    return prefix[1:]
+
+
+def encode_step_back(stop, delta=1):
+    """
+    Encodes "boards X_0, ..., X_delta with X_delta == stop, each one a Life step of the previous" as CNF.
+    Cell (i, j) of X_g is variable g * m * n + i * n + j + 1, so the start board takes the first m * n variables.
+    Neighbour counts go through auxiliary sequential-counter variables (at least 2, 3 and 4 alive neighbours).
+    :param stop: final bitmap (boolean matrix m x n)
+    :param delta: number of generations to unroll
+    :return: CNF
+    """
+    stop = np.asarray(stop, dtype=np.bool_)
+    m, n = stop.shape
+    cnf = CNF(num_vars=(delta + 1) * m * n)
+
+    def cell(g, i, j):
+        return g * m * n + (i % m) * n + (j % n) + 1
+
+    for g in range(delta):
+        for i in range(m):
+            for j in range(n):
+                x = cell(g, i, j)
+                y = cell(g + 1, i, j)
+                neighbours = [cell(g, i + di, j + dj) for di in (-1, 0, 1) for dj in (-1, 0, 1) if di or dj]
+                _, at_least_2, at_least_3, at_least_4 = _add_counter(cnf, neighbours, 4)
+
+                # y <-> (count == 3) | (x & count == 2)
+                cnf.add([-y, -at_least_4])
+                cnf.add([-y, at_least_2])
+                cnf.add([-y, at_least_3, x])
+                cnf.add([-at_least_3, at_least_4, y])
+                cnf.add([-x, -at_least_2, at_least_4, y])
+
+    for i in range(m):
+        for j in range(n):
+            y = cell(delta, i, j)
+            cnf.add([y if stop[i, j] else -y])
+    return cnf
+
+
+def decode_board(model, shape, generation=0):
+    """
+    :param model: list of booleans indexed by variable (index 0 unused), e.g. from CDCLSolver.solve
+    :return: boolean matrix of the given shape with the cells of the given generation
+    """
+    m, n = shape
+    offset = generation * m * n + 1
+    return np.array(model[offset:offset + m * n], dtype=np.bool_).reshape(m, n)
+
+
+def write_dimacs(f, cnf, comments=()):
+    """
+    :param f: path or text file object
+    :param cnf: CNF
+    :param comments: lines written as 'c ...' before the header
+    """
+    if isinstance(f, str):
+        with open(f, 'w') as outfile:
+            return write_dimacs(outfile, cnf, comments)
+
+    for line in comments:
+        f.write(f'c {line}\n')
+    f.write(f'p cnf {cnf.num_vars} {len(cnf.clauses)}\n')
+    for clause in cnf.clauses:
+        f.write(' '.join(map(str, clause)) + ' 0\n')
+
+
+def read_dimacs(f):
+    """
+    :param f: path or text file object
+    :return: CNF
+    """
+    if isinstance(f, str):
+        with open(f) as infile:
+            return read_dimacs(infile)
+
+    cnf = CNF()
+    literals = []
+    for line in f:
+        line = line.strip()
+        if not line or line[0] in 'c%':
+            continue
+        if line[0] == 'p':
+            cnf.num_vars = int(line.split()[2])
+            continue
+        for lit in map(int, line.split()):
+            if lit == 0:
+                cnf.add(literals)
+                literals = []
+            else:
+                literals.append(lit)
+    return cnf
+
+
+def luby(i):
+    """
+    :return: i-th element (counted from 1) of the Luby sequence 1, 1, 2, 1, 1, 2, 4, ...
+    """
+    k = 1
+    while (1 << k) - 1 < i:
+        k += 1
+    while i != (1 << k) - 1:
+        i -= (1 << (k - 1)) - 1
+        k = 1
+        while (1 << k) - 1 < i:
+            k += 1
+    return 1 << (k - 1)
+
+
+class CDCLSolver:
+    """
+    Conflict-driven clause learning SAT solver in pure Python: two watched literals per clause, first-UIP learning
+    with non-chronological backjumping, VSIDS branching with phase saving, Luby restarts and periodic clean up of
+    learnt clauses with a high LBD.
+
+    Internally literal 2 * v is variable v and 2 * v + 1 its negation (v counted from 0).
+    """
+    def __init__(self, cnf, restart_base=100, var_decay=0.95, seed=None):
+        """
+        :param cnf: CNF
+        :param seed: optional seed - randomizes the initial variable order
+        """
+        self.num_vars = cnf.num_vars
+        self.restart_base = restart_base
+        self.var_decay = var_decay
+
+        nv = self.num_vars
+        self.value = [-1] * nv
+        self.level = [0] * nv
+        self.reason = [None] * nv
+        self.phase = [0] * nv
+        self.activity = [0.0] * nv
+        if seed is not None:
+            rs = np.random.RandomState(seed)
+            self.activity = list(rs.rand(nv) * 1e-3)
+        self.var_inc = 1.0
+        self.heap = [(-a, v) for v, a in enumerate(self.activity)]
+        heapq.heapify(self.heap)
+
+        self.watches = [[] for _ in range(2 * nv)]
+        self.trail = []
+        self.trail_lim = []
+        self.qhead = 0
+        self.learnts = []
+        self.lbd = {}
+        self.unsat = False
+        self.units = []
+
+        self.stats = {'decisions': 0, 'propagations': 0, 'conflicts': 0, 'restarts': 0, 'learnt': 0, 'deleted': 0}
+
+        for clause in cnf.clauses:
+            lits = sorted({2 * (abs(lit) - 1) + (lit < 0) for lit in clause})
+            if any(lits[k] ^ 1 == lits[k + 1] for k in range(len(lits) - 1)):
+                continue  # tautology
+            if not lits:
+                self.unsat = True
+            elif len(lits) == 1:
+                self.units.append(lits[0])
+            else:
+                self._attach(lits)
+
+    def _attach(self, clause):
+        self.watches[clause[0]].append(clause)
+        self.watches[clause[1]].append(clause)
+
+    def _lit_value(self, lit):
+        v = self.value[lit >> 1]
+        return v if v < 0 else v ^ (lit & 1)
+
+    def _enqueue(self, lit, reason):
+        var = lit >> 1
+        self.value[var] = (lit & 1) ^ 1
+        self.level[var] = len(self.trail_lim)
+        self.reason[var] = reason
+        self.trail.append(lit)
+
+    def _propagate(self):
+        """
+        :return: conflicting clause or None
+        """
+        value, watches, trail = self.value, self.watches, self.trail
+        while self.qhead < len(trail):
+            false_lit = trail[self.qhead] ^ 1
+            self.qhead += 1
+            self.stats['propagations'] += 1
+
+            watching = watches[false_lit]
+            keep = []
+            conflict = None
+            for idx, clause in enumerate(watching):
+                if not clause:
+                    continue  # deleted
+                if clause[0] == false_lit:
+                    clause[0], clause[1] = clause[1], false_lit
+                first = clause[0]
+                v = value[first >> 1]
+                if v >= 0 and v ^ (first & 1):
+                    keep.append(clause)
+                    continue
+
+                for k in range(2, len(clause)):
+                    lit = clause[k]
+                    v = value[lit >> 1]
+                    if v < 0 or v ^ (lit & 1):
+                        clause[1], clause[k] = lit, false_lit
+                        watches[lit].append(clause)
+                        break
+                else:
+                    keep.append(clause)
+                    v = value[first >> 1]
+                    if v < 0:
+                        self._enqueue(first, clause)
+                    else:
+                        conflict = clause
+                        keep.extend(c for c in watching[idx + 1:] if c)
+                        break
+            watches[false_lit] = keep
+            if conflict is not None:
+                return conflict
+        return None
+
+    def _bump(self, var):
+        self.activity[var] += self.var_inc
+        if self.activity[var] > 1e100:
+            self.activity = [a * 1e-100 for a in self.activity]
+            self.var_inc *= 1e-100
+            self.heap = [(-a, v) for v, a in enumerate(self.activity) if self.value[v] < 0]
+            heapq.heapify(self.heap)
+        elif self.value[var] < 0:
+            heapq.heappush(self.heap, (-self.activity[var], var))
+
+    def _analyze(self, conflict):
+        """
+        First-UIP conflict analysis.
+        :return: (learnt clause with the asserting literal first, level to jump back to)
+        """
+        seen = set()
+        learnt = [None]
+        current = len(self.trail_lim)
+        pending = 0
+        lit = None
+        idx = len(self.trail) - 1
+        clause = conflict
+        while True:
+            for q in (clause if lit is None else clause[1:]):
+                var = q >> 1
+                if var in seen or self.level[var] == 0:
+                    continue
+                seen.add(var)
+                self._bump(var)
+                if self.level[var] == current:
+                    pending += 1
+                else:
+                    learnt.append(q)
+
+            while self.trail[idx] >> 1 not in seen:
+                idx -= 1
+            lit = self.trail[idx]
+            idx -= 1
+            pending -= 1
+            if pending == 0:
+                break
+            clause = self.reason[lit >> 1]
+            # Reasons keep their implied literal first.
+            if clause[0] != lit:
+                k = clause.index(lit)
+                clause[0], clause[k] = clause[k], clause[0]
+
+        learnt[0] = lit ^ 1
+        self.var_inc /= self.var_decay
+
+        # Local minimization: a literal is redundant if all the other literals of its reason are in the clause already.
+        in_clause = {q >> 1 for q in learnt}
+        learnt = [learnt[0]] + [q for q in learnt[1:] if self.reason[q >> 1] is None or any(
+            r >> 1 not in in_clause and self.level[r >> 1] > 0 for r in self.reason[q >> 1][1:])]
+
+        if len(learnt) == 1:
+            return learnt, 0
+        # The literal from the highest of the remaining levels becomes the second watch.
+        k = max(range(1, len(learnt)), key=lambda k: self.level[learnt[k] >> 1])
+        learnt[1], learnt[k] = learnt[k], learnt[1]
+        return learnt, self.level[learnt[1] >> 1]
+
+    def _cancel_until(self, level):
+        if len(self.trail_lim) <= level:
+            return
+        start = self.trail_lim[level]
+        for lit in self.trail[start:]:
+            var = lit >> 1
+            self.phase[var] = self.value[var]
+            self.value[var] = -1
+            self.reason[var] = None
+            heapq.heappush(self.heap, (-self.activity[var], var))
+        del self.trail[start:]
+        del self.trail_lim[level:]
+        self.qhead = len(self.trail)
+
+    def _pick_branch_var(self):
+        while self.heap:
+            _, var = heapq.heappop(self.heap)
+            if self.value[var] < 0:
+                return var
+        return None
+
+    def _reduce_db(self):
+        # Learnt clauses that are reasons for the current assignment have to stay.
+        locked = {id(self.reason[lit >> 1]) for lit in self.trail if self.reason[lit >> 1] is not None}
+        self.learnts.sort(key=lambda c: self.lbd[id(c)])
+        keep = len(self.learnts) // 2
+        for clause in self.learnts[keep:]:
+            if self.lbd[id(clause)] > 2 and id(clause) not in locked:
+                del self.lbd[id(clause)]
+                clause.clear()
+                self.stats['deleted'] += 1
+        self.learnts = [c for c in self.learnts if c]
+
+    def solve(self, max_conflicts=None, time_budget=None):
+        """
+        :param max_conflicts: optional limit on the number of conflicts
+        :param time_budget: optional limit in seconds
+        :return: model - list of booleans indexed by DIMACS variable (index 0 unused), False if the formula is
+            unsatisfiable, None if a limit was hit first
+        """
+        if self.unsat:
+            return False
+        deadline = time.perf_counter() + time_budget if time_budget is not None else None
+
+        for lit in self.units:
+            v = self._lit_value(lit)
+            if v == 0:
+                return False
+            if v < 0:
+                self._enqueue(lit, None)
+        if self._propagate() is not None:
+            return False
+
+        restarts = 0
+        conflicts_left = luby(1) * self.restart_base
+        reduce_at = 2000
+        while True:
+            conflict = self._propagate()
+            if conflict is not None:
+                self.stats['conflicts'] += 1
+                if not self.trail_lim:
+                    return False
+                learnt, back_level = self._analyze(conflict)
+                self._cancel_until(back_level)
+                if len(learnt) == 1:
+                    self._enqueue(learnt[0], None)
+                else:
+                    self._attach(learnt)
+                    self.learnts.append(learnt)
+                    self.lbd[id(learnt)] = len({self.level[lit >> 1] for lit in learnt})
+                    self._enqueue(learnt[0], learnt)
+                self.stats['learnt'] += 1
+
+                conflicts_left -= 1
+                if max_conflicts is not None and self.stats['conflicts'] >= max_conflicts:
+                    return None
+                if deadline is not None and time.perf_counter() > deadline:
+                    return None
+                continue
+
+            if conflicts_left <= 0:
+                restarts += 1
+                self.stats['restarts'] += 1
+                conflicts_left = luby(restarts + 1) * self.restart_base
+                self._cancel_until(0)
+            if len(self.learnts) >= reduce_at:
+                self._reduce_db()
+                reduce_at += 500
+
+            var = self._pick_branch_var()
+            if var is None:
+                return [False] + [v == 1 for v in self.value]
+            self.stats['decisions'] += 1
+            self.trail_lim.append(len(self.trail))
+            # Saved phases start at 0 - dead cells are the better guess for Life boards.
+            self._enqueue(2 * var + (0 if self.phase[var] == 1 else 1), None)
+
+
+class SatSolver:
+    """
+    Exact step back through SAT - an alternative to tile_graph.DFS with the same interface.
+    """
+    def __init__(self, time_budget=None, seed=None):
+        """
+        :param time_budget: optional limit in seconds per solve
+        :param seed: optional seed for the initial variable order of the CDCL solver
+        """
+        self.time_budget = time_budget
+        self.seed = seed
+        self.solver_stats = {}
+        self.search_stats = {}
+
+    def step_back(self, F, verbose=False, deadline=None, callback=None):
+        """
+        :param F: final bitmap (boolean matrix)
+        :param deadline: optional time.perf_counter() value - with a deadline (or time_budget) running out of time or
+            proving there's no predecessor doesn't raise, the majority center bit of the arc consistent tiles is
+            returned instead and search_stats tell it's not complete (see tile_graph.DFS.step_back)
+        :param callback: optional function called with search_stats at the end
+        :return: previous bitmap (int matrix of the same shape as F)
+        """
+        tic = time.perf_counter()
+        if self.time_budget is not None:
+            deadline = min(deadline, tic + self.time_budget) if deadline is not None else tic + self.time_budget
+        self.search_stats = {}
+        try:
+            A = self.predict(1, F, verbose=verbose, deadline=deadline)
+            complete = True
+        except Exception:
+            if deadline is None:
+                raise
+            # The CDCL assignment at that point isn't a board yet, arc consistency on F gives a better guess.
+            A = majority_board(get_tile_graph(), F)
+            complete = False
+        anytime_stats(self.search_stats, A, F, complete, tic, callback)
+        return A
+
+    def predict(self, delta, stop, verbose=False, deadline=None):
+        """
+        Solves all the delta generations at once (instead of stepping back one generation at a time), so the result
+        is guaranteed to evolve into stop if any start board does.
+        :param deadline: optional time.perf_counter() value, on top of time_budget
+        :return: start bitmap (int matrix of the same shape as stop)
+        """
+        stop = np.asarray(stop)
+        cnf = encode_step_back(stop, delta)
+        solver = CDCLSolver(cnf, seed=self.seed)
+        time_budget = self.time_budget
+        if deadline is not None:
+            left = max(0.0, deadline - time.perf_counter())
+            time_budget = min(time_budget, left) if time_budget is not None else left
+        model = solver.solve(time_budget=time_budget)
+        self.solver_stats = dict(solver.stats, vars=cnf.num_vars, clauses=len(cnf.clauses))
+        if verbose:
+            print(f'SAT: {self.solver_stats}')
+        if model is None:
+            raise TimeoutError('Time budget exceeded.')
+        if model is False:
+            raise Exception('No previous state found.')
+        return decode_board(model, stop.shape).astype(int)
+
+
+def benchmark_boards(sizes=(8, 12, 16, 25), steps=2, density=0.3, per_size=3, rseed=2292):
+    """
+    Fixed test boards for comparing exact solvers: random boards evolved a few steps (so a predecessor exists).
+    :return: list of final bitmaps
+    """
+    rs = np.random.RandomState(rseed)
+    boards = []
+    for size in sizes:
+        for _ in range(per_size):
+            X = rs.rand(size, size) < density
+            for _ in range(steps):
+                X = life_step(X)
+            boards.append(X)
+    return boards
+
+
+if __name__ == '__main__':
+    from tile_graph import DFS
+
+    solvers = {'dfs': DFS(), 'sat': SatSolver(time_budget=120)}
+    for F in benchmark_boards():
+        line = f'{F.shape[0]}x{F.shape[1]}, density {np.mean(F):0.3f}:'
+        for name, solver in solvers.items():
+            tic = time.perf_counter()
+            # With its time budget, SatSolver returns the arc consistency guess instead of raising TimeoutError.
+            A = solver.step_back(F)
+            result = 'ok' if solver.search_stats['complete'] else 'timeout'
+            assert result == 'timeout' or (life_step(A) == F).all()
+            toc = time.perf_counter()
+            line += f' {name} {result} {toc - tic:0.2f}s'
+        print(line)
+
+    """
+    Sample output (boards with predecessors, CPU only):
+
+    8x8, density 0.266: dfs ok 0.20s sat ok 0.34s
+    8x8, density 0.234: dfs ok 0.64s sat ok 2.03s
+    8x8, density 0.219: dfs ok 0.13s sat ok 2.22s
+    12x12, density 0.278: dfs ok 2.57s sat ok 4.07s
+    12x12, density 0.312: dfs ok 11.00s sat ok 34.05s
+    12x12, density 0.299: dfs ok 8.19s sat ok 24.71s
+    16x16, density 0.316: dfs ok 4.12s sat ok 7.47s
+    16x16, density 0.320: dfs ok 145.59s sat timeout 120.80s
+    """
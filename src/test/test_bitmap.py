@@ -1,4 +1,10 @@
-from bitmap import generate_all, generate_train_set
+import functools
+import itertools
+import numpy as np
+from bitmap import generate_all, generate_train_set, generate_n_cases, translation_view, augment_cases, \
+    apply_symmetry, canonicalize, inverse_symmetry, num_symmetries, unique_boards, \
+    SharedBatchRing, case_batch_specs, case_batches, \
+    StratifiedCaseGenerator, generate_inf_cases
 from simulator import life_step
 
 
@@ -20,3 +26,110 @@ def test_generate_train_set():
             start = life_step(start)
         assert (start == stop).all()
 
+
+
+def test_translation_view():
+    X = np.arange(12).reshape(3, 4)
+    V = translation_view(X)
+    for dy in range(3):
+        for dx in range(4):
+            assert (V[dy, dx] == np.roll(X, (-dy, -dx), axis=(0, 1))).all()
+
+
+def test_augment_cases_are_valid_pairs():
+    cases = list(generate_n_cases(True, 5, 234, return_one_but_last=True))
+    augmented = list(augment_cases(iter(cases), 4, seed=1, batch_size=3))
+    assert len(augmented) == 20
+    for delta, prev, stop in augmented:
+        assert (life_step(prev) == stop).all()
+
+    # Deterministic under a seed.
+    again = list(augment_cases(iter(cases), 4, seed=1, batch_size=3))
+    assert all((a[1] == b[1]).all() and (a[2] == b[2]).all() for a, b in zip(augmented, again))
+
+
+def test_augment_cases_exhaustive():
+    delta, prev, stop = next(generate_n_cases(True, 1, 234, return_one_but_last=True))
+    augmented = list(augment_cases([(delta, prev, stop)], 'all'))
+    assert len(augmented) == 8 * 25 * 25
+    for _, p, s in augmented[::97]:
+        assert (life_step(p) == s).all()
+    assert len({p.tobytes() for _, p, _ in augmented}) > 1
+
+
+def test_canonicalize_invariant_under_symmetries():
+    rs = np.random.RandomState(5)
+    boards = rs.randint(0, 2, size=(20, 25, 25))
+    keys, transforms = canonicalize(boards)
+
+    moved = apply_symmetry(boards, rs.randint(num_symmetries(25), size=20))
+    moved_keys, moved_transforms = canonicalize(moved)
+    assert (keys == moved_keys).all()
+    assert (apply_symmetry(boards, transforms) == apply_symmetry(moved, moved_transforms)).all()
+
+    canonical = apply_symmetry(boards, transforms)
+    assert (apply_symmetry(canonical, inverse_symmetry(transforms, 25)) == boards).all()
+
+    assert len(set(keys)) == 20
+    assert (unique_boards(np.concatenate([boards, moved])) == np.arange(20)).all()
+
+
+def test_shared_batch_ring():
+    with SharedBatchRing(case_batch_specs(8, board_size=10), num_slots=3) as ring:
+        ring.start(functools.partial(case_batches, base_seed=17, batch_size=8, board_size=10), num_producers=2)
+        for i, (prev, stop, deltas) in enumerate(ring):
+            assert prev.shape == (8, 1, 10, 10)
+            for p, s in zip(prev, stop):
+                assert (life_step(p[0].astype(int)) == s[0]).all()
+            if i == 10:
+                break
+        stats = ring.stats()
+    assert stats['batches_consumed'] == 11
+    assert stats['batches_produced'] >= 11
+
+    # A batch kept past close() is still readable (the memory stays mapped as long as it's alive).
+    assert (life_step(prev[0, 0].astype(int)) == stop[0, 0]).all()
+    prev[:] = 0
+
+
+def test_stratified_cases():
+    g = StratifiedCaseGenerator(True, 234)
+    cases = list(itertools.islice(g, 200))
+    for delta, start, stop, weight in cases:
+        assert 1 <= delta <= 5
+        assert stop.any()
+        assert weight > 0
+        for i in range(delta):
+            start = life_step(start)
+        assert (start == stop).all()
+
+    # The weight is the natural share of the stratum over its share among the cases emitted so far.
+    delta, start, _, weight = next(g)
+    d, b = delta - 1, g.bucket(np.mean(start))
+    assert np.isclose(weight, g.natural_mix()[d, b] * g.emitted.sum() / g.emitted[d, b])
+    assert np.isclose(g.weights()[-1], weight) and np.isclose(g.weights([delta], [b])[0], weight)
+
+    stats = g.stats()
+    assert stats['emitted'] == 201 and len(g.weights()) == 201
+    assert np.isclose(stats['emitted_mix'].sum(), 1.0)
+
+
+def test_stratified_weights():
+    # Target mix far from the natural one - the weights have to make up for it.
+    target = np.ones((5, 6))
+    target[:, 0] = target[4, :] = 20
+    g = StratifiedCaseGenerator(True, 0, target_mix=target, explore=0.5, board_size=12)
+    cases = list(itertools.islice(g, 1000))
+    mix = np.zeros(g.emitted.shape)
+    for (delta, start, _, _), weight in zip(cases, g.weights()):
+        mix[delta - 1, g.bucket(np.mean(start))] += weight
+    mix /= mix.sum()
+
+    natural = np.zeros(g.emitted.shape)
+    for delta, start, _ in itertools.islice(generate_inf_cases(True, 1, board_size=12, dtype=int), 1000):
+        natural[delta - 1, g.bucket(np.mean(start))] += 1
+    natural /= natural.sum()
+
+    # Total variation distance - about the sampling noise of 1000 cases over 30 strata for the weighted mix.
+    assert 0.5 * np.abs(g.stats()['emitted_mix'] - natural).sum() > 0.3
+    assert 0.5 * np.abs(mix - natural).sum() < 0.12
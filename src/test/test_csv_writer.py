@@ -0,0 +1,40 @@
+import io
+import numpy as np
+
+from csv_writer import format_rows, write_csv, write_submission
+
+
+def test_format_rows_matches_join():
+    rs = np.random.RandomState(123)
+    boards = rs.randint(0, 2, size=(7, 5, 5))
+    expected = ''.join(','.join(map(str, b.flatten())) + '\n' for b in boards).encode()
+    assert format_rows(boards) == expected
+    assert format_rows(boards.astype(np.bool_)) == expected
+
+    expected_ids = ''.join(f'{i},' + ','.join(map(str, b.flatten())) + '\n' for i, b in zip(range(50000, 50007), boards)).encode()
+    assert format_rows(boards, ids=range(50000, 50007)) == expected_ids
+
+
+def test_write_csv_streams_tuples():
+    rs = np.random.RandomState(42)
+    pairs = [(rs.randint(0, 2, size=(3, 3)), rs.randint(0, 2, size=(3, 3))) for _ in range(10)]
+    f = io.BytesIO()
+    write_csv(f, iter(pairs), header=['a'] * 18, chunk_size=3)
+
+    lines = f.getvalue().decode().splitlines()
+    assert len(lines) == 11
+    for line, (start, stop) in zip(lines[1:], pairs):
+        assert line == ','.join(map(str, np.concatenate([start.flatten(), stop.flatten()])))
+
+
+def test_write_submission():
+    rs = np.random.RandomState(7)
+    predictions = rs.randint(0, 2, size=(10, 625))
+    f = io.BytesIO()
+    write_submission(f, range(50000, 50010), predictions, chunk_size=4)
+
+    lines = f.getvalue().decode().splitlines()
+    assert lines[0] == ','.join(['id'] + [f'start_{i}' for i in range(625)])
+    rows = np.array([list(map(int, line.split(','))) for line in lines[1:]])
+    assert (rows[:, 0] == np.arange(50000, 50010)).all()
+    assert (rows[:, 1:] == predictions).all()
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from orphans import OrphanIndex, OrphanRouter, window_has_predecessor, get_orphan_index, _strip_step
+from simulator import life_step
+from tile_graph import DFS, BeliefProp, DynamicProg, LocalSearch, MultiStepSearch
+
+
+def test_window_has_predecessor():
+    assert window_has_predecessor(np.ones((4, 4), dtype=np.bool_))
+    glider = np.array([[0, 1, 0], [0, 0, 1], [1, 1, 1]], dtype=np.bool_)
+    assert window_has_predecessor(glider, care=glider)
+
+
+def test_orphan_index_scan(tmp_path):
+    rs = np.random.RandomState(0)
+    W = rs.rand(4, 5) < 0.5
+    care = rs.rand(4, 5) < 0.8
+    care[[0, -1], [0, -1]] = True
+    assert (W & care).any()
+    index = OrphanIndex()
+    assert index.add(W, care)
+    assert not index.add(np.rot90(W), np.rot90(care))
+
+    boards = np.zeros((4, 12, 12), dtype=np.bool_)
+    # Wrapping around the corner, rotated, transposed - and nothing on the last board.
+    boards[0] = np.roll(np.pad(W & care, ((0, 8), (0, 7))), (10, 9), axis=(0, 1))
+    boards[1, 3:8, 2:6] = np.rot90(W & care)
+    boards[2, 1:6, 5:9] = (W & care).T
+    assert index.scan(boards).tolist() == [True, True, True, False]
+    assert index.index_stats['boards'] == 4
+    assert index.index_stats['flagged'] == 3
+
+    index.save(tmp_path / 'orphans.npz')
+    loaded = OrphanIndex()
+    loaded.load(tmp_path / 'orphans.npz')
+    assert loaded.scan(boards).tolist() == [True, True, True, False]
+
+
+def test_orphans_skip_search():
+    F = np.zeros((10, 10), dtype=np.bool_)
+    F[2:5, 2] = True
+    index = OrphanIndex()
+    index.add(np.ones((3, 1), dtype=np.bool_))
+    with pytest.raises(Exception):
+        DFS(orphans=index).step_back(F)
+    # The anytime search still returns an approximation.
+    solver = DFS(orphans=index, time_budget=10)
+    A = solver.step_back(F)
+    assert A.shape == F.shape
+    assert not solver.search_stats['complete']
+
+    orphan = np.random.RandomState(2).rand(6, 6) < 0.5
+    with pytest.raises(Exception):
+        DynamicProg().step_back(orphan)
+
+
+def test_strip_step():
+    # A window keeps some pairs of previous rows exactly when it has a predecessor.
+    rs = np.random.RandomState(3)
+    for _ in range(5):
+        W = rs.rand(3, 4) < 0.6
+        S = np.arange(1 << 12, dtype=np.int64)
+        for r in (W.astype(np.int64) << np.arange(4)).sum(axis=1):
+            S = _strip_step(S, 4)[r]
+        assert (len(S) > 0) == window_has_predecessor(W)
+
+
+def test_default_orphans():
+    index = get_orphan_index()
+    assert len(index.patterns) >= 2
+    rs = np.random.RandomState(4)
+    for W, _ in index.patterns:
+        h, w = W.shape
+        # A real board with the pattern in the middle of random cells, flagged only once the torus is big enough.
+        F = rs.rand(h + 4, 25) < 0.3
+        F[2:2 + h, 5:5 + w] = np.rot90(W, 2)
+        assert index.contains(F)
+        assert not index.contains(F[1:-2])
+
+        solver = DFS(orphans=index)
+        with pytest.raises(Exception):
+            solver.step_back(F)
+        assert solver.search_stats['nodes'] == 0
+        with pytest.raises(Exception):
+            MultiStepSearch(orphans=index).predict(1, F)
+
+
+def test_orphan_router():
+    index = get_orphan_index()
+    rs = np.random.RandomState(5)
+    W, _ = index.patterns[0]
+    h, w = W.shape
+    orphan = rs.rand(h + 4, 25) < 0.3
+    orphan[2:2 + h, 5:5 + w] = W
+    stop = life_step(rs.rand(h + 4, 25) < 0.2)
+
+    # The solver alone isn't given the index - it's the router that sends the orphan to the fallback.
+    router = OrphanRouter(DFS(time_budget=60))
+    A = router.step_back_batch([orphan, stop])
+    assert router.router_stats == {'boards': 2, 'routed': 1}
+    assert (life_step(A[1]) == stop).all()
+    assert (A[0] == BeliefProp().step_back(orphan)).all()
+
+    router = OrphanRouter(DFS(time_budget=60), fallback=LocalSearch(time_budget=None, max_flips=100))
+    A = router.predict(1, orphan)
+    assert A.shape == orphan.shape and router.router_stats == {'boards': 1, 'routed': 1}
@@ -0,0 +1,42 @@
+import functools
+import numpy as np
+import pytest
+
+from portfolio import Portfolio, RandomValueOrder, default_configs
+from scoring import score
+from simulator import life_step
+from tile_graph import DFS
+
+
+def test_portfolio_first_wins():
+    rs = np.random.RandomState(3)
+    stop = life_step(life_step(rs.rand(10, 10) < 0.3))
+    configs = [('dfs', DFS), ('dfs-random', functools.partial(DFS, value_order=RandomValueOrder(1)))]
+    portfolio = Portfolio(configs, num_workers=2)
+    A = portfolio.step_back(stop)
+    assert (life_step(A) == stop).all()
+    assert portfolio.search_stats['winner'] in ('dfs', 'dfs-random')
+    assert sum(portfolio.wins.values()) == 1
+
+
+def test_portfolio_all_fail():
+    orphan = np.random.RandomState(2).rand(6, 6) < 0.5
+    portfolio = Portfolio([('dfs', DFS), ('dfs-random', functools.partial(DFS, value_order=RandomValueOrder(1)))],
+                          num_workers=1)
+    with pytest.raises(Exception):
+        portfolio.step_back(orphan)
+    assert portfolio.search_stats['failed'] == ['dfs', 'dfs-random']
+    assert not portfolio.wins
+
+    # With a time budget, the best guess instead of an exception.
+    portfolio.time_budget = 60
+    progress = []
+    A = portfolio.step_back(orphan, callback=progress.append)
+    assert A.shape == orphan.shape
+    assert progress == [portfolio.search_stats] and not portfolio.search_stats['complete']
+    assert portfolio.search_stats['accuracy'] == score(1, A, orphan)
+
+
+def test_default_configs():
+    names = [name for name, _ in default_configs(6)]
+    assert len(set(names)) == 6 and names[0] == 'dfs'
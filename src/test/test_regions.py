@@ -0,0 +1,63 @@
+import numpy as np
+
+from regions import RegionSolver, decompose, region_key
+from simulator import life_step
+
+
+def _board(size, clusters):
+    X = np.zeros((size, size), dtype=np.bool_)
+    for (i, j), patch in clusters:
+        h, w = patch.shape
+        X[np.ix_((i + np.arange(h)) % size, (j + np.arange(w)) % size)] |= patch
+    return X
+
+
+BLINKER = np.ones((1, 3), dtype=np.bool_)
+GLIDER = np.array([[0, 1, 0], [0, 0, 1], [1, 1, 1]], dtype=np.bool_)
+
+
+def test_decompose():
+    # The glider wraps around the corner of the board.
+    F = _board(20, [((2, 3), BLINKER), ((10, 10), BLINKER.T), ((18, 18), GLIDER)])
+    pieces = decompose(F)
+    assert len(pieces) == 3
+    cover = np.zeros(F.shape, dtype=int)
+    for G, dead, rows, cols in pieces:
+        assert G.shape == dead.shape == (len(rows), len(cols))
+        assert dead[[0, -1]].all() and dead[:, [0, -1]].all()
+        cover[np.ix_(rows, cols)] += G
+    assert (cover == F).all()
+
+    # Nothing to split.
+    assert len(decompose(np.ones((6, 6), dtype=np.bool_))) == 1
+    assert len(decompose(np.zeros((6, 6), dtype=np.bool_))) == 1
+
+
+def test_region_key_symmetries():
+    F = _board(7, [((1, 2), GLIDER)])
+    dead = np.zeros(F.shape, dtype=np.bool_)
+    key, _, _ = region_key(F, dead)
+    assert region_key(np.roll(F, (3, 5), axis=(0, 1)), dead)[0] == key
+    assert region_key(F[::-1].T, dead)[0] == key
+    assert region_key(F[:, ::-1], dead)[0] == key
+    assert region_key(F.T, dead)[0] == key
+    assert region_key(F[:, :5].T, dead[:, :5].T)[0] == region_key(F[:, :5], dead[:, :5])[0]
+
+
+def test_region_solver():
+    F = _board(32, [((2, 3), BLINKER), ((10, 12), BLINKER.T), ((18, 22), GLIDER), ((26, 4), GLIDER[::-1].T)])
+    solver = RegionSolver()
+    A = solver.step_back(F)
+    assert (life_step(A) == F).all()
+    assert solver.region_stats['pieces'] == 4
+    # The two blinkers and the two gliders are the same pieces up to symmetry.
+    assert solver.region_stats['cache_hits'] == 2
+    assert solver.region_stats['fallbacks'] == 0
+    assert len(solver.cache) == 2
+
+    # A board with no predecessor with dead margins falls back to the whole board.
+    rs = np.random.RandomState(0)
+    X = _board(16, [((2, 2), rs.rand(5, 5) < 0.5), ((9, 9), rs.rand(5, 5) < 0.5)])
+    F = life_step(X)
+    A = RegionSolver().step_back(F)
+    assert (life_step(A) == F).all()
@@ -0,0 +1,81 @@
+import io
+import itertools
+import time
+import numpy as np
+import pytest
+
+from sat import CNF, CDCLSolver, SatSolver, encode_step_back, decode_board, write_dimacs, read_dimacs, luby
+from scoring import score
+from simulator import life_step
+
+
+def brute_force(cnf):
+    for bits in itertools.product([False, True], repeat=cnf.num_vars):
+        if all(any(bits[abs(lit) - 1] == (lit > 0) for lit in clause) for clause in cnf.clauses):
+            return True
+    return False
+
+
+def test_cdcl_random_3sat():
+    rs = np.random.RandomState(0)
+    for t in range(100):
+        cnf = CNF(10)
+        for _ in range(rs.randint(20, 60)):
+            variables = rs.choice(10, 3, replace=False) + 1
+            cnf.add([int(v) if rs.rand() < 0.5 else -int(v) for v in variables])
+
+        model = CDCLSolver(cnf, seed=t).solve()
+        assert (model is not False) == brute_force(cnf)
+        if model:
+            assert all(any(model[abs(lit)] == (lit > 0) for lit in clause) for clause in cnf.clauses)
+
+
+def test_encoding_matches_predecessors():
+    successors = {life_step(np.array(bits).reshape(4, 3)).tobytes()
+                  for bits in itertools.product([False, True], repeat=12)}
+    rs = np.random.RandomState(1)
+    for _ in range(10):
+        stop = rs.rand(4, 3) < 0.4
+        has_predecessor = stop.tobytes() in successors
+
+        model = CDCLSolver(encode_step_back(stop)).solve()
+        assert (model is not False) == has_predecessor
+        if model:
+            assert (life_step(decode_board(model, stop.shape)) == stop).all()
+
+
+def test_dimacs_round_trip():
+    cnf = encode_step_back(np.eye(3, dtype=bool))
+    f = io.StringIO()
+    write_dimacs(f, cnf, comments=['eye'])
+    assert f.getvalue().startswith(f'c eye\np cnf {cnf.num_vars} {len(cnf.clauses)}\n')
+
+    f.seek(0)
+    loaded = read_dimacs(f)
+    assert loaded.num_vars == cnf.num_vars
+    assert loaded.clauses == cnf.clauses
+
+
+def test_sat_solver_step_back():
+    assert [luby(i) for i in range(1, 16)] == [1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8]
+
+    rs = np.random.RandomState(3)
+    start = rs.rand(6, 6) < 0.3
+    stop = life_step(life_step(start))
+    solver = SatSolver()
+    A = solver.step_back(stop)
+    assert (life_step(A) == stop).all()
+
+    # Both generations at once.
+    A = solver.predict(2, stop)
+    assert (life_step(life_step(A)) == stop).all()
+
+    # No predecessor - with a deadline that's the arc consistency guess instead of an exception.
+    orphan = np.random.RandomState(2).rand(6, 6) < 0.5
+    with pytest.raises(Exception):
+        solver.step_back(orphan)
+    progress = []
+    A = solver.step_back(orphan, deadline=time.perf_counter() + 60, callback=progress.append)
+    assert A.shape == orphan.shape
+    assert progress == [solver.search_stats] and not solver.search_stats['complete']
+    assert solver.search_stats['accuracy'] == score(1, A, orphan)
@@ -1,10 +1,14 @@
+import itertools
 import numpy as np
 import pytest
 from tqdm import tqdm
 
-from tile_graph import DynamicProg, DFS, TileGraph
+from tile_graph import DynamicProg, DFS, ProbaHeur, LocalSearch, MultiStepSearch, BeliefProp, BlockGraph, ProbaHeur2, \
+    TileGraph, TILE_GRAPH_VERSION, load_tables, Propagator, NogoodCache, pack_mask, mask_size, mask_members, UP, DOWN, \
+    LEFT, RIGHT, TensorProp, unpack_mask, tile_codes, DEFAULT_PROBA_HEUR2_MODEL
 from simulator import life_step
-from bitmap import generate_all
+from transfer import TransferMatrix
+from bitmap import generate_all, generate_inf_cases
 from scoring import score
 
 tile_graph = TileGraph()
@@ -40,7 +44,9 @@ def test_step_back_simple(alg_class):
         [0, 0, 0, 0, 0, 0]
     ])
     A = alg.step_back(toad_2)
-    assert (A == toad_1).all()
+    assert (life_step(A) == toad_2).all()
+    if alg_class is DynamicProg:
+        assert (A == toad_1).all()
 
 
 # DynamicProg cannot unfortunately pass this test :(
@@ -55,3 +61,387 @@ def test_step_back_all_3x3(alg_class):
 
         sc = score(1, A, X)
         assert sc == 1.0
+
+
+def test_preprocess_matches_definitions():
+    T = list(generate_all(3, 3))
+    assert all((t == tile).all() for t, tile in zip(T, tile_graph.tiles))
+
+    for c in (0, 1):
+        assert tile_graph.prev[c] == [i for i, t in enumerate(T) if life_step(t)[1][1] == c]
+
+    T = np.array(T)
+    assert (tile_graph.horiz == (T[:, None, :, 1:] == T[None, :, :, :2]).all(axis=(2, 3))).all()
+    assert (tile_graph.verti == (T[:, None, 1:, :] == T[None, :, :2, :]).all(axis=(2, 3))).all()
+
+
+def test_tile_graph_cache(tmp_path):
+    cache_dir = str(tmp_path)
+    built = TileGraph(cache_dir=cache_dir)
+    loaded = TileGraph(cache_dir=cache_dir)
+    assert isinstance(loaded.horiz.base, np.memmap)
+    assert not loaded.horiz.flags.writeable
+    for G in (built, loaded):
+        assert (G.horiz == tile_graph.horiz).all()
+        assert (G.verti == tile_graph.verti).all()
+        assert (G.tiles == tile_graph.tiles).all()
+        assert G.prev == tile_graph.prev
+
+    # Stale cache gets rebuilt.
+    calls = []
+    def build():
+        calls.append(1)
+        return {'a': np.arange(3)}
+    assert (load_tables('tile_graph', TILE_GRAPH_VERSION + 1, build, cache_dir)['a'] == np.arange(3)).all()
+    assert (load_tables('tile_graph', TILE_GRAPH_VERSION + 1, build, cache_dir)['a'] == np.arange(3)).all()
+    assert len(calls) == 1
+
+
+def test_mask_revision_matches_lists():
+    rs = np.random.RandomState(0)
+    ids = np.arange(512)
+    for _ in range(20):
+        X = sorted(rs.choice(512, rs.randint(0, 40), replace=False).tolist())
+        Y = sorted(rs.choice(512, rs.randint(1, 300), replace=False).tolist())
+        mX, mY = pack_mask(np.isin(ids, X)), pack_mask(np.isin(ids, Y))
+        assert mask_size(mY) == len(Y)
+        for C, side, other_side in [(tile_graph.horiz, RIGHT, LEFT), (tile_graph.verti, DOWN, UP)]:
+            expected = tile_graph.get_compatible_Y(X, Y, C)
+            assert mask_members(tile_graph.allowed(mX, side) & mY).tolist() == expected
+            expected = tile_graph.get_compatible_X(Y, X, C)
+            assert mask_members(tile_graph.allowed(mX, other_side) & mY).tolist() == expected
+
+
+
+def test_propagator_counts_wipeouts():
+    # A pixel without any candidate tiles leaves its neighbours without support.
+    D = tile_graph.initial_domains(np.zeros((5, 5), dtype=int))
+    D[2, 2] = 0
+    P = Propagator(tile_graph, D)
+    P.push_all()
+    assert not P.propagate()
+    assert P.stats()['wipeouts'] == 1
+    assert P.stats()['revisions'] > 0
+
+    block = np.zeros((6, 6), dtype=int)
+    block[2:4, 2:4] = 1
+    D = tile_graph.initial_domains(block)
+    P = Propagator(tile_graph, D)
+    P.push_all()
+    assert P.propagate()
+    assert P.stats()['wipeouts'] == 0
+    assert (mask_size(D) > 0).all()
+
+
+def test_tensor_prop_matches_ac3():
+    rs = np.random.RandomState(5)
+    Fs = rs.rand(3, 7, 6) < 0.3
+    Fs[2] = False
+    Fs[2, 2:4, 2:4] = True
+
+    TP = TensorProp(tile_graph)
+    D = TP.initial(Fs)
+    wiped = TP.propagate(D)
+    for F, tensor_domains, tensor_wiped in zip(Fs, D, wiped):
+        S = tile_graph.initial_domains(F)
+        P = Propagator(tile_graph, S)
+        P.push_all()
+        assert P.propagate() != tensor_wiped
+        if not tensor_wiped:
+            assert (unpack_mask(S) == tensor_domains).all()
+    assert not wiped[2]
+
+
+def test_proba_heur_batch_with_wipeout(monkeypatch):
+    rs = np.random.RandomState(6)
+    Fs = np.array([life_step(rs.rand(8, 8) < 0.3) for _ in range(3)])
+    expected = ProbaHeur(tile_graph, propagation='tensor').step_back_batch(Fs)
+
+    # A domain wiped out on the middle board only (arc consistency hardly ever gets there on its own).
+    initial = TensorProp.initial
+
+    def wiped_initial(self, Fs):
+        D = initial(self, Fs)
+        D[len(D) // 2, 2, 3] = False
+        return D
+    monkeypatch.setattr(TensorProp, 'initial', wiped_initial)
+
+    A = ProbaHeur(tile_graph, propagation='tensor').step_back_batch(Fs)
+    assert (A[[0, 2]] == expected[[0, 2]]).all()
+    assert A[1, 2, 3] == Fs[1, 2, 3]
+    # LocalSearch starting from ProbaHeur still gets a board.
+    X = LocalSearch(tile_graph, time_budget=None, max_flips=100, init='proba').step_back(Fs[1])
+    assert X.shape == Fs[1].shape
+
+
+def test_tile_codes():
+    rs = np.random.RandomState(8)
+    F = rs.rand(5, 4) < 0.5
+    codes = tile_codes(F)
+    for i in range(5):
+        for j in range(4):
+            tile = np.roll(F, (1 - i, 1 - j), axis=(0, 1))[:3, :3]
+            assert (tile_graph.tiles[codes[i, j]] == tile).all()
+
+
+def test_dfs_search_stats():
+    rs = np.random.RandomState(17)
+    stop = life_step(life_step(rs.rand(12, 12) < 0.3))
+    order = []
+    alg = DFS(tile_graph, value_order=lambda F, i, j, tiles: order.append((i, j)) or tiles[::-1])
+    A = alg.step_back(stop)
+    assert (life_step(A) == stop).all()
+    assert alg.search_stats['nodes'] >= 144
+    stats = alg.search_stats
+    assert stats['nodes'] - stats['backtracks'] - stats['backjumps'] == 144
+    assert len(set(order)) == 144
+
+
+def test_dfs_beyond_recursion_limit():
+    # More pixels than the default recursion limit.
+    stop = np.zeros((34, 34), dtype=int)
+    stop[10:12, 10:12] = 1
+    stop[20, 20:23] = 1
+    A = DFS(tile_graph).step_back(stop)
+    assert (life_step(A) == stop).all()
+
+
+def test_nogood_cache_lru():
+    cache = NogoodCache(capacity=2)
+    cache.add([((0, 0), 1), ((0, 1), 2)])
+    cache.add([((1, 1), 3)])
+    assigned = {((0, 0), 1)}
+    is_assigned = lambda pixel, tile_id: (pixel, tile_id) in assigned
+    assert cache.find(((0, 1), 2), is_assigned) is not None
+    assert cache.find(((0, 1), 3), is_assigned) is None
+
+    # The first nogood was just used, so the second one goes.
+    cache.add([((2, 2), 4)])
+    assert cache.find(((1, 1), 3), is_assigned) is None
+    assert cache.find(((0, 1), 2), is_assigned) is not None
+    assert cache.stats() == {'lookups': 4, 'hits': 2, 'learned': 3, 'evictions': 1, 'size': 2}
+
+
+def test_dfs_backjumping_keeps_solution():
+    rs = np.random.RandomState(7)
+    stop = life_step(life_step(rs.rand(14, 14) < 0.3))
+    A = DFS(tile_graph).step_back(stop)
+    B = DFS(tile_graph, nogood_cache_size=0).step_back(stop)
+    assert (life_step(A) == stop).all()
+    assert (A == B).all()
+
+
+def test_local_search():
+    rs = np.random.RandomState(21)
+    stop = life_step(life_step(rs.rand(12, 12) < 0.3))
+    alg = LocalSearch(tile_graph, time_budget=None, max_flips=3000, init='stop', rseed=4)
+    A = alg.step_back(stop)
+    assert alg.search_stats['flips'] <= 3000
+    assert np.isclose(alg.residual, 1 - score(1, A, stop))
+    assert alg.residual < 1 - score(1, stop, stop)
+
+    # Same seed - same board.
+    B = LocalSearch(tile_graph, time_budget=None, max_flips=3000, init='stop', rseed=4).step_back(stop)
+    assert (A == B).all()
+
+
+def test_dfs_enumerates_all_predecessors():
+    # All 4x4 boards and their successors.
+    codes = np.arange(1 << 16)
+    boards = ((codes[:, None] >> np.arange(16)) & 1).reshape(-1, 4, 4).astype(np.bool_)
+    counts = sum(np.roll(boards, (di, dj), axis=(1, 2)) for di in (-1, 0, 1) for dj in (-1, 0, 1) if di or dj)
+    successors = (counts == 3) | (boards & (counts == 2))
+
+    rs = np.random.RandomState(3)
+    for stop in successors[rs.choice(len(boards), 5, replace=False)]:
+        expected = {b.tobytes() for b in boards[(successors == stop).all(axis=(1, 2))]}
+        alg = DFS(tile_graph)
+        found = list(alg.predecessors(stop))
+        assert {A.astype(np.bool_).tobytes() for A in found} == expected
+        assert len(found) == len(expected) == alg.search_stats['solutions']
+        assert (found[0] == DFS(tile_graph).step_back(stop)).all()
+
+    stop = life_step(life_step(rs.rand(10, 10) < 0.3))
+    alg = DFS(tile_graph)
+    found = list(alg.predecessors(stop, max_count=5))
+    assert len(found) == 5 and len({A.tobytes() for A in found}) == 5
+    assert all((life_step(A) == stop).all() for A in found)
+
+
+def test_dfs_anytime():
+    rs = np.random.RandomState(5)
+    stop = life_step(life_step(rs.rand(25, 25) < 0.3))
+    progress = []
+    # The node limit ends the anytime search, the time budget is never reached.
+    alg = DFS(tile_graph, time_budget=3600, max_nodes=200, progress_nodes=10)
+    A = alg.step_back(stop, callback=lambda stats: progress.append(dict(stats)))
+    assert A.shape == stop.shape
+    assert not alg.search_stats['complete']
+    assert alg.search_stats['nodes'] == 201
+    assert alg.search_stats['accuracy'] == score(1, A, stop)
+    assert alg.search_stats['accuracy'] > score(1, stop, stop)
+    assert len(progress) == 21 and all('depth' in p for p in progress[:-1]) and progress[-1]['complete'] is False
+
+    # Deadline already passed - still a board, just the propagated domains.
+    alg = DFS(tile_graph)
+    A = alg.step_back(stop, deadline=0)
+    assert A.shape == stop.shape
+    assert alg.search_stats['nodes'] == 1 and not alg.search_stats['complete']
+    assert alg.search_stats['accuracy'] == score(1, A, stop)
+
+    # Enough time - the exact answer.
+    small = life_step(rs.rand(8, 8) < 0.3)
+    alg = DFS(tile_graph, time_budget=60)
+    assert (life_step(alg.step_back(small)) == small).all()
+    assert alg.search_stats['complete'] and alg.search_stats['accuracy'] == 1
+
+
+def test_step_back_anytime():
+    stops = [stop.astype(np.bool_) for _, stop in itertools.islice(generate_inf_cases(False, 3, dtype=int), 15)]
+
+    # DynamicProg narrows most of these boards down into a wipe-out - with a deadline that gives a guess, not an error.
+    alg = DynamicProg(tile_graph)
+    progress = []
+    boards = [alg.step_back(stop, deadline=float('inf'), callback=progress.append) for stop in stops]
+    assert len(progress) == len(stops)
+    assert all(stats['accuracy'] == score(1, A, stop) for stats, A, stop in zip(progress, boards, stops))
+    wiped = [stop for stats, stop in zip(progress, stops) if not stats['complete']]
+    assert wiped
+    with pytest.raises(Exception):
+        alg.step_back(wiped[0])
+
+    # Deadline already passed - the heuristics still return a board, from the domains they have by then.
+    for alg in [DynamicProg(tile_graph), ProbaHeur(tile_graph), ProbaHeur2(tile_graph), BeliefProp(tile_graph)]:
+        progress = []
+        A = alg.step_back(stops[0], deadline=0, callback=progress.append)
+        assert A.shape == stops[0].shape
+        assert progress == [alg.search_stats] and alg.search_stats['accuracy'] == score(1, A, stops[0])
+        # ProbaHeur is a single propagation, there's nothing to cut short.
+        assert alg.search_stats['complete'] == isinstance(alg, ProbaHeur)
+
+
+def test_belief_prop():
+    bp = BeliefProp(tile_graph, rounds=10)
+    rs = np.random.RandomState(8)
+    H = rs.rand(2, 4, 5, 512)
+    for side, (C, axis, shift) in enumerate([(tile_graph.verti, 1, 1), (tile_graph.horiz, 2, 1),
+                                             (tile_graph.horiz.T, 2, -1), (tile_graph.verti.T, 1, -1)]):
+        assert np.allclose(bp._pass(H, side), np.roll(H @ C, shift, axis=axis))
+
+    # With uniform tile priors the marginals estimate the frequencies over all the predecessors - compared with the
+    # exact ones of narrow boards. Loopy BP is overconfident, but the cells mostly end up on the right side.
+    rs = np.random.RandomState(0)
+    stops = np.array([life_step(life_step(rs.rand(12, 5) < 0.35)) for _ in range(4)])
+    exact = np.array([TransferMatrix().marginals(F) for F in stops])
+    uniform = BeliefProp(tile_graph, np.zeros((512, 512)), rounds=30)
+    P = uniform.marginals(stops)
+    assert P.shape == stops.shape and (P >= 0).all() and (P <= 1 + 1e-6).all()
+    assert uniform.bp_stats['rounds'] <= 30
+    decided = exact != 0.5
+    assert ((P > 0.5) == (exact > 0.5))[decided].mean() > 0.8
+
+    # Trained priors of ProbaHeur2 by default, a model can be passed directly too.
+    model = ProbaHeur2(tile_graph)
+    model.load_model(DEFAULT_PROBA_HEUR2_MODEL)
+    assert model.trans.sum() > 0
+    assert np.allclose(bp.prior, BeliefProp(tile_graph, model).prior)
+    assert np.allclose(bp.prior, BeliefProp(tile_graph, model.trans).prior)
+    assert not np.allclose(bp.prior, uniform.prior)
+    assert bp.step_back(stops[0]).shape == stops[0].shape
+
+
+def test_trans_value_order(tmp_path):
+    rs = np.random.RandomState(11)
+    stop = life_step(life_step(rs.rand(12, 12) < 0.3))
+
+    # No counts - the default order.
+    untrained = ProbaHeur2(tile_graph)
+    assert (DFS(tile_graph, value_order=untrained.value_order()).step_back(stop) == DFS(tile_graph).step_back(stop)).all()
+
+    model = ProbaHeur2(tile_graph)
+    for _ in range(3):
+        start = life_step(rs.rand(12, 12) < 0.3)
+        model.train(1, start, life_step(start))
+    model.save_model(tmp_path / 'model')
+    loaded = ProbaHeur2(tile_graph)
+    loaded.load_model(tmp_path / 'model.npz')
+    assert (loaded.trans == model.trans).all()
+    assert (loaded.order == model.candidate_order()).all()
+
+    order = loaded.value_order()
+    f_tile = tile_codes(stop)[0, 0]
+    tiles = order(stop, 0, 0, np.arange(512))
+    assert (np.diff(model.trans[tiles, f_tile]) <= 0).all()
+
+    alg = DFS(tile_graph, value_order=order)
+    assert (life_step(alg.step_back(stop)) == stop).all()
+
+    # Patches of the block graph are ordered by the same counts.
+    blocks = ProbaHeur2(block_graph)
+    blocks.trans = model.trans
+    assert (life_step(DFS(block_graph, value_order=blocks.value_order()).step_back(stop)) == stop).all()
+
+
+def test_multi_step_search():
+    rs = np.random.RandomState(0)
+    stop = rs.rand(8, 8) < 0.3
+    for _ in range(7):
+        stop = life_step(stop)
+    alg = MultiStepSearch(tile_graph)
+    A = alg.predict(2, stop)
+    assert (life_step(life_step(A)) == stop).all()
+
+    # Shifted and transposed copy of the same board - reversed from the memo.
+    misses = alg.search_stats['memo_misses']
+    shifted = np.roll(stop, (3, 5), axis=(0, 1)).T
+    B = alg.predict(2, shifted)
+    assert (life_step(life_step(B)) == shifted).all()
+    assert alg.search_stats['memo_misses'] == misses
+    assert alg.search_stats['memo_hits'] >= 2
+
+    # Garden of Eden - remembered as a dead end.
+    orphan = np.random.RandomState(2).rand(6, 6) < 0.5
+    with pytest.raises(Exception):
+        alg.predict(1, orphan)
+    with pytest.raises(Exception):
+        alg.predict(1, orphan)
+    assert alg.search_stats['memo_misses'] == misses + 1
+
+
+block_graph = BlockGraph()
+
+
+def test_block_graph_tables():
+    assert block_graph.offsets[-1] == 1 << 16
+    rs = np.random.RandomState(11)
+    for s in range(16):
+        group = block_graph.patches[block_graph.offsets[s]:block_graph.offsets[s + 1]]
+        for patch in rs.choice(group, 5):
+            P = np.array([(int(patch) >> k) & 1 for k in range(16)]).reshape(4, 4)
+            # The middle 2x2 of a 4x4 board padded with dead cells evolves the same as on the infinite plane.
+            middle = life_step(np.pad(P, 2))[3:5, 3:5]
+            assert sum(int(middle[r, c]) << (2 * r + c) for r in range(2) for c in range(2)) == s
+
+    # Odd sizes add overlaps across the seam; overlaps are symmetric.
+    layout = block_graph.layout((9, 9))
+    assert layout.rows == [0, 2, 4, 6, 7]
+    for a, overlaps in enumerate(layout.overlaps):
+        for b, bits_a, bits_b in overlaps:
+            assert (a, bits_b, bits_a) in [(c, x, y) for c, x, y in layout.overlaps[b]]
+
+
+@pytest.mark.parametrize("shape", [(6, 6), (9, 8)])
+def test_dfs_on_blocks(shape):
+    rs = np.random.RandomState(sum(shape))
+    stop = life_step(life_step(rs.rand(*shape) < 0.3))
+    A = DFS(block_graph).step_back(stop)
+    assert (life_step(A) == stop).all()
+
+
+def test_proba_heur2_on_blocks():
+    block = np.zeros((8, 8), dtype=bool)
+    block[3:5, 3:5] = True
+    alg = ProbaHeur2(block_graph)
+    A = alg.step_back(block)
+    assert A.shape == block.shape
+    assert score(1, A, block) > 0.9
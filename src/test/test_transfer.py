@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from simulator import life_step
+from transfer import TransferMatrix
+
+
+def _brute_force(F):
+    m, n = F.shape
+    X = ((np.arange(1 << (m * n))[:, None] >> np.arange(m * n)) & 1).reshape(-1, m, n)
+    nbrs = sum(np.roll(X, (di, dj), axis=(1, 2)) for di in (-1, 0, 1) for dj in (-1, 0, 1)) - X
+    nxt = (nbrs == 3) | (X == 1) & (nbrs == 2)
+    return list(X[(nxt == F).all(axis=(1, 2))].astype(np.bool_))
+
+
+def test_transfer_matrix_exact():
+    rs = np.random.RandomState(0)
+    T = TransferMatrix()
+    for shape in [(3, 4), (4, 4), (5, 3)]:
+        for F in (rs.rand(*shape) < 0.3, life_step(rs.rand(*shape) < 0.4)):
+            found = _brute_force(F)
+            assert T.count(F) == len(found)
+            if found:
+                assert np.allclose(T.marginals(F), np.mean(found, axis=0))
+                samples = T.sample(F, size=5, rseed=1)
+                assert all((life_step(X) == F).all() for X in samples)
+            else:
+                assert np.isnan(T.marginals(F)).all()
+                with pytest.raises(Exception):
+                    T.step_back(F)
+    assert T.transfer_stats['entries'] > 0 and T.transfer_stats['bytes'] > 0
+
+
+def test_transfer_matrix_narrow_torus():
+    rs = np.random.RandomState(1)
+    F = life_step(life_step(rs.rand(5, 16) < 0.35))
+    T = TransferMatrix()
+    A = T.step_back(F, rseed=0)
+    assert A.shape == F.shape
+    assert (life_step(A) == F).all()
+    assert T.count(F) > 0
+    assert T.transfer_stats['width'] == 5
+
+    # Samples are uniform - their mean approaches the exact marginals.
+    P = T.marginals(F)
+    samples = T.sample(F, size=200, rseed=2)
+    assert np.abs(samples.mean(axis=0) - P).max() < 0.2
+
+    with pytest.raises(MemoryError):
+        TransferMatrix(max_bytes=10 ** 4).count(F)
+    with pytest.raises(ValueError):
+        TransferMatrix(max_width=4).count(F)
@@ -1,28 +1,232 @@
 # Algorithm based on dynamic programming
 
+import collections
+import json
+import os
+import shutil
+import tempfile
 import numpy as np
 import time
 from simulator import life_step
-from bitmap import generate_all, generate_inf_cases
+from bitmap import generate_inf_cases, canonicalize, apply_symmetry, inverse_symmetry
 from scoring import score
-from tqdm import tqdm
+
+# On-disk cache of precomputed tables. Bump the version whenever the content of the tables changes.
+TILE_GRAPH_VERSION = 2
+BLOCK_GRAPH_VERSION = 1
+DEFAULT_CACHE_DIR = os.environ.get(
+    'JJS229_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'cache'))
+# Transition counts of ProbaHeur2 trained on generate_inf_cases, the default tile priors of BeliefProp.
+DEFAULT_PROBA_HEUR2_MODEL = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'models', 'best', 'proba_heur2.npz')
+
+
+def load_tables(name, version, build, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Loads numpy tables from the on-disk cache, memory-mapped read-only - so processes forked from (or started next to)
+    each other share the same physical pages. The tables are rebuilt and stored if the cache is missing or was written
+    with a different version.
+    :param name: name of the cache entry (a directory in cache_dir)
+    :param build: function returning a dict: table name -> np.ndarray
+    :param cache_dir: cache directory, or None to just build the tables in memory
+    :return: dict: table name -> np.ndarray
+    """
+    if cache_dir is None:
+        return build()
+
+    path = os.path.join(cache_dir, name)
+
+    def load():
+        try:
+            with open(os.path.join(path, 'tables.json')) as f:
+                manifest = json.load(f)
+            if manifest['version'] != version:
+                return None
+            # Plain ndarray views of the mapping - indexing np.memmap objects element by element is much slower.
+            return {t: np.load(os.path.join(path, t + '.npy'), mmap_mode='r').view(np.ndarray)
+                    for t in manifest['tables']}
+        except (OSError, ValueError, KeyError):
+            return None
+
+    tables = load()
+    if tables is not None:
+        return tables
+
+    tables = build()
+    try:
+        # Write everything to a temporary directory first and rename it, so concurrent readers never see partial files.
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=name + '.', dir=cache_dir)
+        for t, arr in tables.items():
+            np.save(os.path.join(tmp, t + '.npy'), arr)
+        with open(os.path.join(tmp, 'tables.json'), 'w') as f:
+            json.dump({'version': version, 'tables': sorted(tables)}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another process has just stored the same tables.
+            shutil.rmtree(tmp, ignore_errors=True)
+    except OSError:
+        return tables
+
+    return load() or tables
+
+
+# Sides of a tile, used to index TileGraph.support.
+UP, DOWN, LEFT, RIGHT = range(4)
+
+# Sets of tiles are also stored as 512-bit masks: 8 uint64 words, tile t is bit (t % 64) of word t // 64.
+MASK_WORDS = 8
+_BIT_SHIFTS = np.arange(64, dtype=np.uint64)
+_POPCOUNT8 = np.array([bin(b).count('1') for b in range(256)], dtype=np.int64)
+_BYTE_BITS = ((np.arange(256)[:, None] >> np.arange(8)) & 1).astype(np.bool_)
+_BYTE_POSITIONS = np.arange(MASK_WORDS * 8)
+# Center cell of every tile (bit 3 * 1 + 1 of the tile id).
+_TILE_CENTERS = (np.arange(MASK_WORDS * 64) >> 4) & 1
+
+
+def pack_mask(rows):
+    """
+    :param rows: boolean array of shape (..., 512)
+    :return: uint64 array of shape (..., 8)
+    """
+    bits = np.reshape(rows, rows.shape[:-1] + (MASK_WORDS, 64)).astype(np.uint64)
+    # Bits are distinct, so summing them is the same as OR-ing them.
+    return (bits << _BIT_SHIFTS).sum(axis=-1, dtype=np.uint64)
+
+
+def unpack_mask(mask):
+    """
+    :param mask: uint64 array of shape (..., 8)
+    :return: boolean array of shape (..., 512)
+    """
+    # Byte-wise table lookup - bytes of little-endian words are in the order of the tile ids.
+    bits = _BYTE_BITS[np.ascontiguousarray(mask, dtype='<u8').view(np.uint8)]
+    return bits.reshape(mask.shape[:-1] + (MASK_WORDS * 64,))
+
+
+def mask_size(mask):
+    """
+    :return: number of tiles in every mask of an array of shape (..., 8)
+    """
+    mask = np.ascontiguousarray(mask)
+    return _POPCOUNT8[mask.view(np.uint8)].reshape(mask.shape[:-1] + (-1,)).sum(axis=-1)
+
+
+def single_mask(tile_id):
+    """
+    :return: mask of the set with just one tile
+    """
+    mask = np.zeros(MASK_WORDS, dtype=np.uint64)
+    mask[tile_id // 64] = np.uint64(1) << np.uint64(tile_id % 64)
+    return mask
+
+
+def mask_members(mask):
+    """
+    :return: sorted ids of the tiles in a single mask
+    """
+    return np.flatnonzero(unpack_mask(mask))
+
+
+def tile_codes(F):
+    """
+    :param F: bitmaps - array of shape (..., m, n)
+    :return: int array of the same shape with the id of the 3x3 tile centered at every pixel
+    """
+    F = np.asarray(F, dtype=np.int64)
+    codes = np.zeros(F.shape, dtype=np.int64)
+    for r in range(3):
+        for c in range(3):
+            codes |= np.roll(F, (1 - r, 1 - c), axis=(-2, -1)) << (3 * r + c)
+    return codes
+
 
 class TileGraph:
-    def __init__(self):
-        self.tiles, self.prev, self.horiz, self.verti = self.preprocess()
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        :param cache_dir: directory with the persisted tables (see load_tables), or None to build them in memory
+        """
+        tables = load_tables('tile_graph', TILE_GRAPH_VERSION, self.build_tables, cache_dir)
+        self.tiles = tables['tiles']
+        self.prev = [tables['prev_0'].tolist(), tables['prev_1'].tolist()]
+        self.horiz = tables['horiz']
+        self.verti = tables['verti']
+
+        # support[side][t] - mask of the tiles that can be put on the given side of tile t.
+        self.support = tables['support']
+        # prev_masks[c] - mask of self.prev[c], center_mask - mask of the tiles with central bit set.
+        self.prev_masks = tables['prev_masks']
+        self.center_mask = tables['center_mask']
+
+        # byte_support[side][k][v] - union of support[side][t] over the tiles t set in byte value v of the k-th byte of
+        # a mask, so allowed() is a lookup per byte instead of per tile.
+        per_byte = self.support.reshape(4, MASK_WORDS * 8, 1, 8, MASK_WORDS)
+        self.byte_support = np.bitwise_or.reduce(
+            np.where(_BYTE_BITS[None, None, :, :, None], per_byte, np.uint64(0)), axis=3)
+
+    @staticmethod
+    def build_tables():
+        T, B, horiz, verti = TileGraph.preprocess()
+        support = np.stack([
+            pack_mask(verti.T),  # UP: tiles i with verti[i, t]
+            pack_mask(verti),    # DOWN: tiles j with verti[t, j]
+            pack_mask(horiz.T),  # LEFT: tiles i with horiz[i, t]
+            pack_mask(horiz),    # RIGHT: tiles j with horiz[t, j]
+        ])
+        prev_masks = pack_mask(np.stack([np.isin(np.arange(len(T)), b) for b in B]))
+        center_mask = pack_mask(T[:, 1, 1])
+        return {
+            'tiles': T, 'prev_0': np.array(B[0]), 'prev_1': np.array(B[1]), 'horiz': horiz, 'verti': verti,
+            'support': support, 'prev_masks': prev_masks, 'center_mask': center_mask,
+        }
+
+    def initial_domains(self, F):
+        """
+        :param F: final bitmap (boolean matrix m x n)
+        :return: uint64 array of shape (m, n, 8) - mask of possible previous tiles for every pixel
+        """
+        return self.prev_masks[np.asarray(F, dtype=np.int64)].copy()
+
+    def search_state(self, F, isolate_wipeouts=False, dead=None):
+        """
+        :param isolate_wipeouts: see Propagator - the state is then returned even with some domains empty
+        :param dead: optional boolean matrix of the previous cells that have to be dead
+        :return: arc consistent SearchState of the final bitmap F, or None if some pixel has no possible tile
+        """
+        D = self.initial_domains(F)
+        if dead is not None:
+            D[np.asarray(dead, dtype=np.bool_)] &= ~self.center_mask
+        P = Propagator(self, D, isolate_wipeouts)
+        P.push_all()
+        return SearchState(self, D) if P.propagate() else None
+
+    def allowed(self, mask, side):
+        """
+        :param mask: set of tiles (mask)
+        :param side: UP, DOWN, LEFT or RIGHT
+        :return: mask of the tiles that can be put on the given side of at least one tile of the set
+        """
+        mask_bytes = np.ascontiguousarray(mask, dtype='<u8').view(np.uint8)
+        return np.bitwise_or.reduce(self.byte_support[side, _BYTE_POSITIONS, mask_bytes], axis=0)
 
     @staticmethod
     def preprocess():
-        # Tiles - all possible titles 3x3
-        T = list(generate_all(3, 3))
+        # Tiles - all possible titles 3x3.
+        # Tile i is packed as a 9-bit code: bit 3*r + c holds the pixel (r, c) - same order as generate_all(3, 3).
+        codes = np.arange(512)
+        T = ((codes[:, None] >> np.arange(9)) & 1).astype(np.bool_).reshape(512, 3, 3)
+        T.flags.writeable = False
         assert (len(T) == 512)
 
         # Backward possibilities
         # dict: central bit -> list of possible prev tiles 3x3
-        B = [[], []]
-        for i, tile in enumerate(T):
-            next_tile = life_step(tile)
-            B[int(next_tile[1][1])].append(i)
+        # Central bit of the next step: 3 live neighbours, or 2 live neighbours and alive already.
+        center = (codes >> 4) & 1
+        nbrs_count = np.array([bin(code).count('1') for code in codes & ~(1 << 4)])
+        next_center = (nbrs_count == 3) | ((center == 1) & (nbrs_count == 2))
+        B = [np.flatnonzero(~next_center).tolist(), np.flatnonzero(next_center).tolist()]
 
         # Fun fact:
         # >>> len(B[0])
@@ -34,27 +238,19 @@ class TileGraph:
         # 0 0 1     0 1 0    0 0 1 0
         # 0[1]0  +  1[0]0 =  0[1|0]0
         # 0 0 0     0 0 1    0 0 0 1
-        horiz = np.zeros((len(T), len(T)), dtype=np.bool)
+        # I.e. left tile's right side is equal to right tile's left side: columns 1,2 of the left tile shifted by one
+        # bit are columns 0,1 (mask 0b011011011) of the right tile.
+        cols_01 = 0b011011011
+        horiz = ((codes >> 1) & cols_01)[:, None] == (codes & cols_01)[None, :]
 
         # Matrix verti[i,j] - true if tile j can be put vertically under tile i.
-        verti = np.zeros((len(T), len(T)), dtype=np.bool)
+        # I.e. upper tile's rows 1,2 shifted by one row are rows 0,1 (mask 0b000111111) of the lower tile.
+        rows_01 = 0b000111111
+        verti = ((codes >> 3) & rows_01)[:, None] == (codes & rows_01)[None, :]
 
         # Diagonal relationships -- they don't seem to be needed.
-        #diago_se = np.zeros((len(T), len(T)), dtype=np.bool)
-        #diago_sw = np.zeros((len(T), len(T)), dtype=np.bool)
-        for i, x in enumerate(T):
-            for j, y in enumerate(T):
-                # Check if left tile is compatible with the right tile.
-                # I.e., left tile's right side is equal to right tile's left side.
-                horiz[i, j] = (x[:, (1, 2)] == y[:, (0, 1)]).all()
-
-                # Check if upper tile is compatible with the lower tile.
-                # I.e., upper tile's lower side is equal to lower tile's upper side.
-                verti[i, j] = (x[(1, 2), :] == y[(0, 1), :]).all()
-
-                # Diagonal relationships -- they don't seem to be needed.
-                #diago_se[i, j] = (x[(1, 2), (1, 2)] == y[(0, 1), (0, 1)]).all()
-                #diago_sw[i, j] = (x[(1, 2), (0, 1)] == y[(0, 1), (1, 2)]).all()
+        #diago_se[i, j] = (x[(1, 2), (1, 2)] == y[(0, 1), (0, 1)]).all()
+        #diago_sw[i, j] = (x[(1, 2), (0, 1)] == y[(0, 1), (1, 2)]).all()
 
         return T, B, horiz, verti
 
@@ -79,70 +275,907 @@ class TileGraph:
         return [x for x in X if any(C[x][y] for y in Y)]
 
 
+_tile_graph = None
+
+
+def get_tile_graph():
+    """
+    Lazily created process-wide TileGraph, backed by the on-disk cache.
+    """
+    global _tile_graph
+    if _tile_graph is None:
+        _tile_graph = TileGraph()
+    return _tile_graph
+
+
+# Bits of a 4x4 patch (bit 4r + c is cell (r, c)) with the 2x2 block in its middle, and the 4 3x3 tiles inside it.
+_PATCH_INNER = (5, 6, 9, 10)
+_PATCH_TILE_BITS = [[4 * (r0 + r) + c0 + c for r in range(3) for c in range(3)] for r0 in range(2) for c0 in range(2)]
+
+
+class BlockLayout:
+    """
+    Placement of 2x2 blocks on an m x n torus, with the overlaps between their 4x4 patches. Blocks start at rows (and
+    columns) 0, 2, 4, ... - on odd sizes the last block is moved one back, so it overlaps its neighbour by one row.
+    """
+    def __init__(self, shape):
+        self.shape = m, n = shape
+        assert m >= 4 and n >= 4, 'Blocks need boards of at least 4x4.'
+        self.rows = [min(2 * k, m - 2) for k in range((m + 1) // 2)]
+        self.cols = [min(2 * k, n - 2) for k in range((n + 1) // 2)]
+        self.grid = (len(self.rows), len(self.cols))
+
+        # Cells of the patch of every block, in the order of the patch bits.
+        self.patch_cells = [
+            [((i0 - 1 + r) % m, (j0 - 1 + c) % n) for r in range(4) for c in range(4)]
+            for i0 in self.rows for j0 in self.cols]
+
+        # overlaps[b] - list of (other block, bits of b, bits of the other block) over the shared cells, in the same
+        # order on both sides. Patches of the 8 surrounding blocks always overlap, the ones across the seam of an odd
+        # board may too.
+        covering = collections.defaultdict(list)
+        for b, cells in enumerate(self.patch_cells):
+            for bit, cell in enumerate(cells):
+                covering[cell].append((b, bit))
+        shared = collections.defaultdict(list)
+        for cell in sorted(covering):
+            for a, bit_a in covering[cell]:
+                for b, bit_b in covering[cell]:
+                    if a != b:
+                        shared[a, b].append((bit_a, bit_b))
+        self.overlaps = [[] for _ in self.patch_cells]
+        for (a, b), bits in sorted(shared.items()):
+            self.overlaps[a].append((b, tuple(bit for bit, _ in bits), tuple(bit for _, bit in bits)))
+
+    def stop_codes(self, F):
+        """
+        :return: code of the 2x2 block of F (bit 2r + c is cell (r, c)) for every block
+        """
+        F = np.asarray(F, dtype=np.int64)
+        return [sum(int(F[(i0 + r) % F.shape[0], (j0 + c) % F.shape[1]]) << (2 * r + c)
+                    for r in range(2) for c in range(2)) for i0 in self.rows for j0 in self.cols]
+
+
+class BlockGraph:
+    """
+    Coarser variant of TileGraph: a variable is a 2x2 block of the previous board and its values are the 4x4 patches
+    around it that evolve into the 2x2 block of the final bitmap. Neighbouring patches have to agree on the cells they
+    share, in all 8 directions, so a revision prunes much more than between the 3x3 tiles of single pixels.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        :param cache_dir: directory with the persisted tables (see load_tables), or None to build them in memory
+        """
+        tables = load_tables('block_graph', BLOCK_GRAPH_VERSION, self.build_tables, cache_dir)
+        # Patch codes grouped by the code of the 2x2 block they evolve into: group s is patches[offsets[s]:offsets[s+1]].
+        self.patches = tables['patches']
+        self.offsets = tables['offsets']
+
+        # 3x3 tiles (same ids as in TileGraph), so models trained on tiles can score patches.
+        codes = np.arange(512)
+        self.tiles = ((codes[:, None] >> np.arange(9)) & 1).astype(np.bool_).reshape(512, 3, 3)
+        all_patches = np.arange(1 << 16)
+        self.patch_tiles = np.stack(
+            [sum(((all_patches >> bit) & 1) << k for k, bit in enumerate(bits)) for bits in _PATCH_TILE_BITS], axis=1)
+
+        self._key_tables = {}
+        self._layouts = {}
+
+    @staticmethod
+    def build_tables():
+        codes = np.arange(1 << 16)
+        P = ((codes[:, None] >> np.arange(16)) & 1).astype(np.bool_).reshape(-1, 4, 4)
+        stop = np.zeros(len(codes), dtype=np.int64)
+        for r in range(2):
+            for c in range(2):
+                window = P[:, r:r + 3, c:c + 3]
+                count = window.sum(axis=(1, 2)) - window[:, 1, 1]
+                alive = (count == 3) | (window[:, 1, 1] & (count == 2))
+                stop |= alive.astype(np.int64) << (2 * r + c)
+        order = np.argsort(stop, kind='stable')
+        offsets = np.searchsorted(stop[order], np.arange(17))
+        return {'patches': order.astype(np.uint16), 'offsets': offsets}
+
+    def layout(self, shape):
+        shape = tuple(shape)
+        if shape not in self._layouts:
+            self._layouts[shape] = BlockLayout(shape)
+        return self._layouts[shape]
+
+    def key_table(self, bits):
+        """
+        :param bits: tuple of patch bits
+        :return: array: patch code -> the given bits packed into an int (k-th bit of the key is bits[k] of the patch)
+        """
+        if bits not in self._key_tables:
+            codes = np.arange(1 << 16)
+            self._key_tables[bits] = sum(((codes >> bit) & 1) << k for k, bit in enumerate(bits))
+        return self._key_tables[bits]
+
+    def initial_domains(self, F):
+        """
+        :return: BlockLayout of F and list of the possible patches (int arrays) of every block
+        """
+        layout = self.layout(np.shape(F))
+        domains = [self.patches[self.offsets[s]:self.offsets[s + 1]].astype(np.int64) for s in layout.stop_codes(F)]
+        return layout, domains
+
+    def revise(self, domain, other, bits, other_bits):
+        """
+        :return: patches of domain that agree with at least one patch of the other block on the shared cells
+        """
+        present = np.zeros(1 << len(bits), dtype=np.bool_)
+        present[self.key_table(other_bits)[other]] = True
+        return domain[present[self.key_table(bits)[domain]]]
+
+    def search_state(self, F, isolate_wipeouts=False):
+        """
+        :param isolate_wipeouts: see Propagator - the state is then returned even with some domains empty
+        :return: arc consistent BlockSearchState of the final bitmap F, or None if some block has no possible patch
+        """
+        layout, domains = self.initial_domains(F)
+        state = BlockSearchState(self, layout, domains, isolate_wipeouts)
+        return state if state.propagate(range(len(domains))) else None
+
+    def board(self, layout, patches):
+        """
+        :param patches: patch code of every block (or -1 to leave the block False)
+        :return: previous bitmap made of the middle 2x2 cells of the patches
+        """
+        A = np.zeros(layout.shape, dtype=int)
+        for b, patch in enumerate(patches):
+            if patch < 0:
+                continue
+            i0, j0 = layout.rows[b // layout.grid[1]], layout.cols[b % layout.grid[1]]
+            for k, bit in enumerate(_PATCH_INNER):
+                A[(i0 + k // 2) % layout.shape[0], (j0 + k % 2) % layout.shape[1]] = (patch >> bit) & 1
+        return A
+
+    def center_probability(self, layout, domains):
+        """
+        :param domains: patch codes left on every block
+        :return: fraction of the patches of the covering block with every cell alive (NaN where a domain is empty)
+        """
+        P = np.full(layout.shape, np.nan)
+        for b, domain in enumerate(domains):
+            if not len(domain):
+                continue
+            i0, j0 = layout.rows[b // layout.grid[1]], layout.cols[b % layout.grid[1]]
+            for k, bit in enumerate(_PATCH_INNER):
+                P[(i0 + k // 2) % layout.shape[0], (j0 + k % 2) % layout.shape[1]] = ((domain >> bit) & 1).mean()
+        return P
+
+
+class Propagator:
+    """
+    Shared AC-3 style constraint propagation engine for the tile-graph solvers.
+
+    Keeps a worklist of arcs (pixel, side) - "remove tiles of the pixel not supported by its neighbour on that side".
+    Only when a revision shrinks a domain, the arcs of the 4 neighbours pointing back at that pixel are enqueued, so the
+    work scales with the amount of change instead of board area times the number of full sweeps.
+    """
+    # side -> (row offset, column offset, side of the neighbour the pixel is on)
+    ARCS = {UP: (-1, 0, DOWN), DOWN: (1, 0, UP), LEFT: (0, -1, RIGHT), RIGHT: (0, 1, LEFT)}
+
+    def __init__(self, G, D, isolate_wipeouts=False):
+        """
+        :param G: TileGraph
+        :param D: domains - uint64 array of shape (m, n, 8), updated in place
+        :param isolate_wipeouts: if True, a pixel with an empty domain stops constraining its neighbours (so the failure
+            stays local) and propagation goes on; otherwise propagation stops at the first wipe-out
+        """
+        self.G = G
+        self.D = D
+        self.m, self.n = D.shape[0], D.shape[1]
+        self.isolate_wipeouts = isolate_wipeouts
+        self.queue = collections.deque()
+        self.queued = np.zeros((self.m, self.n, 4), dtype=np.bool_)
+
+        self.revisions = 0
+        self.wipeouts = 0
+
+    def stats(self):
+        return {'revisions': self.revisions, 'wipeouts': self.wipeouts}
+
+    def _push(self, i, j, side):
+        if not self.queued[i, j, side]:
+            self.queued[i, j, side] = True
+            self.queue.append((i, j, side))
+
+    def push_all(self):
+        for i in range(self.m):
+            for j in range(self.n):
+                for side in (UP, LEFT, RIGHT, DOWN):
+                    self._push(i, j, side)
+
+    def push_pixel(self, i, j, skip=None):
+        """
+        Enqueues the arcs of all neighbours pointing at (i, j) - call it after the domain of (i, j) has changed.
+        :param skip: side of (i, j) whose neighbour doesn't need to be revised
+        """
+        for side, (di, dj, back) in self.ARCS.items():
+            if side != skip:
+                self._push((i + di) % self.m, (j + dj) % self.n, back)
+
+    def revise(self, i, j, side):
+        """
+        :return: True if the domain of (i, j) has changed
+        """
+        di, dj, back = self.ARCS[side]
+        nb = self.D[(i + di) % self.m, (j + dj) % self.n]
+        if self.isolate_wipeouts and not nb.any():
+            return False
+
+        self.revisions += 1
+        cur = self.D[i, j]
+        new = cur & self.G.allowed(nb, back)
+        if (new == cur).all():
+            return False
+        self.D[i, j] = new
+        return True
+
+    def propagate(self):
+        """
+        Revises arcs until the worklist is empty.
+        :return: False if a domain got wiped out (unless isolate_wipeouts), True otherwise
+        """
+        while self.queue:
+            i, j, side = self.queue.popleft()
+            self.queued[i, j, side] = False
+            if not self.revise(i, j, side):
+                continue
+
+            if not self.D[i, j].any():
+                self.wipeouts += 1
+                if not self.isolate_wipeouts:
+                    return False
+                continue
+            self.push_pixel(i, j, skip=side)
+        return True
+
+
+class TensorProp:
+    """
+    Whole-board propagation on dense domain tensors: domains of a batch of boards are kept as a boolean tensor of shape
+    (boards, m, n, 512), and one round revises every pixel of every board against its 4 neighbours at once (neighbour
+    domains are fetched with np.roll, so the torus wrap comes for free). Rounds are repeated until nothing changes,
+    which gives the same arc-consistent domains as Propagator.
+
+    The support of a set of tiles on a side is the boolean product (D @ C) > 0 with C being horiz, verti or their
+    transposes. C only looks at the 6 pixels the two tiles share, so it's computed in factored form: the tile axis is
+    viewed as 9 bit axes, the 3 bits C ignores on the row side are OR-reduced, the remaining 64 classes are mapped
+    through a 64x64 matrix (a permutation for the 3x3 tiles) and broadcast back over the 3 bits C ignores on the
+    column side. No 512x512 product is ever materialized.
+    """
+    def __init__(self, G):
+        self.G = G
+        # (axis of the neighbour in the (boards, m, n) layout, roll shift, factored compatibility matrix)
+        # E.g. allowed(D[i-1, j], DOWN) has to land on (i, j), so it's rolled by +1 along the rows.
+        self.sides = [
+            (1, 1, self._factor(G.verti)),     # upper neighbour - tiles below it
+            (2, 1, self._factor(G.horiz)),     # left neighbour - tiles right of it
+            (2, -1, self._factor(G.horiz.T)),  # right neighbour - tiles left of it
+            (1, -1, self._factor(G.verti.T)),  # lower neighbour - tiles above it
+        ]
+        self.rounds = 0
+        self.wipeouts = 0
+
+    @staticmethod
+    def _factor(C):
+        codes = np.arange(C.shape[0])
+        row_free = [k for k in range(9) if (C == C[codes ^ (1 << k)]).all()]
+        col_free = [k for k in range(9) if (C == C[:, codes ^ (1 << k)]).all()]
+        rows = codes[(codes & sum(1 << k for k in row_free)) == 0]
+        cols = codes[(codes & sum(1 << k for k in col_free)) == 0]
+        K = C[rows][:, cols]
+        if (K.sum(axis=0) == 1).all() and (K.sum(axis=1) == 1).all():
+            K = K.argmax(axis=1)
+        else:
+            K = K.astype(np.float32)
+        return row_free, K, col_free
+
+    def initial(self, Fs):
+        """
+        :param Fs: final bitmaps - array of shape (boards, m, n)
+        :return: boolean tensor of shape (boards, m, n, 512) with possible previous tiles of every pixel
+        """
+        return unpack_mask(self.G.prev_masks)[np.asarray(Fs, dtype=np.int64)]
+
+    @staticmethod
+    def _reachable(D, row_free, K):
+        # Bit k of the tile code is axis -1 - k of the (..., 2, ..., 2) view. Going from the lowest bit up keeps the
+        # positions of the bits still to be reduced.
+        # With float D (weights of tiles instead of sets) it's the sum-product version: the weights are summed.
+        lead = D.ndim - 1
+        X = D.reshape(D.shape[:-1] + (2,) * 9)
+        for k in sorted(row_free):
+            axis = (slice(None),) * (lead + 8 - k)
+            X = X[axis + (0,)] + X[axis + (1,)]
+        classes = X.reshape(D.shape[:-1] + (-1,))
+        if K.dtype == np.float32:
+            return (classes.astype(np.float32) @ K) > 0 if D.dtype == np.bool_ else classes @ K
+        reachable = np.empty_like(classes)
+        reachable[..., K] = classes
+        return reachable
+
+    def _supported(self, D, dirty, isolate_wipeouts):
+        allowed = np.ones(D.shape[:-1] + (2,) * 9, dtype=np.bool_)
+        empty = ~D.any(axis=-1) if isolate_wipeouts else None
+        for axis, shift, (row_free, K, col_free) in self.sides:
+            reachable = self._reachable(D, row_free, K)
+            if isolate_wipeouts:
+                # Wiped out pixels don't constrain their neighbours.
+                reachable |= empty[..., None]
+            if dirty is not None:
+                # Only neighbours that have changed are looked at, like the arcs on the worklist of Propagator.
+                reachable |= ~dirty[..., None]
+            shape = D.shape[:-1] + tuple(1 if k in col_free else 2 for k in range(8, -1, -1))
+            allowed &= np.roll(reachable, shift, axis=axis).reshape(shape)
+        return allowed.reshape(D.shape)
+
+    def propagate(self, D, isolate_wipeouts=False, dirty=None):
+        """
+        :param D: domains - boolean tensor of shape (boards, m, n, 512), updated in place
+        :param isolate_wipeouts: see Propagator
+        :param dirty: optional boolean array (boards, m, n) with the pixels whose domains have changed - only their
+            neighbours get revised in the first round; by default all pixels are revised
+        :return: boolean array (boards,) - True for the boards where some domain got wiped out
+        """
+        if dirty is None:
+            active = np.arange(D.shape[0])
+        else:
+            active = np.flatnonzero(dirty.any(axis=(1, 2)))
+            dirty = dirty[active]
+
+        while len(active):
+            sub = D[active]
+            new = sub & self._supported(sub, dirty, isolate_wipeouts)
+            dirty = (new != sub).any(axis=-1)
+            D[active] = new
+            self.rounds += 1
+
+            changed = dirty.any(axis=(1, 2))
+            if not isolate_wipeouts:
+                # Nothing more to learn about boards that already have an empty domain.
+                changed &= new.any(axis=-1).all(axis=(1, 2))
+            active = active[changed]
+            dirty = dirty[changed]
+
+        wiped = ~D.any(axis=-1).all(axis=(1, 2))
+        self.wipeouts += int(wiped.sum())
+        return wiped
+
+    def stats(self):
+        return {'rounds': self.rounds, 'wipeouts': self.wipeouts}
+
+
+class SearchState:
+    """
+    Domains of a partially filled tile board for the exact search: assigned pixels have a single tile, the others the
+    tiles still consistent with them. Every change goes to a trail, so backtracking is just undoing the trail down to
+    a mark instead of copying the board.
+
+    For conflict-directed backjumping every pixel also keeps its culprits - a bitset of the search depths whose
+    assignments its current domain follows from (directly or through a chain of propagated changes).
+    """
+    def __init__(self, G, D):
+        """
+        :param G: TileGraph
+        :param D: initial domains - uint64 array of shape (m, n, 8), updated in place
+        """
+        self.G = G
+        self.D = D
+        self.m, self.n = D.shape[0], D.shape[1]
+        self.sizes = mask_size(D)
+        self.assigned = np.zeros((self.m, self.n), dtype=np.bool_)
+        self.culprits = np.zeros((self.m, self.n), dtype=object)
+        self.trail = []
+        # Culprits of the domain wiped out by the last failed assign().
+        self.conflict = 0
+
+    def select(self):
+        """
+        Minimum remaining values - the unassigned pixel with the fewest candidate tiles.
+        :return: (i, j) or None if all pixels are assigned
+        """
+        sizes = np.where(self.assigned, MASK_WORDS * 64 + 1, self.sizes)
+        i, j = np.unravel_index(np.argmin(sizes), sizes.shape)
+        return None if self.assigned[i, j] else (i, j)
+
+    def _set(self, i, j, mask, culprits):
+        self.trail.append((i, j, self.D[i, j].copy(), self.sizes[i, j], self.assigned[i, j], self.culprits[i, j]))
+        self.D[i, j] = mask
+        self.sizes[i, j] = mask_size(mask)
+        self.culprits[i, j] = culprits
+
+    def assign(self, i, j, tile_id, culprits=0):
+        """
+        Puts the tile on (i, j) and propagates the change: the 4 neighbours are forward checked and, if their domains
+        shrink, the change spreads further the same way as in Propagator.
+        :param culprits: culprits of the assignment - the bit of its own depth for a choice
+        :return: False if some pixel has no tile left - its culprits are left in self.conflict
+        """
+        self._set(i, j, single_mask(tile_id), culprits)
+        self.assigned[i, j] = True
+        queue = collections.deque([(i, j)])
+        while queue:
+            i, j = queue.popleft()
+            mask = self.D[i, j]
+            for side, (di, dj, back) in Propagator.ARCS.items():
+                ni, nj = (i + di) % self.m, (j + dj) % self.n
+                cur = self.D[ni, nj]
+                new = cur & self.G.allowed(mask, side)
+                if (new != cur).any():
+                    # The neighbour loses tiles because of this pixel's domain, so it inherits its culprits.
+                    self._set(ni, nj, new, self.culprits[ni, nj] | self.culprits[i, j])
+                    if self.sizes[ni, nj] == 0:
+                        self.conflict = self.culprits[ni, nj]
+                        return False
+                    queue.append((ni, nj))
+        return True
+
+    def undo(self, mark):
+        """
+        Reverts all the changes made after len(trail) was equal to mark.
+        """
+        while len(self.trail) > mark:
+            i, j, mask, size, assigned, culprits = self.trail.pop()
+            self.D[i, j] = mask
+            self.sizes[i, j] = size
+            self.assigned[i, j] = assigned
+            self.culprits[i, j] = culprits
+
+    def candidates(self, i, j):
+        """
+        :return: ids of the tiles left on (i, j)
+        """
+        return mask_members(self.D[i, j])
+
+    def tile_board(self):
+        """
+        :return: matrix m x n with id of a tile chosen on each pixel or -1 if not chosen yet
+        """
+        return np.where(self.assigned, unpack_mask(self.D).argmax(axis=-1), -1)
+
+    def board(self):
+        """
+        :return: previous bitmap given by the tiles of a fully assigned board
+        """
+        return self.G.tiles[self.tile_board()][:, :, 1, 1].astype(int)
+
+    def snapshot(self):
+        """
+        :return: copy of the current domains for center_probability
+        """
+        return self.D.copy()
+
+    def center_probability(self, D=None):
+        """
+        :param D: domains saved by snapshot() (the current ones by default)
+        :return: m x n matrix with the fraction of the tiles left on every pixel with the center alive (NaN if none)
+        """
+        U = unpack_mask(self.D if D is None else D)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (U @ _TILE_CENTERS) / U.sum(axis=-1)
+
+
+class BlockSearchState:
+    """
+    SearchState for a BlockGraph: variables are the blocks on a grid of BlockLayout.grid and domains are arrays of
+    patch codes. Same interface, so DFS can run on either.
+    """
+    def __init__(self, G, layout, domains, isolate_wipeouts=False):
+        """
+        :param isolate_wipeouts: see Propagator
+        """
+        self.G = G
+        self.isolate_wipeouts = isolate_wipeouts
+        self.layout = layout
+        self.m, self.n = layout.grid
+        self.D = domains
+        self.sizes = np.array([len(d) for d in domains], dtype=np.int64).reshape(layout.grid)
+        self.assigned = np.zeros(layout.grid, dtype=np.bool_)
+        self.culprits = np.zeros(layout.grid, dtype=object)
+        self.trail = []
+        self.conflict = 0
+
+    def select(self):
+        sizes = np.where(self.assigned, np.iinfo(np.int64).max, self.sizes)
+        i, j = np.unravel_index(np.argmin(sizes), sizes.shape)
+        return None if self.assigned[i, j] else (i, j)
+
+    def _set(self, b, domain, culprits):
+        i, j = divmod(b, self.n)
+        self.trail.append((b, self.D[b], self.assigned[i, j], self.culprits[i, j]))
+        self.D[b] = domain
+        self.sizes[i, j] = len(domain)
+        self.culprits[i, j] = culprits
+
+    def propagate(self, changed):
+        """
+        Revises the neighbours of the changed blocks until nothing changes.
+        :return: False if some block has no patch left - its culprits are left in self.conflict
+        """
+        queue = collections.deque(changed)
+        queued = set(queue)
+        while queue:
+            a = queue.popleft()
+            queued.discard(a)
+            if self.isolate_wipeouts and not len(self.D[a]):
+                continue
+            for b, bits_a, bits_b in self.layout.overlaps[a]:
+                new = self.G.revise(self.D[b], self.D[a], bits_b, bits_a)
+                if len(new) == len(self.D[b]):
+                    continue
+                culprits = self.culprits.flat[b] | self.culprits.flat[a]
+                self._set(b, new, culprits)
+                if not len(new):
+                    self.conflict = culprits
+                    if self.isolate_wipeouts:
+                        continue
+                    return False
+                if b not in queued:
+                    queued.add(b)
+                    queue.append(b)
+        return True
+
+    def assign(self, i, j, patch, culprits=0):
+        b = i * self.n + j
+        self._set(b, np.array([patch], dtype=np.int64), culprits)
+        self.assigned[i, j] = True
+        return self.propagate([b])
+
+    def undo(self, mark):
+        while len(self.trail) > mark:
+            b, domain, assigned, culprits = self.trail.pop()
+            i, j = divmod(b, self.n)
+            self.D[b] = domain
+            self.sizes[i, j] = len(domain)
+            self.assigned[i, j] = assigned
+            self.culprits[i, j] = culprits
+
+    def candidates(self, i, j):
+        return self.D[i * self.n + j]
+
+    def board(self):
+        return self.G.board(self.layout, [d[0] if len(d) else -1 for d in self.D])
+
+    def snapshot(self):
+        # Domains are replaced, never modified in place, so a shallow copy is enough.
+        return list(self.D)
+
+    def center_probability(self, D=None):
+        return self.G.center_probability(self.layout, self.D if D is None else D)
+
+
+class NogoodCache:
+    """
+    Bounded store of nogoods - sets of (pixel, tile) assignments that can't be all part of a solution - with LRU
+    eviction. Nogoods are indexed by their assignments, so checking a new assignment only looks at the nogoods that
+    contain it.
+    """
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.nogoods = collections.OrderedDict()
+        self.index = collections.defaultdict(set)
+
+        self.lookups = 0
+        self.hits = 0
+        self.learned = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'lookups': self.lookups, 'hits': self.hits, 'learned': self.learned, 'evictions': self.evictions,
+                'size': len(self.nogoods)}
+
+    def add(self, nogood):
+        """
+        :param nogood: iterable of (pixel, tile) pairs
+        """
+        nogood = frozenset(nogood)
+        if self.capacity <= 0 or not nogood:
+            return
+        if nogood in self.nogoods:
+            self.nogoods.move_to_end(nogood)
+            return
+
+        self.nogoods[nogood] = None
+        for assignment in nogood:
+            self.index[assignment].add(nogood)
+        self.learned += 1
+
+        if len(self.nogoods) > self.capacity:
+            evicted, _ = self.nogoods.popitem(last=False)
+            for assignment in evicted:
+                self.index[assignment].discard(evicted)
+                if not self.index[assignment]:
+                    del self.index[assignment]
+            self.evictions += 1
+
+    def find(self, assignment, is_assigned):
+        """
+        :param assignment: (pixel, tile) pair that is about to be made
+        :param is_assigned: function (pixel, tile) -> True if the pair is already part of the partial solution
+        :return: a nogood completed by the assignment or None
+        """
+        self.lookups += 1
+        for nogood in self.index.get(assignment, ()):
+            if all(other == assignment or is_assigned(*other) for other in nogood):
+                self.hits += 1
+                self.nogoods.move_to_end(nogood)
+                return nogood
+        return None
+
+
+def majority_board(G, F, dead=None):
+    """
+    Best guess of the anytime step_back methods once they run out of time or find no predecessor - every pixel gets
+    the center value of the majority of the tiles arc consistency leaves on it (a wiped out domain doesn't take the
+    others down with it), pixels without any tile stay as in F.
+    :param G: TileGraph or BlockGraph
+    :param dead: optional boolean matrix of the previous cells that have to be dead (TileGraph only)
+    :return: previous bitmap (int matrix of the same shape as F)
+    """
+    constraints = {} if dead is None else {'dead': dead}
+    P = G.search_state(F, isolate_wipeouts=True, **constraints).center_probability()
+    return np.where(np.isnan(P), F, P > 0.5).astype(int)
+
+
+def anytime_stats(stats, A, F, complete, tic, callback=None):
+    """
+    Adds the stats every anytime step_back reports - if the method ran to its end (complete), the forward-check
+    accuracy of the board and the seconds taken - and passes them to the progress callback.
+    :return: stats
+    """
+    stats.update(complete=bool(complete), accuracy=score(1, A, F), seconds=time.perf_counter() - tic)
+    if callback is not None:
+        callback(stats)
+    return stats
+
+
 class DFS:
     """
     Depth-First Search - examines all possible paths of compatible tiles until finding the solution.
     Slow but reliable.
-    """
-    def __init__(self, tile_graph=None):
-        self.G = tile_graph if tile_graph is not None else TileGraph()
 
-    def step_back(self, F, verbose=False):
+    The next pixel is the one with the fewest candidate tiles left (MRV) and every assignment is forward checked
+    against the 4 neighbours, with the pruning spreading further as long as domains shrink - so dead ends show up as
+    soon as some domain gets empty instead of when the search reaches that pixel.
+
+    With a deadline it's an anytime method: once the time is up (or the board turns out to have no predecessor), it
+    returns the deepest partial assignment reached, with the pixels left filled by the center value of the majority of
+    their remaining tiles.
+    """
+    def __init__(self, tile_graph=None, value_order=None, nogood_cache_size=10000, max_nodes=None, time_budget=None,
+                 progress_nodes=1000, orphans=None):
+        """
+        :param tile_graph: TileGraph (a pixel per variable) or BlockGraph (a 2x2 block per variable)
+        :param value_order: optional function (F, i, j, tiles) -> tiles in the order they should be tried (i, j and
+            the tiles are block coordinates and patch codes with a BlockGraph); by default ids go in increasing order
+        :param nogood_cache_size: max number of learned nogoods kept per board (0 turns learning off)
+        :param max_nodes: optional limit of tried tiles per board, step_back raises TimeoutError once it's reached (with
+            a deadline or time_budget it returns the best board found instead, as when the time is up)
+        :param time_budget: optional limit in seconds per step back, see step_back's deadline
+        :param progress_nodes: the progress callback of step_back is called every that many nodes
+        :param orphans: optional OrphanIndex - boards containing one of its patterns aren't searched at all (batch jobs
+            rather scan whole batches at once, see orphans.OrphanRouter)
+        """
+        self.G = tile_graph if tile_graph is not None else get_tile_graph()
+        self.value_order = value_order
+        self.nogood_cache_size = nogood_cache_size
+        self.max_nodes = max_nodes
+        self.time_budget = time_budget
+        self.progress_nodes = progress_nodes
+        self.orphans = orphans
+        self.search_stats = {'nodes': 0, 'backtracks': 0, 'backjumps': 0}
+        self.nogoods = NogoodCache(nogood_cache_size)
+        self.best = None
+
+    def step_back(self, F, verbose=False, deadline=None, callback=None, dead=None):
         """
         :param F: final bitmap (boolean matrix)
-        :return:
+        :param deadline: optional time.perf_counter() value - with a deadline (or time_budget) the best board found
+            until then is returned instead of raising, search_stats tell if it's complete and its accuracy
+        :param callback: optional function called with the search stats every progress_nodes nodes and at the end
+        :param dead: optional boolean matrix of the previous cells that have to be dead (TileGraph only)
+        :return: previous bitmap (int matrix of the same shape as F)
         """
-        tile_board = np.full_like(F, -1, dtype=np.int)
-        r = self.dfs(F, tile_board, 0, 0, verbose)
-        if r is None:
+        tic = time.perf_counter()
+        if self.time_budget is not None:
+            deadline = min(deadline, tic + self.time_budget) if deadline is not None else tic + self.time_budget
+        self.search_stats = {'nodes': 0, 'backtracks': 0, 'backjumps': 0}
+        self.nogoods = NogoodCache(self.nogood_cache_size)
+
+        # Making the board arc consistent first is cheap and prunes a lot before any branching.
+        constraints = {} if dead is None else {'dead': dead}
+        orphan = self.orphans is not None and self.orphans.contains(F)
+        state = self.G.search_state(F, **constraints) if not orphan else None
+        if state is not None:
+            found = self.dfs(F, state, verbose, deadline=deadline, callback=callback)
+        else:
+            found = False
+            if deadline is not None:
+                # Nothing to search (a domain got wiped out or the board contains an orphan pattern), but the domains
+                # that didn't get wiped out still say something.
+                state = self.G.search_state(F, isolate_wipeouts=True, **constraints)
+                self.best = (0, state.snapshot())
+        self.search_stats['nogoods'] = self.nogoods.stats()
+        if not found and deadline is None:
             raise Exception('No previous state found.')
 
-        # Set central bit of the tile to the result bitmap.
-        A = np.array([[self.G.tiles[tile_board[i,j]][1][1] for j in range(tile_board.shape[1])] for i in range(tile_board.shape[0])])
+        if found:
+            A = state.board()
+        else:
+            # Undecided pixels get the majority center value of their tiles, ones without any tile stay as in F.
+            P = state.center_probability(self.best[1])
+            A = np.where(np.isnan(P), F, P > 0.5).astype(int)
+        anytime_stats(self.search_stats, A, F, found, tic, callback)
+        if verbose:
+            print(f'Search: {self.search_stats}')
+
         return A
 
-    def dfs(self, F, tile_board, i, j, verbose=False):
-        """
-        :param tile_board: matrix m x n with id of a tile chosen on each pixel or -1 if not chosen yet
-        :param i: current row
-        :param j: current column
-        :return: finished tile_board or None if couldn't find the path
-        """
-        m = len(F)
-        n = len(F[0])
-
-        if tile_board[i][j] != -1:
-            # Success!
-            # We have been here already, which means we have iterated over the whole board and found the solution.
-            assert i == 0 and j == 0
-            return tile_board
-
-        possible_tiles = self.G.prev[F[i][j]].copy()
-        if tile_board[i-1][j] != -1:
-            possible_tiles = self.G.get_compatible_Y([tile_board[i-1][j]], possible_tiles, self.G.verti)
-        if tile_board[i][j-1] != -1:
-            possible_tiles = self.G.get_compatible_Y([tile_board[i][j-1]], possible_tiles, self.G.horiz)
-        if tile_board[i][(j+1)%n] != -1:
-            possible_tiles = self.G.get_compatible_X(possible_tiles, [tile_board[i][(j+1)%n]], self.G.horiz)
-        if tile_board[(i+1)%m][j] != -1:
-            possible_tiles = self.G.get_compatible_X(possible_tiles, [tile_board[(i+1)%m][j]], self.G.verti)
-
-        # We're moving row by row.
-        # TODO: consider other patterns of movements - e.g. filling all the edges of a box (not sure if there's any
-        #   difference in speed though...)
-        next_j = (j + 1)%n
-        next_i = (i + 1)%m if next_j == 0 else i
-
-        for tile_id in tqdm(possible_tiles, disable=not verbose):
-            tile_board[i][j] = tile_id
-
-            # Not passing 'verbose' to the next steps on purpose.
-            if self.dfs(F, tile_board, next_i, next_j) is not None:
-                return tile_board
-
-        # Revert decision for this tile.
-        tile_board[i][j] = -1
-        return None
+    def predecessors(self, F, max_count=None, verbose=False, deadline=None):
+        """
+        Lazily enumerates distinct predecessors of F. The search goes on from where it found the previous one, so k
+        predecessors cost one search run further instead of k searches.
+        :param max_count: optional max number of predecessors
+        :param deadline: optional time.perf_counter() value - the enumeration just ends there
+        :return: generator of previous bitmaps (int matrices of the same shape as F)
+        """
+        self.search_stats = {'nodes': 0, 'backtracks': 0, 'backjumps': 0, 'solutions': 0}
+        self.nogoods = NogoodCache(self.nogood_cache_size)
+        state = self.G.search_state(F)
+        if state is None:
+            return
+
+        seen = set()
+        for _ in self.search(F, state, verbose, deadline=deadline):
+            A = state.board()
+            key = A.astype(np.bool_).tobytes()
+            if key in seen:
+                continue
+            seen.add(key)
+            self.search_stats['solutions'] = len(seen)
+            self.search_stats['nogoods'] = self.nogoods.stats()
+            yield A
+            if max_count is not None and len(seen) >= max_count:
+                return
+
+    def dfs(self, F, state, verbose=False, deadline=None, callback=None):
+        """
+        :param state: SearchState of the board - on success it's left with all the pixels assigned
+        :return: True if the board could be completed
+        """
+        return next(self.search(F, state, verbose, deadline, callback), False)
+
+    def search(self, F, state, verbose=False, deadline=None, callback=None):
+        """
+        Iterative search with an explicit stack - depth d holds the pixel assigned at that depth, its candidate tiles
+        and the trail mark to return to, all in arrays preallocated for the whole board, so board size isn't bounded by
+        the recursion limit.
+
+        Backtracking is conflict-directed: every depth collects the culprits of its failures (as a bitset of depths)
+        and once it runs out of tiles, the search jumps straight back to the deepest culprit, skipping the assignments
+        in between that had nothing to do with the failure. The culprit assignments are remembered as a nogood, so
+        the same dead end isn't searched again after the search comes back to it through another branch.
+
+        It's a generator: every time all the pixels are assigned, it yields True, and when resumed, goes on as if the
+        last tile had failed.
+        :param state: SearchState of the board - left with all the pixels assigned at every yield
+        :param deadline: optional time.perf_counter() value to stop at - the domains at the deepest point reached are
+            then left in self.best as (depth, state.snapshot())
+        :param callback: optional progress callback, see step_back
+        """
+        size = state.m * state.n
+        # Culprit bit of the subtrees a solution was found in - they didn't fail because of any assignment.
+        solved = 1 << size
+        cells = np.zeros((size, 2), dtype=np.int64)
+        candidates = [None] * size
+        num_candidates = np.zeros(size, dtype=np.int64)
+        next_candidate = np.zeros(size, dtype=np.int64)
+        marks = np.zeros(size, dtype=np.int64)
+        conflicts = [0] * size
+        # Tile and depth of the assignment on every pixel (valid where state.assigned is set).
+        tiles_on = np.zeros((state.m, state.n), dtype=np.int64)
+        depth_of = np.zeros((state.m, state.n), dtype=np.int64)
+
+        def is_assigned(pixel, tile_id):
+            return state.assigned[pixel] and tiles_on[pixel] == tile_id
+
+        def push(depth):
+            cell = state.select()
+            if cell is None:
+                return False
+            i, j = cell
+            tiles = state.candidates(i, j)
+            if self.value_order is not None:
+                tiles = self.value_order(F, i, j, tiles)
+            cells[depth] = cell
+            candidates[depth] = tiles
+            num_candidates[depth] = len(tiles)
+            next_candidate[depth] = 0
+            # Tiles missing from the domain are missing because of these.
+            conflicts[depth] = state.culprits[i, j]
+            return True
+
+        if not push(0):
+            yield True
+            return
+
+        tic = time.perf_counter()
+        self.best = (0, state.snapshot()) if deadline is not None else None
+        depth = 0
+        while True:
+            k = next_candidate[depth]
+            if k == num_candidates[depth]:
+                # All the tiles failed - the assignments in the conflict set can't be all part of a solution.
+                conflict = conflicts[depth] & ~(1 << depth)
+                if conflict & solved:
+                    # There was a solution below - nothing to learn and no assignment to skip.
+                    if depth == 0:
+                        return
+                    jump = depth - 1
+                else:
+                    if conflict == 0:
+                        return
+                    culprit_depths = [d for d in range(depth) if conflict >> d & 1]
+                    self.nogoods.add(((tuple(cells[d]), candidates[d][next_candidate[d] - 1]) for d in culprit_depths))
+                    # Revert everything down to the decision of the deepest culprit and try its next tile.
+                    jump = culprit_depths[-1]
+                    self.search_stats['backjumps'] += depth - jump - 1
+                self.search_stats['backtracks'] += 1
+                state.undo(marks[jump])
+                conflicts[jump] |= conflict & ~(1 << jump)
+                depth = jump
+                continue
+
+            next_candidate[depth] = k + 1
+            i, j = cells[depth]
+            tile_id = candidates[depth][k]
+            self.search_stats['nodes'] += 1
+            if self.max_nodes is not None and self.search_stats['nodes'] > self.max_nodes:
+                if deadline is not None:
+                    # Anytime search - running out of nodes ends it like running out of time.
+                    return
+                raise TimeoutError(f'No previous state found within {self.max_nodes} nodes.')
+            if deadline is not None and time.perf_counter() > deadline:
+                return
+            if callback is not None and self.search_stats['nodes'] % self.progress_nodes == 0:
+                callback(dict(self.search_stats, depth=depth, size=size, seconds=time.perf_counter() - tic,
+                              best_depth=self.best[0] if self.best is not None else None))
+
+            nogood = self.nogoods.find(((i, j), tile_id), is_assigned)
+            if nogood is not None:
+                for pixel, _ in nogood:
+                    if pixel != (i, j):
+                        conflicts[depth] |= 1 << depth_of[pixel]
+                self.search_stats['backtracks'] += 1
+                continue
+
+            # A pixel with a single tile left isn't a choice - it's forced by whatever emptied the rest of its domain.
+            forced = num_candidates[depth] == 1
+            marks[depth] = len(state.trail)
+            if not state.assign(i, j, tile_id, conflicts[depth] if forced else 1 << depth):
+                conflicts[depth] |= state.conflict & ~(1 << depth)
+                state.undo(marks[depth])
+                self.search_stats['backtracks'] += 1
+                continue
+            tiles_on[i, j] = tile_id
+            depth_of[i, j] = depth
+            if deadline is not None and depth + 1 > self.best[0]:
+                self.best = (depth + 1, state.snapshot())
+
+            if verbose and self.search_stats['nodes'] % 1000 == 0:
+                print(f'Depth {depth + 1}/{size}: {self.search_stats}, nogoods: {self.nogoods.stats()}')
+
+            depth += 1
+            if depth == size or not push(depth):
+                # Success!
+                yield True
+                depth -= 1
+                state.undo(marks[depth])
+                conflicts[depth] |= solved
 
 
 class DynamicProg:
@@ -151,67 +1184,73 @@ class DynamicProg:
     on one pixel may have "global" effects in a completely different place of the board.
     """
     def __init__(self, tile_graph=None):
-        self.G = tile_graph if tile_graph is not None else TileGraph()
+        self.G = tile_graph if tile_graph is not None else get_tile_graph()
+        self.search_stats = {}
 
-    def step_back(self, F, random=False, rseed=12345, verbose=False):
+    def step_back(self, F, random=False, rseed=12345, verbose=False, deadline=None, callback=None):
         """
         :param F: final bitmap (boolean matrix)
+        :param deadline: optional time.perf_counter() value - with a deadline a wipe-out or running out of time doesn't
+            raise, the majority center bit of the tiles left is returned instead (see DFS.step_back)
+        :param callback: optional function called with search_stats at the end
         :return: previous bitmap (boolean matrix of the same shape as F)
         """
+        tic = time.perf_counter()
+        self.search_stats = {}
 
-        # Sets of possible previous tiles per central pixel.
+        # Sets of possible previous tiles per central pixel (as tile masks).
         rs = np.random.RandomState(rseed)
         # rs.choice(self.B[F[i][j]], size=100, replace=False) if random else
-        S = [[self.G.prev[F[i][j]].copy() for j in range(F.shape[1])] for i in range(F.shape[0])]
+        S = self.G.initial_domains(F)
 
         def narrow_down():
+            sizes = mask_size(S)
             for i in range(m):
                 for j in range(n):
-                    if len(S[i][j]) > 1:
-                        S[i][j] = [S[i][j][0]]
+                    if sizes[i, j] > 1:
+                        # Keep just the first (lowest id) tile.
+                        S[i, j] = single_mask(mask_members(S[i, j])[0])
                         if verbose:
                             print(f'Narrowing down {i},{j}')
-                        return True
-            return False
-
-        m = len(S)
-        n = len(S[0])
+                        return i, j
+            return None
+
+        m = S.shape[0]
+        n = S.shape[1]
+        P = Propagator(self.G, S)
+        P.push_all()
+        complete = True
         while True:
             if verbose:
                 print('Loop!')
-            changed = False
-            for i in range(m):
-                for j in range(n):
-                    orig_size = len(S[i][j])
-                    S[i][j] = self.G.get_compatible_Y(S[i-1][j], S[i][j], self.G.verti)
-                    S[i][j] = self.G.get_compatible_Y(S[i][j-1], S[i][j], self.G.horiz)
-                    S[i][j] = self.G.get_compatible_X(S[i][j], S[i][(j+1)%n], self.G.horiz)
-                    S[i][j] = self.G.get_compatible_X(S[i][j], S[(i+1)%m][j], self.G.verti)
-
-                    #S[i][j] = self.G.get_compatible_X(S[i][j], S[(i+1)%m][(j+1)%n], self.diago_se)
-                    #S[i][j] = self.G.get_compatible_X(S[i][j], S[(i+1)%m][j-1], self.diago_sw)
-                    #S[i][j] = self.G.get_compatible_Y(S[i-1][j-1], S[i][j], self.diago_se)
-                    #S[i][j] = self.G.get_compatible_Y(S[i-1][(j+1)%n], S[i][j], self.diago_sw)
-                    if verbose:
-                        print(f'{i},{j}: {orig_size} -> {len(S[i][j])}')
-                    if len(S[i][j]) == 0:
-                        import pdb; pdb.set_trace()
-                    if len(S[i][j]) != orig_size:
-                        changed = True
-
-            if not changed and not narrow_down():
+            if not P.propagate():
+                if deadline is None:
+                    raise Exception('No previous state found.')
+                # A narrowing down went wrong - the tiles left on F before any of them still say something.
+                A = majority_board(self.G, F).astype(np.bool_)
+                complete = False
+                break
+            if deadline is not None and time.perf_counter() > deadline:
+                # Out of time - the pixels not narrowed down yet get the majority center value of their tiles.
+                A = mask_size(S & self.G.center_mask) / mask_size(S) > 0.5
+                complete = False
                 break
 
-        # Pick greedily one of the possible configurations of tiles.
-        A = np.zeros(F.shape, dtype=np.bool)
-        for i in range(m):
-            for j in range(n):
-                assert len(S[i][j]) == 1
-                tile_id = S[i][j][0]
+            narrowed = narrow_down()
+            if narrowed is None:
+                # Pick greedily one of the possible configurations of tiles.
+                assert (mask_size(S) == 1).all()
 
                 # Set central bit of the tile to the result bitmap.
-                A[i][j] = self.G.tiles[tile_id][1][1]
+                A = (S & self.G.center_mask).any(axis=-1)
+                break
+            P.push_pixel(*narrowed)
 
+        self.propagation_stats = P.stats()
+        anytime_stats(self.search_stats, A, F, complete, tic, callback)
+        if verbose:
+            print(f'Propagation: {self.propagation_stats}')
+            print(f'Search: {self.search_stats}')
         return A
 
 
@@ -220,69 +1259,135 @@ class ProbaHeur:
     Heuristic approach similar to DynamicProg. After finding initial plausible tile candidates, it just estimates
     probability of each pixel being '1' separately.
     """
-    def __init__(self, tile_graph=None):
-        self.G = tile_graph if tile_graph is not None else TileGraph()
+    def __init__(self, tile_graph=None, propagation='ac3'):
+        """
+        :param propagation: 'ac3' (Propagator) or 'tensor' (TensorProp - boards are solved in batches)
+        """
+        assert propagation in ('ac3', 'tensor')
+        self.G = tile_graph if tile_graph is not None else get_tile_graph()
+        self.propagation = propagation
+        self.search_stats = {}
 
-    def step_back(self, F, random=False, rseed=12345, verbose=False):
+    def step_back_batch(self, Fs, verbose=False):
+        """
+        :param Fs: final bitmaps - boolean array of shape (boards, m, n)
+        :return: previous bitmaps (boolean array of the same shape as Fs) - pixels of boards without any predecessor
+            whose domain got wiped out stay as in Fs
+        """
+        Fs = np.asarray(Fs, dtype=np.bool_)
+        TP = TensorProp(self.G)
+        D = TP.initial(Fs)
+        # A board without any predecessor doesn't take the rest of the batch down, its other pixels still get estimated.
+        TP.propagate(D, isolate_wipeouts=True)
+
+        self.propagation_stats = TP.stats()
+        if verbose:
+            print(f'Propagation: {self.propagation_stats}')
+
+        center = unpack_mask(self.G.center_mask)
+        sizes = D.sum(axis=-1)
+        proba = (D & center).sum(axis=-1) / np.maximum(sizes, 1)
+        return np.where(sizes > 0, proba > 0.5, Fs)
+
+    def step_back(self, F, random=False, rseed=12345, verbose=False, deadline=None, callback=None):
         """
         :param F: final bitmap (boolean matrix)
+        :param deadline: optional time.perf_counter() value - with a deadline a wipe-out doesn't raise, the majority
+            center bit of the domains that didn't get wiped out is returned instead (the estimate itself is a single
+            propagation, so it isn't cut short)
+        :param callback: optional function called with search_stats at the end
         :return: previous bitmap (boolean matrix of the same shape as F)
         """
-
-        # Sets of possible previous tiles per central pixel.
+        tic = time.perf_counter()
+        self.search_stats = {}
+        if self.propagation == 'tensor':
+            # Wiped out pixels are left as in F, so the batch never raises.
+            A = self.step_back_batch(np.asarray(F)[None], verbose=verbose)[0]
+            anytime_stats(self.search_stats, A, F, True, tic, callback)
+            return A
+
+        # Sets of possible previous tiles per central pixel (as tile masks).
         rs = np.random.RandomState(rseed)
         # rs.choice(self.B[F[i][j]], size=100, replace=False) if random else
-        S = [[self.G.prev[F[i][j]].copy() for j in range(F.shape[1])] for i in range(F.shape[0])]
+        S = self.G.initial_domains(F)
 
-        m = len(S)
-        n = len(S[0])
-        while True:
-            if verbose:
-                print('Loop!')
-            changed = False
-            for i in range(m):
-                for j in range(n):
-                    orig_size = len(S[i][j])
-                    S[i][j] = self.G.get_compatible_Y(S[i-1][j], S[i][j], self.G.verti)
-                    S[i][j] = self.G.get_compatible_Y(S[i][j-1], S[i][j], self.G.horiz)
-                    S[i][j] = self.G.get_compatible_X(S[i][j], S[i][(j+1)%n], self.G.horiz)
-                    S[i][j] = self.G.get_compatible_X(S[i][j], S[(i+1)%m][j], self.G.verti)
-                    if verbose:
-                        print(f'{i},{j}: {orig_size} -> {len(S[i][j])}')
-                    assert len(S[i][j]) > 0
-                    if len(S[i][j]) != orig_size:
-                        changed = True
-
-            if not changed:
-                break
+        P = Propagator(self.G, S)
+        P.push_all()
+        ok = P.propagate()
+        if not ok and deadline is None:
+            raise Exception('No previous state found.')
 
-        # Pick the most probable pixel on each position.
-        A = np.zeros(F.shape, dtype=np.bool)
-        for i in range(m):
-            for j in range(n):
-                tiles = (self.G.tiles[tile_id] for tile_id in S[i][j])
-                proba = np.mean([t[1][1] for t in tiles])
+        self.propagation_stats = P.stats()
+        if verbose:
+            print(f'Propagation: {self.propagation_stats}')
 
-                # Set central bit of the tile to the result bitmap.
-                A[i][j] = proba > 0.5
+        if ok:
+            # Pick the most probable pixel on each position.
+            proba = mask_size(S & self.G.center_mask) / mask_size(S)
 
+            # Set central bit of the tile to the result bitmap.
+            A = proba > 0.5
+        else:
+            A = majority_board(self.G, F).astype(np.bool_)
+        anytime_stats(self.search_stats, A, F, ok, tic, callback)
         return A
 
 
+class TransValueOrder:
+    """
+    DFS value order from the transition counts of ProbaHeur2: candidate tiles of a pixel are tried from the one most
+    often seen before its stop tile. The ranking of the start tiles is precomputed for every stop tile, so ordering the
+    candidates is a lookup and an argsort. On a BlockGraph, patches go by the sum of the ranks of their 4 tiles.
+    """
+    def __init__(self, G, order):
+        """
+        :param order: array (tiles, tiles) - see ProbaHeur2.candidate_order
+        """
+        self.G = G
+        self.rank = np.empty(order.shape, dtype=np.int64)
+        self.rank[np.arange(len(order))[:, None], order] = np.arange(order.shape[1])
+        self._F = None
+        self._stop_tiles = None
+
+    def __call__(self, F, i, j, tiles):
+        if F is not self._F:
+            self._F = F
+            self._stop_tiles = tile_codes(F)
+        tiles = np.asarray(tiles)
+        if isinstance(self.G, BlockGraph):
+            layout = self.G.layout(np.shape(F))
+            i0, j0 = layout.rows[i], layout.cols[j]
+            stop = [self._stop_tiles[(i0 + k // 2) % layout.shape[0], (j0 + k % 2) % layout.shape[1]] for k in range(4)]
+            ranks = self.rank[stop, self.G.patch_tiles[tiles]].sum(axis=-1)
+        else:
+            ranks = self.rank[self._stop_tiles[i, j], tiles]
+        return tiles[np.argsort(ranks, kind='stable')]
+
+
 class ProbaHeur2:
     """
     Heuristic approach similar to DynamicProg. After finding initial plausible tile candidates, it just estimates
     probability of each pixel being '1' separately.
     """
-    def __init__(self, tile_graph=None):
-        self.G = tile_graph if tile_graph is not None else TileGraph()
+    def __init__(self, tile_graph=None, propagation='ac3'):
+        """
+        :param tile_graph: TileGraph, or BlockGraph to decide 2x2 blocks (with the 'ac3' propagation only)
+        :param propagation: 'ac3' (Propagator) or 'tensor' (TensorProp - boards are solved in batches)
+        """
+        assert propagation in ('ac3', 'tensor')
+        self.G = tile_graph if tile_graph is not None else get_tile_graph()
+        self.propagation = propagation
+        assert not (isinstance(self.G, BlockGraph) and propagation == 'tensor')
 
         self.tile_to_id = {self.G.tiles[i].tobytes(): i for i in range(len(self.G.tiles))}
 
         self.trans = np.zeros((len(self.G.tiles), len(self.G.tiles)))
+        self.order = None
+        self.search_stats = {}
 
 
     def train(self, delta, start, stop):
+        self.order = None
         X = start
 
         m = X.shape[0]
@@ -298,10 +1403,27 @@ class ProbaHeur2:
 
     def load_model(self, path):
         with np.load(path) as data:
-            self.trans = data['arr_0']
+            # Older models were saved as a single unnamed array.
+            self.trans = data['trans'] if 'trans' in data else data['arr_0']
+            self.order = data['order'] if 'order' in data else None
 
     def save_model(self, path):
-        np.savez(path, trans=self.trans)
+        np.savez(path, trans=self.trans, order=self.candidate_order())
+
+    def candidate_order(self):
+        """
+        :return: array (tiles, tiles) - row b lists the start tiles from the one most often seen before stop tile b
+            (ties in increasing id order, as DFS tries them by default)
+        """
+        if self.order is None:
+            self.order = np.argsort(-self.trans.T, axis=1, kind='stable').astype(np.int16)
+        return self.order
+
+    def value_order(self):
+        """
+        :return: value order for DFS trying the tiles in the order of the transition counts
+        """
+        return TransValueOrder(self.G, self.candidate_order())
 
     def __get_tile_id(self, X, i, j):
         a = np.array(np.roll(np.roll(X, 1-i, axis=0), 1-j, axis=1)[:3,:3], dtype=np.bool)
@@ -309,42 +1431,158 @@ class ProbaHeur2:
         return a_id
 
     def predict(self, delta, stop):
+        if self.propagation == 'tensor':
+            return self.predict_batch([delta], np.asarray(stop)[None])[0]
+
         X = stop
         for _ in range(delta):
             X = self.step_back(X, verbose=False)
         return X
 
-    def step_back(self, F, random=False, rseed=12345, verbose=False):
+    def predict_batch(self, deltas, stops):
+        """
+        :param deltas: number of steps back for every board
+        :param stops: final bitmaps - array of shape (boards, m, n)
+        :return: boolean array of the same shape as stops
+        """
+        deltas = np.asarray(deltas)
+        X = np.array(stops, dtype=np.bool_)
+        for s in range(deltas.max(initial=0)):
+            sel = deltas > s
+            X[sel] = self.step_back_batch(X[sel])
+        return X
+
+    def step_back_batch(self, Fs, verbose=False):
+        """
+        Same as step_back with the 'tensor' propagation, for a batch of boards at once.
+        :param Fs: final bitmaps - boolean array of shape (boards, m, n)
+        :return: previous bitmaps (boolean array of the same shape as Fs)
+        """
+        TP = TensorProp(self.G)
+        D = TP.initial(Fs)
+        f_tiles = tile_codes(Fs)
+        dirty = np.zeros(D.shape[:-1], dtype=np.bool_)
+
+        while True:
+            undecided = D.sum(axis=-1) > 1
+            if not undecided.any():
+                break
+
+            for b in np.flatnonzero(undecided.any(axis=(1, 2))):
+                # The same ranking as narrow_down in step_back: the most likely tile given the transition counts,
+                # sorted by (tile, i, j) in descending order.
+                i, j = np.nonzero(undecided[b])
+                trans_counts = self.trans[:, f_tiles[b, i, j]].T
+                p = np.where(D[b, i, j], trans_counts, -1).argmax(axis=-1)
+                order = np.lexsort((j, i, p))[::-1]
+                i, j, p = i[order], j[order], p[order]
+
+                stop = np.flatnonzero((p != p[0]) & (np.arange(len(p)) > len(p) // 2))
+                k = stop[0] + 1 if len(stop) else len(p)
+                D[b, i[:k], j[:k]] = False
+                D[b, i[:k], j[:k], p[:k]] = True
+                dirty[b, i[:k], j[:k]] = True
+
+            if verbose:
+                print('Loop!')
+            TP.propagate(D, isolate_wipeouts=True, dirty=dirty)
+            dirty[:] = False
+
+        self.propagation_stats = TP.stats()
+        if verbose:
+            print(f'Propagation: {self.propagation_stats}')
+
+        return (D & unpack_mask(self.G.center_mask)).any(axis=-1)
+
+    def step_back_blocks(self, F, verbose=False, deadline=None):
+        """
+        step_back on a BlockGraph: a patch is scored by the transition counts of the 4 tiles around its middle cells,
+        the best scoring half of the undecided blocks is fixed and the choice propagated, until all blocks are decided.
+        :param deadline: optional time.perf_counter() value - the blocks still undecided then get the majority value of
+            their patches
+        :return: (previous bitmap, True if all the blocks got decided before the deadline)
+        """
+        m, n = np.shape(F)
+        layout, domains = self.G.initial_domains(F)
+        state = BlockSearchState(self.G, layout, domains, isolate_wipeouts=True)
+        state.propagate(range(len(domains)))
+
+        # Stop tiles of the 4 middle cells of every block and log P(start tile | stop tile) with add-one smoothing.
+        f_tiles = tile_codes(F)
+        stop_tiles = np.array([[f_tiles[(i0 + k // 2) % m, (j0 + k % 2) % n] for k in range(4)]
+                               for i0 in layout.rows for j0 in layout.cols])
+        log_p = np.log(self.trans + 1) - np.log(self.trans.sum(axis=0) + len(self.trans))
+
+        while True:
+            if deadline is not None and time.perf_counter() > deadline:
+                P = self.G.center_probability(layout, state.D)
+                return np.where(np.isnan(P), F, P > 0.5).astype(np.bool_), False
+            ranking = []
+            for b, domain in enumerate(state.D):
+                if len(domain) > 1:
+                    scores = log_p[self.G.patch_tiles[domain], stop_tiles[b]].sum(axis=-1)
+                    k = np.argmax(scores)
+                    ranking.append((scores[k], b, domain[k]))
+            if not ranking:
+                break
+            ranking.sort(reverse=True)
+
+            if verbose:
+                print(f'{len(ranking)}')
+
+            chosen = ranking[:max(1, len(ranking) // 2)]
+            for _, b, patch in chosen:
+                state._set(b, np.array([patch], dtype=np.int64), 0)
+            state.propagate([b for _, b, _ in chosen])
+
+        return self.G.board(layout, [d[0] if len(d) else -1 for d in state.D]).astype(np.bool_), True
+
+    def step_back(self, F, random=False, rseed=12345, verbose=False, deadline=None, callback=None):
         """
         :param F: final bitmap (boolean matrix)
+        :param deadline: optional time.perf_counter() value - once it's reached, the narrowing down stops and the
+            pixels left undecided get the majority center value of their tiles (the 'tensor' propagation isn't cut short)
+        :param callback: optional function called with search_stats at the end
         :return: previous bitmap (boolean matrix of the same shape as F)
         """
+        tic = time.perf_counter()
+        self.search_stats = {}
+        if isinstance(self.G, BlockGraph):
+            A, complete = self.step_back_blocks(F, verbose=verbose, deadline=deadline)
+            anytime_stats(self.search_stats, A, F, complete, tic, callback)
+            return A
+        if self.propagation == 'tensor':
+            A = self.step_back_batch(np.asarray(F)[None], verbose=verbose)[0]
+            anytime_stats(self.search_stats, A, F, True, tic, callback)
+            return A
 
         m = F.shape[0]
         n = F.shape[1]
 
-        # Sets of possible previous tiles per central pixel.
+        # Sets of possible previous tiles per central pixel (as tile masks).
         rs = np.random.RandomState(rseed)
         # rs.choice(self.B[F[i][j]], size=100, replace=False) if random else
-        S = [[self.G.prev[F[i][j]].copy() for j in range(n)] for i in range(m)]
+        S = self.G.initial_domains(F)
 
         f_tiles = [[self.__get_tile_id(F, i, j) for j in range(n)] for i in range(m)]
 
         def narrow_down():
             ranking = []
+            sizes = mask_size(S)
             for i in range(m):
                 for j in range(n):
-                    if len(S[i][j]) > 1:
+                    if sizes[i, j] > 1:
                         b_id = f_tiles[i][j]
+                        members = mask_members(S[i, j])
                         # transition counts to b:
-                        trans_counts = np.array([self.trans[s, b_id] for s in S[i][j]])
+                        trans_counts = self.trans[members, b_id]
 
                         # TODO: hmm it's interesting I haven't seen div by zero here?
                         trans_p = trans_counts / np.sum(trans_counts)
                         max_s_k = np.argmax(trans_p)
 
                         # TODO: we also use p == 0... should we change that?
-                        max_p = S[i][j][max_s_k]
+                        max_p = members[max_s_k]
                         ranking.append((max_p,i,j,max_s_k))
 
             ranking.sort(reverse=True)
@@ -353,46 +1591,452 @@ class ProbaHeur2:
                 print(f'{len(ranking)}')
 
             for r_idx, (p,i,j,k) in enumerate(ranking):
-                S[i][j] = [S[i][j][k]]
+                S[i, j] = single_mask(p)
+                P.push_pixel(i, j)
                 if np.abs(p - ranking[0][0]) > 0.0001 and r_idx > len(ranking)//2:
                     break
 
             return len(ranking) > 0
 
-        while narrow_down():
+        # Wiped out pixels just end up as False, so they shouldn't take their neighbours down with them.
+        P = Propagator(self.G, S, isolate_wipeouts=True)
+        complete = True
+        while True:
+            if deadline is not None and time.perf_counter() > deadline:
+                complete = False
+                break
+            if not narrow_down():
+                break
             if verbose:
                 print('Loop!')
+            P.propagate()
+
+        self.propagation_stats = P.stats()
+        if verbose:
+            print(f'Propagation: {self.propagation_stats}')
+
+        if complete:
+            # Pick the most probable pixel on each position.
+            # Every domain has at most one tile left - empty ones give False.
+            A = (S & self.G.center_mask).any(axis=-1)
+        else:
+            sizes = mask_size(S)
+            A = np.where(sizes > 0, mask_size(S & self.G.center_mask) / np.maximum(sizes, 1) > 0.5, F)
+        anytime_stats(self.search_stats, A, F, complete, tic, callback)
+        return A
 
-            for _ in range(2):
-                changed = False
-
-                # narrow down tile based on trans
-                for i in range(m):
-                    for j in range(n):
-                        orig_size = len(S[i][j])
-                        S[i][j] = self.G.get_compatible_Y(S[i-1][j], S[i][j], self.G.verti)
-                        S[i][j] = self.G.get_compatible_Y(S[i][j-1], S[i][j], self.G.horiz)
-                        S[i][j] = self.G.get_compatible_X(S[i][j], S[i][(j+1)%n], self.G.horiz)
-                        S[i][j] = self.G.get_compatible_X(S[i][j], S[(i+1)%m][j], self.G.verti)
-                        #if verbose:
-                        #    print(f'{i},{j}: {orig_size} -> {len(S[i][j])}')
-                        if len(S[i][j]) != orig_size:
-                            changed = True
-
-                if not changed:
-                    break
 
-        # Pick the most probable pixel on each position.
-        A = np.zeros(F.shape, dtype=np.bool)
-        for i in range(m):
-            for j in range(n):
-                #assert len(S[i][j]) <= 1
-                pixel = self.G.tiles[S[i][j][0]][1][1] if len(S[i][j]) != 0 else False
-                # Set central bit of the tile to the result bitmap.
-                A[i][j] = pixel
+class BeliefProp:
+    """
+    Loopy sum-product belief propagation on the tile graph. ProbaHeur counts every tile left in a domain equally,
+    here a tile counts by how well it's supported by the tiles of its neighbours, which are weighted the same way.
+
+    Messages are dense tensors of shape (boards, m, n, 512) - one per side, with the weights of the tiles of every
+    pixel as seen by its neighbour on that side. A round recomputes all of them at once with the factored products of
+    TensorProp, so the cost is a fixed number of vectorized rounds without any search.
+    """
+    def __init__(self, tile_graph=None, trans=None, rounds=30, damping=0.5, tol=1e-4):
+        """
+        :param trans: transition counts of ProbaHeur2 (start tile x stop tile) or a trained ProbaHeur2 - the tile
+            priors given the stop tile are P(start tile | stop tile) with add-one smoothing (all zero counts give
+            uniform priors); the model in DEFAULT_PROBA_HEUR2_MODEL by default
+        :param rounds: max number of rounds
+        :param damping: weight of the old message in the update (helps against oscillations on the loopy torus)
+        :param tol: converged once no message entry changes by more than this
+        """
+        self.G = tile_graph if tile_graph is not None else get_tile_graph()
+        self.TP = TensorProp(self.G)
+        if trans is None:
+            trans = ProbaHeur2(self.G)
+            trans.load_model(DEFAULT_PROBA_HEUR2_MODEL)
+        trans = np.asarray(trans.trans if isinstance(trans, ProbaHeur2) else trans, dtype=np.float64)
+        # prior[stop tile, start tile]
+        self.prior = ((trans + 1) / (trans.sum(axis=0) + len(trans))).T
+        self.rounds = rounds
+        self.damping = damping
+        self.tol = tol
+        self.bp_stats = {}
+        self.search_stats = {}
+
+    def _pass(self, H, side):
+        # Sum of the weights of the tiles compatible with every tile on the given side, broadcast back to 512 tiles.
+        axis, shift, (row_free, K, col_free) = self.TP.sides[side]
+        shape = H.shape[:-1] + tuple(1 if k in col_free else 2 for k in range(8, -1, -1))
+        full = np.broadcast_to(self.TP._reachable(H, row_free, K).reshape(shape), H.shape[:-1] + (2,) * 9)
+        return np.roll(full.reshape(H.shape), shift, axis=axis)
+
+    @staticmethod
+    def _normalize(M):
+        total = M.sum(axis=-1, keepdims=True)
+        empty = total[..., 0] == 0
+        total[empty] = 1
+        M /= total
+        # A wiped out pixel sends no information instead of taking its neighbours down with it.
+        M[empty] = 1 / M.shape[-1]
+        return M
+
+    def beliefs(self, Fs, deadline=None):
+        """
+        :param Fs: final bitmaps - boolean array of shape (boards, m, n)
+        :param deadline: optional time.perf_counter() value - no more rounds are started after it
+        :return: normalized tile beliefs - array of shape (boards, m, n, 512)
+        """
+        D = self.TP.initial(Fs)
+        self.TP.propagate(D, isolate_wipeouts=True)
+        phi = np.where(D, self.prior[tile_codes(Fs)], 0).astype(np.float32)
+
+        # M[s] - messages from the neighbours in the order of TensorProp.sides: upper, left, right and lower. The
+        # neighbour on side s leaves out the message it got back from the pixel, which is its M[3 - s].
+        M = np.full((4,) + D.shape, 1 / D.shape[-1], dtype=np.float32)
+        delta = np.inf
+        rounds = 0
+        timed_out = False
+        while rounds < self.rounds and delta > self.tol:
+            if deadline is not None and time.perf_counter() > deadline:
+                timed_out = True
+                break
+            # Products of phi and all the messages but one from prefix and suffix products.
+            head = [phi]
+            for t in range(3):
+                head.append(head[-1] * M[t])
+            tail = [M[3]]
+            for t in (2, 1):
+                tail.insert(0, M[t] * tail[0])
+            leave_out = [head[t] * tail[t] for t in range(3)] + [head[3]]
+
+            new = np.stack([self._normalize(self._pass(leave_out[3 - s], s)) for s in range(4)])
+            new = self.damping * M + (1 - self.damping) * new
+            delta = np.abs(new - M).max()
+            M = new
+            rounds += 1
+
+        self.bp_stats = {'rounds': rounds, 'delta': float(delta), 'converged': delta <= self.tol,
+                         'timed_out': timed_out}
+        return self._normalize(phi * M[0] * M[1] * M[2] * M[3])
+
+    def marginals(self, Fs, deadline=None):
+        """
+        :param deadline: see beliefs
+        :return: probability of every previous cell being alive - array of shape (boards, m, n)
+        """
+        B = self.beliefs(Fs, deadline)
+        return B @ self.G.tiles[:, 1, 1].astype(B.dtype)
+
+    def step_back_batch(self, Fs, threshold=0.5, verbose=False, deadline=None):
+        """
+        :param Fs: final bitmaps - boolean array of shape (boards, m, n)
+        :param deadline: see beliefs
+        :return: previous bitmaps (boolean array of the same shape as Fs)
+        """
+        P = self.marginals(Fs, deadline)
+        if verbose:
+            print(f'Belief propagation: {self.bp_stats}')
+        return P > threshold
+
+    def step_back(self, F, threshold=0.5, verbose=False, deadline=None, callback=None):
+        """
+        :param F: final bitmap (boolean matrix)
+        :param deadline: optional time.perf_counter() value - the marginals of the last round done by then are used
+        :param callback: optional function called with search_stats at the end
+        :return: previous bitmap (boolean matrix of the same shape as F)
+        """
+        tic = time.perf_counter()
+        self.search_stats = {}
+        A = self.step_back_batch(np.asarray(F)[None], threshold, verbose, deadline)[0]
+        anytime_stats(self.search_stats, A, F, not self.bp_stats['timed_out'], tic, callback)
+        return A
+
+    def predict(self, delta, stop):
+        X = np.asarray(stop, dtype=np.bool_)
+        for _ in range(delta):
+            X = self.step_back(X)
+        return X
+
+
+class MultiStepSearch:
+    """
+    Exact reversal over several generations. Instead of stepping back greedily (one predecessor per generation), it
+    keeps up to `branching` predecessors of every intermediate board and when a board turns out to have no predecessor,
+    it backtracks to the next predecessor of the generation after it instead of restarting the whole search.
 
+    Predecessors are memoized by board hash, together with dead ends (boards with none). Square boards are hashed by
+    their canonical form under the torus symmetries, so shifted or mirrored copies of a board are reversed only once.
+    """
+    def __init__(self, tile_graph=None, branching=4, max_nodes=20000, memo_size=10000, rseed=12345, orphans=None):
+        """
+        :param tile_graph: TileGraph or BlockGraph for the DFS doing the single steps
+        :param branching: max number of predecessors kept per board
+        :param max_nodes: node limit of every single-step DFS - a board running out of it is treated as a dead end,
+            since proving that a board has no predecessor at all can take much longer than finding one
+        :param memo_size: max number of boards in the memo (least recently used ones are dropped)
+        :param orphans: optional OrphanIndex - boards containing one of its patterns are dead ends without any search
+        """
+        self.G = tile_graph if tile_graph is not None else get_tile_graph()
+        self.branching = branching
+        self.max_nodes = max_nodes
+        self.memo_size = memo_size
+        self.rseed = rseed
+        self.orphans = orphans
+        self.memo = collections.OrderedDict()
+        self.search_stats = {'steps': 0, 'backtracks': 0, 'memo_hits': 0, 'memo_misses': 0, 'gave_up': 0}
+
+    @staticmethod
+    def board_key(X):
+        """
+        :return: (hash key, symmetry id mapping X to its canonical form or None if X isn't square)
+        """
+        if X.shape[0] != X.shape[1]:
+            return (X.shape, X.tobytes()), None
+        keys, transforms = canonicalize(X[None], bits=128)
+        return (X.shape, keys[0].tobytes()), transforms[0]
+
+    def _extend(self, entry):
+        """
+        Looks for one more predecessor of the memoized board - the first DFS tries the tiles in the default order, the
+        next ones in random orders (with the domains mostly forced after the first few assignments, they still end up
+        in different predecessors).
+        :return: False if there's no point in trying again
+        """
+        entry['attempts'] += 1
+        rs = entry['random']
+        value_order = None if entry['attempts'] == 1 else (lambda F, i, j, tiles: rs.permutation(tiles))
+        try:
+            A = DFS(self.G, value_order=value_order, max_nodes=self.max_nodes, orphans=self.orphans).step_back(
+                entry['board'])
+        except TimeoutError:
+            if entry['attempts'] == 1:
+                self.search_stats['gave_up'] += 1
+                return False
+            return entry['attempts'] < 2 * self.branching
+        except Exception:
+            return False
+
+        A = A.astype(np.bool_)
+        if not any((A == B).all() for B in entry['found']):
+            entry['found'].append(A)
+        return len(entry['found']) < self.branching and entry['attempts'] < 2 * self.branching
+
+    def predecessors(self, X):
+        """
+        Lazily yields up to `branching` distinct predecessors of X, the DFS runs only when all the already found ones
+        have been used.
+        """
+        X = np.asarray(X, dtype=np.bool_)
+        key, transform = self.board_key(X)
+        if key in self.memo:
+            self.search_stats['memo_hits'] += 1
+            self.memo.move_to_end(key)
+        else:
+            self.search_stats['memo_misses'] += 1
+            C = apply_symmetry(X[None], [transform])[0] if transform is not None else X
+            self.memo[key] = {'board': C, 'found': [], 'attempts': 0, 'more': True,
+                              'random': np.random.RandomState(self.rseed)}
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        entry = self.memo[key]
+
+        back = inverse_symmetry([transform], X.shape[0]) if transform is not None else None
+        k = 0
+        while True:
+            if k == len(entry['found']):
+                if not entry['more']:
+                    return
+                entry['more'] = self._extend(entry)
+                continue
+            # Predecessors are stored for the canonical board - they're mapped back the same way.
+            A = entry['found'][k]
+            yield apply_symmetry(A[None], back)[0] if back is not None else A
+            k += 1
+
+    def predict(self, delta, stop):
+        """
+        :return: start bitmap that evolves into stop in delta steps
+        """
+        path = [np.asarray(stop, dtype=np.bool_)]
+        candidates = [self.predecessors(path[0])] if delta > 0 else []
+        while len(path) <= delta:
+            P = next(candidates[-1], None)
+            if P is None:
+                # Every predecessor of this board led to a dead end - go one generation forward and continue with the
+                # next predecessor there.
+                path.pop()
+                candidates.pop()
+                self.search_stats['backtracks'] += 1
+                if not candidates:
+                    raise Exception('No previous state found.')
+                continue
+
+            self.search_stats['steps'] += 1
+            path.append(P)
+            if len(path) <= delta:
+                candidates.append(self.predecessors(P))
+        return path[-1].astype(int)
+
+
+class LocalSearch:
+    """
+    Approximate step back with WalkSAT / Novelty style local search on the cells of the previous board: the "clauses"
+    are the pixels of the final bitmap, a move flips one previous cell and is scored by how many final pixels it breaks
+    or fixes. Neighbour counts are updated incrementally, so a move only looks at the 3x3 block around the flipped cell.
+    It's an anytime method - it stops on a time / flip budget and returns the best board seen so far.
+    """
+    def __init__(self, tile_graph=None, time_budget=1.0, max_flips=None, restart_flips=20000, noise=0.1,
+                 novelty=0.3, init='proba', rseed=12345):
+        """
+        :param time_budget: seconds per step back (None - only max_flips is used)
+        :param max_flips: optional limit on the number of flips per step back
+        :param restart_flips: flips without improving the best board before restarting from a perturbed best board
+        :param noise: probability of a random walk move (flipping a random cell next to a broken pixel)
+        :param novelty: probability of taking the second best move when the best one would undo the latest flip
+        :param init: initial board - 'proba' (ProbaHeur) or 'stop' (the final bitmap itself)
+        """
+        assert time_budget is not None or max_flips is not None
+        assert init in ('proba', 'stop')
+        self.G = tile_graph
+        self.time_budget = time_budget
+        self.max_flips = max_flips
+        self.restart_flips = restart_flips
+        self.noise = noise
+        self.novelty = novelty
+        self.init = init
+        self.rseed = rseed
+        self.search_stats = {}
+
+    @staticmethod
+    def _blocks(m, n):
+        # Flat ids of the 3x3 block around every cell - the cell itself goes first.
+        offsets = [(0, 0)] + [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1) if di or dj]
+        return [[((i + di) % m) * n + (j + dj) % n for di, dj in offsets] for i in range(m) for j in range(n)]
+
+    def step_back(self, F, random=False, rseed=None, verbose=False):
+        """
+        :param F: final bitmap (boolean matrix)
+        :return: previous bitmap (boolean matrix of the same shape as F) - the best one found, see self.residual
+        """
+        A, self.residual = self.search(F, rseed=rseed, verbose=verbose)
         return A
 
+    def predict(self, delta, stop):
+        X = stop
+        for _ in range(delta):
+            X = self.step_back(X)
+        return X
+
+    def search(self, F, rseed=None, verbose=False):
+        """
+        :return: (best previous bitmap, its residual - fraction of the pixels of F it gets wrong after one step)
+        """
+        F = np.asarray(F, dtype=np.bool_)
+        m, n = F.shape
+        rs = np.random.RandomState(self.rseed if rseed is None else rseed)
+        deadline = time.perf_counter() + self.time_budget if self.time_budget is not None else None
+
+        if self.init == 'proba':
+            G = self.G if self.G is not None else get_tile_graph()
+            try:
+                X0 = ProbaHeur(G, propagation='tensor').step_back(F)
+            except Exception:
+                # No usable estimate (F has no predecessor) - the flips start from F itself.
+                X0 = F
+        else:
+            X0 = F
+
+        blocks = self._blocks(m, n)
+        target = [int(v) for v in F.flatten()]
+        size = m * n
+
+        def evaluate(x):
+            counts = [0] * size
+            for c in range(size):
+                if x[c]:
+                    for k in blocks[c][1:]:
+                        counts[k] += 1
+            unsat = [c for c in range(size) if int(counts[c] == 3 or (x[c] and counts[c] == 2)) != target[c]]
+            return counts, unsat
+
+        x = [int(v) for v in X0.flatten()]
+        counts, unsat = evaluate(x)
+        pos = [-1] * size
+        for p, c in enumerate(unsat):
+            pos[c] = p
+        best, best_unsat = list(x), len(unsat)
+        last_flip = [-1] * size
+
+        def move_delta(c):
+            # Change in the number of broken pixels if cell c flips.
+            d = 1 - 2 * x[c]
+            change = 0
+            for k, b in enumerate(blocks[c]):
+                cnt = counts[b] + (d if k else 0)
+                alive = x[b] ^ (k == 0)
+                new_broken = int(cnt == 3 or (alive and cnt == 2)) != target[b]
+                change += new_broken - (pos[b] >= 0)
+            return change
+
+        def flip(c):
+            d = 1 - 2 * x[c]
+            x[c] ^= 1
+            for k, b in enumerate(blocks[c]):
+                if k:
+                    counts[b] += d
+                broken = int(counts[b] == 3 or (x[b] and counts[b] == 2)) != target[b]
+                if broken and pos[b] < 0:
+                    pos[b] = len(unsat)
+                    unsat.append(b)
+                elif not broken and pos[b] >= 0:
+                    # Swap with the last one to remove in O(1).
+                    last = unsat.pop()
+                    if last != b:
+                        unsat[pos[b]] = last
+                        pos[last] = pos[b]
+                    pos[b] = -1
+
+        flips = restarts = since_best = 0
+        while unsat:
+            if self.max_flips is not None and flips >= self.max_flips:
+                break
+            if deadline is not None and flips % 256 == 0 and time.perf_counter() > deadline:
+                break
+
+            if since_best >= self.restart_flips:
+                # Restart from the best board with some noise around the pixels it still gets wrong.
+                x = list(best)
+                counts, unsat = evaluate(x)
+                for c in unsat[:]:
+                    if rs.rand() < 0.5:
+                        x[blocks[c][rs.randint(9)]] ^= 1
+                counts, unsat = evaluate(x)
+                pos = [-1] * size
+                for p, c in enumerate(unsat):
+                    pos[c] = p
+                restarts += 1
+                since_best = 0
+                continue
+
+            # Cells that can fix a broken pixel are the 9 cells of its 3x3 block.
+            candidates = blocks[unsat[rs.randint(len(unsat))]]
+            if rs.rand() < self.noise:
+                c = candidates[rs.randint(9)]
+            else:
+                # Novelty: the best move (ties go to the least recently flipped cell), unless it's the latest flip.
+                scored = sorted((move_delta(c), last_flip[c], c) for c in candidates)
+                c = scored[0][2]
+                if last_flip[c] == max(last_flip[k] for k in candidates) and rs.rand() < self.novelty:
+                    c = scored[1][2]
+
+            flip(c)
+            last_flip[c] = flips
+            flips += 1
+            since_best += 1
+            if len(unsat) < best_unsat:
+                best, best_unsat = list(x), len(unsat)
+                since_best = 0
+
+        self.search_stats = {'flips': flips, 'restarts': restarts, 'broken': best_unsat}
+        if verbose:
+            print(f'Local search: {self.search_stats}')
+        return np.array(best, dtype=np.bool_).reshape(m, n), best_unsat / size
+
 
 def train_loop(model_name, learner, early_stop_window=100, rseed=9342184):
     errors = []
@@ -0,0 +1,352 @@
+import random
+import time
+import numpy as np
+
+# _NEXT[l * 64 + c * 8 + r] - next state of the middle cell of 3 columns (left, center, right) of 3 cells each, bit k of
+# a column being the cell in row k.
+_COLUMN_CELLS = (np.arange(8)[:, None] >> np.arange(3)) & 1
+_codes = np.arange(512)
+_live = _COLUMN_CELLS.sum(axis=1)
+_center = (_codes >> 4) & 1
+_nbrs = _live[_codes >> 6] + _live[(_codes >> 3) & 7] + _live[_codes & 7] - _center
+_NEXT = ((_nbrs == 3) | ((_center == 1) & (_nbrs == 2))).astype(np.uint8)
+
+
+def row_triples(r, w):
+    """
+    All the triples of previous rows (a, b, c) of a torus of width w that evolve into row r in the place of row b.
+    Columns of the 3 rows are enumerated left to right, every new column decides the cell left of it, so the partial
+    assignments stay about 4^w.
+    :param r: final row as an int, bit j is the cell in column j
+    :return: 3 int64 arrays a, b, c
+    """
+    target = (r >> np.arange(w)) & 1
+    # Partial assignments: the first two columns (for the wrap), the last two and the rows built so far.
+    first, second = np.divmod(np.arange(64), 8)
+    prev, last = first, second
+    rows = [_COLUMN_CELLS[first, k] | _COLUMN_CELLS[second, k] << 1 for k in range(3)]
+    for j in range(2, w):
+        new = np.tile(np.arange(8), len(prev))
+        keep = _NEXT[np.repeat(prev * 64 + last * 8, 8) + new] == target[j - 1]
+        idx = np.repeat(np.arange(len(prev)), 8)[keep]
+        new = new[keep]
+        rows = [x[idx] | _COLUMN_CELLS[new, k] << j for k, x in enumerate(rows)]
+        first, second, prev, last = first[idx], second[idx], last[idx], new
+    # The two cells whose neighbourhood wraps around.
+    keep = (_NEXT[prev * 64 + last * 8 + first] == target[w - 1]) & (_NEXT[last * 64 + first * 8 + second] == target[0])
+    return tuple(x[keep].astype(np.int64) for x in rows)
+
+
+class TransferMatrix:
+    """
+    Exact predecessors of narrow tori with a transfer matrix over pairs of consecutive previous rows: a row of the final
+    board only depends on 3 consecutive previous rows, so a predecessor is a closed walk of row pairs (a, b) -> (b, c),
+    with a step allowed only if (a, b, c) evolves into the final row. The walks are extended row by row for many start
+    pairs at once (to close the torus a walk has to come back to its start), which gives the number of predecessors,
+    exact marginals of the previous cells (forward-backward) and uniform samples (stepping back through the layers).
+
+    Walks are kept per (start pair, last pair), so a layer can have up to 16^width entries - the start pairs are split
+    into chunks whose layers fit in max_bytes (MemoryError if even a single start pair needs more) and the usage is
+    reported in transfer_stats. The torus is cut at the final row with the fewest start pairs. Counts are int64 as long
+    as they fit, Python ints beyond that.
+
+    The width is the smaller side of the board. It's meant as the reference oracle for narrow boards - up to width 6
+    a board takes seconds, width 7 minutes. Sparse boards are the slowest, they have the most start pairs.
+    """
+    def __init__(self, max_width=7, max_bytes=2 ** 30):
+        """
+        :param max_width: boards with both sides wider are rejected with ValueError
+        :param max_bytes: max size of the layers of walks kept at once (plus the temporary arrays of the next step)
+        """
+        self.max_width = max_width
+        self.max_bytes = max_bytes
+        self.transfer_stats = {}
+        self._cache = None
+
+    def _prepare(self, F):
+        """
+        :return: board context - the final rows along the longer side, rolled so that the torus is cut before row 1,
+            and the triples of previous rows for every final row
+        """
+        F = np.asarray(F, dtype=np.bool_)
+        if self._cache is not None and self._cache['board'].shape == F.shape and (self._cache['board'] == F).all():
+            return self._cache
+
+        transposed = F.shape[1] > F.shape[0]
+        X = F.T if transposed else F
+        h, w = X.shape
+        if w > self.max_width:
+            raise ValueError(f'Board {F.shape[0]}x{F.shape[1]} is too wide for the transfer matrix.')
+        if w < 3 or h < 3:
+            raise ValueError('Both sides of the board have to be at least 3.')
+
+        final_rows = (X.astype(np.int64) << np.arange(w)).sum(axis=1)
+        triples = {}
+        for r in set(final_rows.tolist()):
+            a, b, c = row_triples(r, w)
+            order = np.argsort(a << w | b, kind='stable')
+            triples[r] = ((a << w | b)[order], c[order])
+
+        # Every walk starts with a triple of final row 1, the one with the fewest distinct start pairs is the cheapest.
+        starts = {r: np.unique(keys) for r, (keys, _) in triples.items()}
+        shift = int(np.argmin([len(starts[r]) for r in final_rows])) - 1
+        final_rows = np.roll(final_rows, -shift)
+        self._cache = {
+            'board': F.copy(), 'transposed': transposed, 'shift': shift, 'w': w, 'h': h, 'final_rows': final_rows,
+            'triples': triples, 'starts': starts[final_rows[1]], 'chunks': None, 'layers': None,
+        }
+        return self._cache
+
+    def _walks(self, ctx, starts):
+        """
+        :param starts: sorted start pairs (row 0 << w | row 1) of the walks
+        :return: (layers, closed, total) - layer k has the walks over the previous rows 0..k+2 (row h being row 0
+            again) as arrays (start pair << 2w | last pair, count, (parent entry in layer k-1, entry) of every step);
+            closed marks the walks of the last layer that make a predecessor, total is their number
+        """
+        w, h, final_rows, triples = ctx['w'], ctx['h'], ctx['final_rows'], ctx['triples']
+        mask = (1 << w) - 1
+
+        # Layer 0: rows 0, 1, 2 - the triples of final row 1 with the given start pairs.
+        keys, c = triples[final_rows[1]]
+        lo, hi = np.searchsorted(keys, starts[0]), np.searchsorted(keys, starts[-1], side='right')
+        walks = keys[lo:hi] << (2 * w) | (keys[lo:hi] & mask) << w | c[lo:hi]
+        layers = [(walks, np.ones(len(walks), dtype=np.int64), None)]
+        stored = 2 * walks.nbytes
+        for k in range(2, h):
+            # Steps to every triple of final row k starting with the last pair of a walk.
+            keys, c = triples[final_rows[k]]
+            pair = walks & ((1 << (2 * w)) - 1)
+            lo = np.searchsorted(keys, pair, side='left')
+            n = np.searchsorted(keys, pair, side='right') - lo
+            steps = int(n.sum())
+            # About 6 int64 arrays of the size of the steps are alive at once.
+            if stored + 48 * steps > self.max_bytes:
+                raise MemoryError(f'Transfer matrix walks need more than {self.max_bytes} bytes.')
+            parent = np.repeat(np.arange(len(walks), dtype=np.int32), n)
+            step = np.repeat(lo - np.cumsum(n) + n, n) + np.arange(steps)
+            key = (walks[parent] >> (2 * w)) << (2 * w) | (pair[parent] & mask) << w | c[step]
+            del pair, lo, n, step
+
+            # Walks with the same start and last pair are merged.
+            order = np.argsort(key, kind='stable')
+            key, parent = key[order], parent[order]
+            del order
+            new = np.r_[True, key[1:] != key[:-1]] if steps else np.zeros(0, dtype=np.bool_)
+            child = (np.cumsum(new) - 1).astype(np.int32)
+            count = _sum_at(int(new.sum()), child, layers[-1][1][parent])
+            walks = key[new]
+            layers.append((walks, count, (parent, child)))
+            stored += walks.nbytes + count.nbytes + parent.nbytes + child.nbytes
+
+        # Closing the torus: the last step has put row 0 after row h-1, and row 1 has to follow with final row 0.
+        start, count = walks >> (2 * w), layers[-1][1]
+        before, last = walks >> w & mask, walks & mask
+        closed = (last == start >> w) & (_next_row(before, last, start & mask, w) == final_rows[0])
+        total = int(sum(count[closed].tolist()))
+
+        self.transfer_stats['entries'] = max(self.transfer_stats.get('entries', 0), sum(len(l[0]) for l in layers))
+        self.transfer_stats['bytes'] = max(self.transfer_stats.get('bytes', 0), stored)
+        return layers, closed, total
+
+    def _chunks(self, ctx):
+        """
+        Forward passes over all the start pairs, split in chunks that fit in max_bytes.
+        :return: generator of (starts, layers, closed, total)
+        """
+        if ctx['chunks'] is not None:
+            if ctx['layers'] is not None:
+                yield (ctx['chunks'][0][0],) + ctx['layers']
+                return
+            for starts, _ in ctx['chunks']:
+                yield (starts,) + self._walks(ctx, starts)
+            return
+
+        tic = time.perf_counter()
+        self.transfer_stats = {'width': ctx['w'], 'height': ctx['h']}
+        chunks = []
+        todo = [ctx['starts']] if len(ctx['starts']) else []
+        while todo:
+            starts = todo.pop()
+            try:
+                result = self._walks(ctx, starts)
+            except MemoryError:
+                if len(starts) == 1:
+                    raise
+                todo += [starts[len(starts) // 2:], starts[:len(starts) // 2]]
+                continue
+            chunks.append((starts, result[2]))
+            yield (starts,) + result
+        ctx['chunks'] = chunks
+        if len(chunks) == 1:
+            ctx['layers'] = result
+        self.transfer_stats.update(chunks=len(chunks), seconds=time.perf_counter() - tic)
+
+    def count(self, F):
+        """
+        :param F: final bitmap (boolean matrix)
+        :return: exact number of predecessors of F (int)
+        """
+        ctx = self._prepare(F)
+        if ctx['chunks'] is None:
+            for _ in self._chunks(ctx):
+                pass
+        return sum(total for _, total in ctx['chunks'])
+
+    def marginals(self, F):
+        """
+        :return: probability of every previous cell being alive over all the predecessors of F (uniformly), NaN if F
+            has no predecessor
+        """
+        ctx = self._prepare(F)
+        w, h = ctx['w'], ctx['h']
+        bits = np.arange(w)
+        alive = [[0] * w for _ in range(h)]
+        for _, layers, closed, total in self._chunks(ctx):
+            if total == 0:
+                continue
+            # Backward pass: number of ways to finish every walk, times the number of walks reaching it.
+            back = closed.astype(np.int64)
+            for k in range(len(layers) - 1, -1, -1):
+                walks, count, edges = layers[k]
+                through = _product(count, back)
+                if total >= 2 ** 62:
+                    # The sums of the layer go up to the total.
+                    through = through.astype(object)
+                # Layer k ends with rows k+1 and k+2 (row h is row 0 again), layer 0 starts with rows 0 and 1.
+                rows = [(k + 2, walks & ((1 << w) - 1))] if k + 2 < h else []
+                if k == 0:
+                    rows += [(0, walks >> (3 * w)), (1, walks >> w & ((1 << w) - 1))]
+                for i, values in rows:
+                    on = ((values[:, None] >> bits) & 1).astype(np.bool_)
+                    for j in range(w):
+                        alive[i][j] += int(through[on[:, j]].sum())
+                if edges is not None:
+                    parent, child = edges
+                    back = _sum_at(len(layers[k - 1][0]), parent, back[child])
+
+        total = self.count(F)
+        if total == 0:
+            return np.full(np.shape(F), np.nan)
+        P = np.roll(np.array([[a / total for a in row] for row in alive]), ctx['shift'], axis=0)
+        return P.T if ctx['transposed'] else P
+
+    def sample(self, F, size=1, rseed=None):
+        """
+        :return: array (size, m, n) of predecessors of F drawn uniformly (independently)
+        """
+        total = self.count(F)
+        if total == 0:
+            raise Exception('No previous state found.')
+        ctx = self._prepare(F)
+        w, h = ctx['w'], ctx['h']
+        mask = (1 << w) - 1
+        # The counts may be big ints, so are the random numbers.
+        rs = random.Random(rseed)
+
+        def choose(weights):
+            cumulative = np.cumsum(np.asarray(weights.tolist(), dtype=object))
+            return int(np.searchsorted(cumulative, rs.randrange(cumulative[-1]), side='right'))
+
+        # Number of samples from every chunk first, so every chunk is walked once.
+        totals = np.array([t for _, t in ctx['chunks']], dtype=object)
+        per_chunk = np.bincount([choose(totals) for _ in range(size)], minlength=len(totals))
+        samples = []
+        for (starts, _), n in zip(ctx['chunks'], per_chunk):
+            if n == 0:
+                continue
+            layers, closed, _ = ctx['layers'] if ctx['layers'] is not None else self._walks(ctx, starts)
+            last = np.flatnonzero(closed)
+            for _ in range(n):
+                e = last[choose(layers[-1][1][last])]
+                rows = np.zeros(h + 1, dtype=np.int64)
+                for k in range(len(layers) - 1, -1, -1):
+                    walks, _, edges = layers[k]
+                    rows[k + 2] = walks[e] & mask
+                    if edges is not None:
+                        parent, child = edges
+                        options = parent[child == e]
+                        e = options[choose(layers[k - 1][1][options])]
+                rows[0], rows[1] = walks[e] >> (3 * w), walks[e] >> w & mask
+                samples.append((rows[:h, None] >> np.arange(w)) & 1)
+
+        # The chunks come in order, the samples shouldn't.
+        samples = np.roll(np.array(samples, dtype=np.bool_)[rs.sample(range(size), size)], ctx['shift'], axis=1)
+        return samples.transpose(0, 2, 1) if ctx['transposed'] else samples
+
+    def step_back(self, F, rseed=None, verbose=False):
+        """
+        :param F: final bitmap (boolean matrix)
+        :return: previous bitmap drawn uniformly from all the predecessors (int matrix of the same shape as F)
+        """
+        A = self.sample(F, rseed=rseed)[0]
+        if verbose:
+            print(f'Transfer matrix: {self.transfer_stats}')
+        return A.astype(int)
+
+    def predict(self, delta, stop, rseed=None):
+        A = np.asarray(stop)
+        for _ in range(delta):
+            A = self.step_back(A, rseed=rseed)
+        return A
+
+
+def _sum_at(size, index, values):
+    """
+    :return: array of the given size with values summed by index - int64 unless the sums could overflow
+    """
+    if values.dtype != object and np.bincount(index, values.astype(np.float64), size).max(initial=0) >= 2 ** 62:
+        values = values.astype(object)
+    sums = np.zeros(size, dtype=values.dtype)
+    np.add.at(sums, index, values)
+    return sums
+
+
+def _product(a, b):
+    if a.dtype != object and b.dtype != object and (a.astype(np.float64) * b).max(initial=0) < 2 ** 62:
+        return a * b
+    return a.astype(object) * b.astype(object)
+
+
+def _next_row(a, b, c, w):
+    """
+    :return: rows evolved from the previous rows a, b, c (int arrays) in the place of b on a torus of width w
+    """
+    bits = np.arange(w)
+    column = ((a[:, None] >> bits) & 1) | ((b[:, None] >> bits) & 1) << 1 | ((c[:, None] >> bits) & 1) << 2
+    cells = _NEXT[np.roll(column, 1, axis=1) * 64 + column * 8 + np.roll(column, -1, axis=1)]
+    return (cells.astype(np.int64) << bits).sum(axis=1)
+
+
+if __name__ == '__main__':
+    from simulator import life_step
+    from tile_graph import BeliefProp
+
+    # Exact marginals as the reference for the approximate reverse models on narrow boards of the test distribution
+    # (random density, 5 warm-up steps, one step to reverse). BeliefProp with uniform priors and without any round is
+    # the domain fraction of ProbaHeur.
+    uniform = np.zeros((512, 512))
+    models = {
+        'ProbaHeur': BeliefProp(trans=uniform, rounds=0),
+        'BeliefProp uniform': BeliefProp(trans=uniform),
+        'BeliefProp': BeliefProp(),
+    }
+    errors = {name: [] for name in models}
+    agreement = {name: [] for name in models}
+    T = TransferMatrix()
+    rs = np.random.RandomState(0)
+    for _ in range(20):
+        density = rs.uniform(0.01, 0.99)
+        X = rs.rand(16, 5) < density
+        for _ in range(6):
+            X = life_step(X)
+        P = T.marginals(X)
+        print(f'Predecessors: {T.count(X):.3e} {T.transfer_stats}', flush=True)
+        for name, model in models.items():
+            Q = model.marginals(X[None])[0]
+            errors[name].append(np.abs(Q - P).mean())
+            # Cells alive in exactly half of the predecessors have no majority.
+            decided = P != 0.5
+            agreement[name].append(((Q > 0.5) == (P > 0.5))[decided].mean())
+    for name in models:
+        print(f'{name}: mean abs error {np.mean(errors[name]):.4f}, same majority {np.mean(agreement[name]):.4f}')
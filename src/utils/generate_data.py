@@ -1,5 +1,9 @@
+import sys
 import numpy as np
 
+sys.path.insert(0, '..')
+from csv_writer import write_csv
+
 def generate():
     # Create seeding board
     seed_board = np.random.randint(0, 2, (25, 25)) 
@@ -27,10 +31,10 @@ def life_step(X):
 
 if __name__ == '__main__':
     N = 100000
-    with open('../../data/extra.csv', 'w') as outfile:
-        for i in range(N): 
+
+    def rows():
+        for i in range(N):
             num_steps, start_board, stop_board = generate()
-            #row = f'{i}, {num_steps}, '
-            row = ', '.join(map(str, start_board.flatten())) + ', '
-            row += ', '.join(map(str, stop_board.flatten())) + '\n'
-            outfile.write(row)
+            yield start_board, stop_board
+
+    write_csv('../../data/extra.csv', rows())